@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules under test import their siblings from scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+
+# Manual scripts that load the full models at import time, not pytest tests
+collect_ignore = ['test_analysis.py', 'test_similarity.py', 'debug_embeddings.py', 'debug_xray.py',
+                  'simple_test.py']
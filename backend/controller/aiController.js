@@ -3,10 +3,12 @@ import ErrorHandler from "../middlewares/error.js";
 import ragAssistant from "../utils/ragModel.js";
 import ChatHistory from "../models/chatHistorySchema.js";
 import { spawn } from "child_process";
-import fs from "fs";
 import path from "path";
 import { Notification } from "../models/notificationSchema.js";
 import mongoose from "mongoose";
+import axios from "axios";
+import FramedClient from "../utils/framedClient.js";
+import ImageJobQueue, { QueueFullError } from "../utils/imageJobQueue.js";
 
 // TODO: Import your trained RAG model here
 // import { yourRAGModel } from '../utils/ragModel.js';
@@ -265,7 +267,8 @@ export const aiHealthCheck = catchAsyncErrors(async (req, res, next) => {
     
     res.status(200).json({
       success: true,
-      ...healthStatus
+      ...healthStatus,
+      imageJobs: getImageJobQueue().stats()
     });
   } catch (error) {
     return next(new ErrorHandler("AI service health check failed", 500));
@@ -414,144 +417,298 @@ export const getDetailedResponse = catchAsyncErrors(async (req, res, next) => {
   }
 });
 
-// Image Analysis endpoint
-export const analyzeImage = catchAsyncErrors(async (req, res, next) => {
-  if (!req.file) {
-    return next(new ErrorHandler("No image file uploaded.", 400));
+// Stderr kept from a spawned image analysis for error reporting
+const MAX_STDERR_CHARS = 16384;
+
+// Persistent image-analysis server on a Unix socket, if configured
+let imageSocketClient = null;
+const getImageSocketClient = () => {
+  const socketPath = process.env.IMAGE_ANALYZER_SOCKET;
+  if (!socketPath) return null;
+  if (!imageSocketClient || imageSocketClient.socketPath !== socketPath) {
+    imageSocketClient = new FramedClient(socketPath, { timeout: 120000 });
   }
-  if (!req.body.type) {
-    fs.unlinkSync(req.file.path); // Clean up uploaded file
-    return next(new ErrorHandler("Image type (ct, xray, mri) is required.", 400));
+  return imageSocketClient;
+};
+
+// Run the image analyzer: on the IMAGE_ANALYZER_SOCKET server, through the
+// warm inference service when INFERENCE_SERVICE_URL is set, otherwise by
+// spawning the Python script. The encoded image travels in memory on every
+// path (socket payload, HTTP body or the script's stdin); uploads are never
+// written to disk. Aborting `signal` abandons the analysis on every path.
+const runImageAnalysis = async (imageBuffer, modelType, { signal } = {}) => {
+  const socketClient = getImageSocketClient();
+  if (socketClient) {
+    try {
+      return await socketClient.request({ model_type: modelType }, imageBuffer, { signal });
+    } catch (error) {
+      throw new Error(`Failed to analyze the image: ${error.message}`);
+    }
+  }
+
+  const serviceUrl = process.env.INFERENCE_SERVICE_URL;
+  if (serviceUrl) {
+    try {
+      const { data } = await axios.post(`${serviceUrl}/image/analyze/bytes`, imageBuffer, {
+        params: { model_type: modelType },
+        headers: { 'Content-Type': 'application/octet-stream' },
+        maxBodyLength: Infinity,
+        timeout: 120000,
+        signal
+      });
+      return data;
+    } catch (error) {
+      if (error.response?.status === 500 && error.response.data?.detail) {
+        // Analyzer-level failures come back as HTTP 500 with the analyzer's message
+        return { error: error.response.data.detail };
+      }
+      throw new Error(`Failed to analyze the image: ${error.response?.data?.detail || error.message}`);
+    }
   }
 
-  const imagePath = req.file.path;
-  const modelType = req.body.type;
-  const { userId, sessionId } = req.body;
-  
   // Use the lightweight version that works with 8GB RAM
   const scriptPath = path.join(process.cwd(), 'scripts', 'lightweight_image_analyzer.py');
 
-  const pythonProcess = spawn('python', [scriptPath, '--image_path', imagePath, '--model_type', modelType]);
+  return new Promise((resolve, reject) => {
+    const pythonProcess = spawn('python', [scriptPath, '--image_path', '-', '--model_type', modelType]);
+    // A timed-out job stops its analyzer instead of leaving it running
+    signal?.addEventListener('abort', () => pythonProcess.kill('SIGTERM'), { once: true });
+    // The script reads the image from stdin; if it dies early the close handler reports it
+    pythonProcess.stdin.on('error', () => {});
+    pythonProcess.stdin.end(imageBuffer);
+
+    let result = '';
+    let error = '';
+
+    pythonProcess.stdout.on('data', (data) => {
+      result += data.toString();
+    });
 
-  let result = '';
-  let error = '';
+    pythonProcess.stderr.on('data', (data) => {
+      // Only the tail is needed to report a failure; traces (IMAGE_TRACE=-) can be long
+      error = (error + data.toString()).slice(-MAX_STDERR_CHARS);
+    });
+
+    pythonProcess.on('close', (code) => {
+      if (code !== 0) {
+        console.error(`Python Script Error: ${error}`);
+        return reject(new Error("Failed to analyze the image."));
+      }
+      try {
+        resolve(JSON.parse(result));
+      } catch (parseError) {
+        console.error('Error parsing Python response:', parseError);
+        reject(new Error("Failed to parse analysis results."));
+      }
+    });
 
-  pythonProcess.stdout.on('data', (data) => {
-    result += data.toString();
+    pythonProcess.on('error', (err) => {
+      console.error('Failed to start Python process:', err);
+      reject(new Error("Failed to start analysis process."));
+    });
   });
+};
 
-  pythonProcess.stderr.on('data', (data) => {
-    error += data.toString();
+// Bounded queue in front of the image analyzer: IMAGE_JOB_WORKERS analyses
+// run at once, up to IMAGE_JOB_QUEUE wait, and uploads beyond that get a 429
+let imageJobQueue = null;
+const getImageJobQueue = () => {
+  if (!imageJobQueue) {
+    imageJobQueue = new ImageJobQueue({
+      workers: parseInt(process.env.IMAGE_JOB_WORKERS || '2', 10),
+      maxQueue: parseInt(process.env.IMAGE_JOB_QUEUE || '16', 10),
+      timeoutMs: parseInt(process.env.IMAGE_JOB_TIMEOUT_MS || '120000', 10)
+    });
+  }
+  return imageJobQueue;
+};
+
+// Analyze an uploaded image and save it for doctor approval; runs as a queued job
+const processImageUpload = async ({ file, modelType, userId, sessionId }, signal) => {
+  // multer keeps the upload in memory; the same buffer is analyzed and stored
+  const imageBuffer = file.buffer;
+  let jsonResponse;
+  try {
+    jsonResponse = await runImageAnalysis(imageBuffer, modelType, { signal });
+  } catch (analysisError) {
+    console.error(`Image analysis error: ${analysisError.message}`);
+    throw new ErrorHandler(analysisError.message, 500);
+  }
+
+  console.log('[IMAGE ANALYSIS] Python response:', JSON.stringify(jsonResponse, null, 2));
+
+  if (jsonResponse.error) {
+    throw new ErrorHandler(jsonResponse.error, 500);
+  }
+
+  console.log('[IMAGE ANALYSIS] Image file info:', {
+    mimetype: file.mimetype,
+    originalname: file.originalname,
+    size: file.size
   });
 
-  pythonProcess.on('close', async (code) => {
-    if (code !== 0) {
-      console.error(`Python Script Error: ${error}`);
-      fs.unlinkSync(imagePath); // Clean up uploaded file
-      return next(new ErrorHandler("Failed to analyze the image.", 500));
-    }
+  // Prepare analysis results
+  const analysisResults = {
+    diagnosis: jsonResponse.final_diagnosis || jsonResponse.diagnosis || "Analysis completed",
+    confidence: jsonResponse.similarity_score || jsonResponse.confidence || "N/A",
+    findings: jsonResponse.treatment_plan || jsonResponse.findings || "Treatment plan available",
+    recommendations: jsonResponse.recommendations || "Based on analysis, consult with a specialist.",
+    followUp: jsonResponse.follow_up || "Schedule follow-up appointment.",
+    medication: jsonResponse.medication_prescribed || "Medication should be prescribed by a qualified healthcare provider.",
+    source: jsonResponse.source || "AI Analysis",
+  };
+
+  // Save to chat history with image data as pending
+  if (userId && sessionId) {
     try {
-      const jsonResponse = JSON.parse(result);
-      console.log('[IMAGE ANALYSIS] Python response:', JSON.stringify(jsonResponse, null, 2));
-      
-      if (jsonResponse.error) {
-        fs.unlinkSync(imagePath); // Clean up uploaded file
-        return next(new ErrorHandler(jsonResponse.error, 500));
+      let chatSession = await ChatHistory.findOne({ userId, sessionId, type: 'image_analysis' });
+      if (!chatSession) {
+        chatSession = new ChatHistory({ userId, sessionId, type: 'image_analysis', messages: [] });
       }
-
-      // Read the image file data BEFORE deleting it
-      const imageBuffer = fs.readFileSync(imagePath);
-      console.log('[IMAGE ANALYSIS] Image buffer size:', imageBuffer.length, 'bytes');
-      console.log('[IMAGE ANALYSIS] Image file info:', {
-        path: imagePath,
-        mimetype: req.file.mimetype,
-        originalname: req.file.originalname,
-        size: req.file.size
-      });
-      
-      // Clean up the uploaded file
-      fs.unlinkSync(imagePath);
-
-      // Prepare analysis results
-      const analysisResults = {
-        diagnosis: jsonResponse.final_diagnosis || jsonResponse.diagnosis || "Analysis completed",
-        confidence: jsonResponse.similarity_score || jsonResponse.confidence || "N/A",
-        findings: jsonResponse.treatment_plan || jsonResponse.findings || "Treatment plan available",
-        recommendations: jsonResponse.recommendations || "Based on analysis, consult with a specialist.",
-        followUp: jsonResponse.follow_up || "Schedule follow-up appointment.",
-        medication: jsonResponse.medication_prescribed || "Medication should be prescribed by a qualified healthcare provider.",
-        source: jsonResponse.source || "AI Analysis",
-      };
-
-      // Save to chat history with image data as pending
-      if (userId && sessionId) {
-        try {
-          let chatSession = await ChatHistory.findOne({ userId, sessionId, type: 'image_analysis' });
-          if (!chatSession) {
-            chatSession = new ChatHistory({ userId, sessionId, type: 'image_analysis', messages: [] });
-          }
-          // Add user message (image upload)
-          chatSession.messages.push({
-            role: 'user',
-            content: `Uploaded ${modelType.toUpperCase()} image for analysis`,
-            timestamp: new Date(),
-            imageType: modelType,
-            imageData: {
-              data: imageBuffer,
-              contentType: req.file.mimetype,
-              filename: req.file.originalname,
-            }
-          });
-          // Add AI analysis response as pending
-          chatSession.messages.push({
-            role: 'ai',
-            content: analysisResults.diagnosis || 'Analysis completed',
-            timestamp: new Date(),
-            imageType: modelType,
-            analysisResults: analysisResults,
-            imageData: {
-              data: imageBuffer,
-              contentType: req.file.mimetype,
-              filename: req.file.originalname,
-            },
-            status: 'pending',
-            approved: false
-          });
-          if (chatSession.messages.length === 2) {
-            chatSession.title = `${modelType.toUpperCase()} Image Analysis`;
-          }
-          await chatSession.save();
-          console.log('[IMAGE ANALYSIS] Saved pending image analysis for doctor approval');
-
-          // Find a doctor to notify (for demo, notify the first doctor)
-          const doctor = await (await import("../models/userSchema.js")).User.findOne({ role: "Doctor" });
-          if (doctor) {
-            await notifyDoctorOfPendingLLM({ doctorId: doctor._id, userId, sessionId, chatType: 'image_analysis' });
-          }
-        } catch (historyError) {
-          console.error('[IMAGE ANALYSIS] Error saving image analysis to history:', historyError);
-          return next(new ErrorHandler('Failed to save image analysis for doctor approval', 500));
+      // Add user message (image upload)
+      chatSession.messages.push({
+        role: 'user',
+        content: `Uploaded ${modelType.toUpperCase()} image for analysis`,
+        timestamp: new Date(),
+        imageType: modelType,
+        imageData: {
+          data: imageBuffer,
+          contentType: file.mimetype,
+          filename: file.originalname,
         }
-      } else {
-        console.log('[IMAGE ANALYSIS] Skipping chat history save - missing userId or sessionId:', { userId: !!userId, sessionId: !!sessionId });
+      });
+      // Add AI analysis response as pending
+      chatSession.messages.push({
+        role: 'ai',
+        content: analysisResults.diagnosis || 'Analysis completed',
+        timestamp: new Date(),
+        imageType: modelType,
+        analysisResults: analysisResults,
+        imageData: {
+          data: imageBuffer,
+          contentType: file.mimetype,
+          filename: file.originalname,
+        },
+        status: 'pending',
+        approved: false
+      });
+      if (chatSession.messages.length === 2) {
+        chatSession.title = `${modelType.toUpperCase()} Image Analysis`;
       }
+      await chatSession.save();
+      console.log('[IMAGE ANALYSIS] Saved pending image analysis for doctor approval');
 
-      // Respond to user: waiting for doctor approval
-      res.status(200).json({
-        success: true,
-        message: 'Waiting for doctor approval...',
-        waitingForApproval: true
-      });
-    } catch (parseError) {
-      console.error('Error parsing Python response:', parseError);
-      fs.unlinkSync(imagePath); // Clean up uploaded file
-      return next(new ErrorHandler("Failed to parse analysis results.", 500));
+      // Find a doctor to notify (for demo, notify the first doctor)
+      const doctor = await (await import("../models/userSchema.js")).User.findOne({ role: "Doctor" });
+      if (doctor) {
+        await notifyDoctorOfPendingLLM({ doctorId: doctor._id, userId, sessionId, chatType: 'image_analysis' });
+      }
+    } catch (historyError) {
+      console.error('[IMAGE ANALYSIS] Error saving image analysis to history:', historyError);
+      throw new ErrorHandler('Failed to save image analysis for doctor approval', 500);
     }
-  });
+  } else {
+    console.log('[IMAGE ANALYSIS] Skipping chat history save - missing userId or sessionId:', { userId: !!userId, sessionId: !!sessionId });
+  }
+
+  // Respond to user: waiting for doctor approval
+  return {
+    success: true,
+    message: 'Waiting for doctor approval...',
+    waitingForApproval: true
+  };
+};
+
+// Image Analysis endpoint
+// Waits for the result by default; with `async=true` (body or query) it
+// returns 202 and a job id that its owner (`userId`) can poll at
+// /image-jobs/:id or stream from /image-jobs/:id/events. Waiting uploads are
+// queued ahead of async ones, since a client is holding a connection open.
+export const analyzeImage = catchAsyncErrors(async (req, res, next) => {
+  if (!req.file) {
+    return next(new ErrorHandler("No image file uploaded.", 400));
+  }
+  if (!req.body.type) {
+    return next(new ErrorHandler("Image type (ct, xray, mri) is required.", 400));
+  }
 
-  pythonProcess.on('error', (err) => {
-    fs.unlinkSync(imagePath);
-    console.error('Failed to start Python process:', err);
-    return next(new ErrorHandler("Failed to start analysis process.", 500));
+  const isAsync = req.body.async === 'true' || req.query.async === 'true';
+  if (isAsync && !req.body.userId) {
+    return next(new ErrorHandler("userId is required for async image analysis.", 400));
+  }
+
+  const queue = getImageJobQueue();
+  const upload = {
+    file: req.file,
+    modelType: req.body.type,
+    userId: req.body.userId,
+    sessionId: req.body.sessionId
+  };
+
+  let jobId;
+  try {
+    jobId = queue.submit((signal) => processImageUpload(upload, signal), {
+      priority: isAsync ? 0 : 1,
+      meta: { modelType: upload.modelType, userId: upload.userId || null }
+    });
+  } catch (error) {
+    if (!(error instanceof QueueFullError)) throw error;
+    res.set('Retry-After', '10');
+    return next(new ErrorHandler(`${error.message}, please retry shortly.`, 429));
+  }
+
+  if (isAsync) {
+    return res.status(202).json({
+      success: true,
+      jobId,
+      status: 'queued',
+      statusUrl: `${req.baseUrl}/image-jobs/${jobId}`
+    });
+  }
+
+  const job = await queue.wait(jobId);
+  if (job.status !== 'succeeded') {
+    return next(new ErrorHandler(job.error, job.statusCode));
+  }
+  res.status(200).json(job.result);
+});
+
+// A job is only visible to the user who uploaded it; others get the same 404 as for a missing job
+const findOwnImageJob = (queue, req) => {
+  const job = queue.get(req.params.id);
+  if (!job || String(job.meta.userId) !== String(req.user._id)) return null;
+  return job;
+};
+
+// Status (and, once finished, result) of a queued image analysis
+export const getImageJob = catchAsyncErrors(async (req, res, next) => {
+  const job = findOwnImageJob(getImageJobQueue(), req);
+  if (!job) {
+    return next(new ErrorHandler("Image analysis job not found or expired.", 404));
+  }
+  res.status(200).json({ success: true, job });
+});
+
+// Server-sent events with every state change of a queued image analysis
+export const subscribeImageJob = catchAsyncErrors(async (req, res, next) => {
+  const queue = getImageJobQueue();
+  const job = findOwnImageJob(queue, req);
+  if (!job) {
+    return next(new ErrorHandler("Image analysis job not found or expired.", 404));
+  }
+
+  res.writeHead(200, {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    Connection: 'keep-alive'
   });
-}); 
\ No newline at end of file
+  const send = (view) => {
+    res.write(`event: ${view.status}\ndata: ${JSON.stringify(view)}\n\n`);
+    if (view.finishedAt) res.end();
+  };
+
+  send(job);
+  if (job.finishedAt) return;
+  const unsubscribe = queue.subscribe(job.id, send);
+  req.on('close', unsubscribe);
+});
@@ -1,26 +1,13 @@
 import multer from "multer";
-import path from "path";
-import fs from "fs";
 
-// Ensure the uploads directory exists
-const uploadDir = path.join(process.cwd(), 'uploads');
-if (!fs.existsSync(uploadDir)) {
-  fs.mkdirSync(uploadDir, { recursive: true });
-}
+// Keep uploads in memory: the analyzer receives the buffer directly (socket
+// payload, HTTP body or stdin), so nothing is written to or cleaned up from disk.
+// The size limit and the image job queue bound how many buffers are held at once.
+const storage = multer.memoryStorage();
 
-const storage = multer.diskStorage({
-  destination: function (req, file, cb) {
-    cb(null, uploadDir);
-  },
-  filename: function (req, file, cb) {
-    const uniqueSuffix = Date.now() + '-' + Math.round(Math.random() * 1E9);
-    cb(null, file.fieldname + '-' + uniqueSuffix + path.extname(file.originalname));
-  }
-});
-
-const upload = multer({ 
+const upload = multer({
   storage: storage,
-  limits: { 
+  limits: {
     fileSize: 10 * 1024 * 1024, // 10 MB file size limit
     files: 1 // Only allow 1 file
   },
@@ -33,4 +20,4 @@ const upload = multer({
   }
 }).single('image'); // Explicitly specify the field name
 
-export default upload; 
\ No newline at end of file
+export default upload;
@@ -1,7 +1,11 @@
 import os
+import sys
 import pickle
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from embedding_store import migrate_pickle
+
 def normalize_embeddings(modality):
     base_path = f"data/medical_images/{modality}"
     emb_path = os.path.join(base_path, "diagnosis_image_embeddings.pkl")
@@ -33,6 +37,10 @@ def normalize_embeddings(modality):
         pickle.dump(norm_embeddings, f)
     print(f"Saved normalized embeddings to {emb_path}")
 
+    # The analyzers read the memory-mapped store, so rebuild it from the new pickle
+    meta = migrate_pickle(base_path)
+    print(f"Rebuilt embedding store ({meta['count']} x {meta['dim']})")
+
 if __name__ == "__main__":
     for modality in ["ct", "mri", "xray"]:
         normalize_embeddings(modality)
@@ -7,7 +7,9 @@ import {
   initializeAIModel,
   testRAGModel,
   getDetailedResponse,
-  analyzeImage
+  analyzeImage,
+  getImageJob,
+  subscribeImageJob
 } from "../controller/aiController.js";
 import { isAuthenticated } from "../middlewares/auth.js";
 import upload from "../middlewares/upload.js";
@@ -52,6 +54,10 @@ router.post("/image-analyze", (req, res, next) => {
   });
 });
 
+// Queued image analysis status, by polling or as server-sent events (owner only)
+router.get("/image-jobs/:id", isAuthenticated, getImageJob);
+router.get("/image-jobs/:id/events", isAuthenticated, subscribeImageJob);
+
 // Test RAG model endpoint
 router.post("/test", testRAGModel);
 
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Parallel offline builder for the diagnosis image embeddings
+Walks a labelled image folder per modality (<images_root>/<modality>/<diagnosis>/*.jpg),
+decodes and embeds the images in a pool of worker processes with batched
+DenseNet inference, averages the unit-length image embeddings of each
+diagnosis and writes the result as the modality's embedding store (and the
+legacy pickle) atomically. Progress is checkpointed, so an interrupted build
+resumes where it stopped. The store metadata records the embedder version the
+analyzers check against.
+
+    python scripts/build_image_embeddings.py --images_root reference_images --modalities xray ct
+"""
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+from multiprocessing import Pool
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from cpu_scheduler import available_cpus
+from embedding_store import DATA_ROOT, LEGACY_PICKLE, STORE_NAME, write_store
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+BACKEND_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+CHECKPOINT_ROOT = os.path.join(BACKEND_DIR, 'data', 'cache', 'embedding_build')
+
+# Set in each worker process by _init_worker
+_worker_embedder = None
+
+
+def list_labelled_images(modality_root: str) -> List[Tuple[str, str]]:
+    """(image path, diagnosis) for every image under <modality_root>/<diagnosis>/, sorted"""
+    items = []
+    for diagnosis in sorted(os.listdir(modality_root)):
+        diagnosis_dir = os.path.join(modality_root, diagnosis)
+        if not os.path.isdir(diagnosis_dir):
+            continue
+        for root, _, files in os.walk(diagnosis_dir):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    items.append((os.path.join(root, name), diagnosis))
+    return items
+
+
+def item_key(path: str) -> str:
+    """Identifies one version of an image file, so edited images are re-embedded on resume"""
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def embedder_version(identity_head: bool) -> str:
+    from image_embedder import projection_head_version
+    from image_inference import mode_from_env
+    head = 'densenet121+identity' if identity_head else projection_head_version()
+    return f"{head}/{mode_from_env()}"
+
+
+def _init_worker(identity_head: bool, threads: int):
+    global _worker_embedder
+    import torch
+    from cpu_scheduler import set_library_threads
+    from image_inference import embedder_from_env
+
+    set_library_threads(threads)
+    if identity_head:
+        from torchvision.models import densenet121
+        model = densenet121(weights='DenseNet121_Weights.DEFAULT')
+        model.classifier = torch.nn.Identity()
+        model.eval()
+    else:
+        from image_embedder import build_image_embedder
+        model, _ = build_image_embedder()
+    _worker_embedder, _ = embedder_from_env(model)
+
+
+def _embed_chunk(chunk: List[Tuple[str, str, str]]) -> Dict[str, Any]:
+    """Decode and embed one batch in a worker; returns unit-length rows and per-image errors"""
+    import torch
+    from image_preprocessing import preprocess_image
+
+    tensors, done, errors = [], [], []
+    for path, diagnosis, key in chunk:
+        try:
+            tensors.append(preprocess_image(path).tensor)
+            done.append((diagnosis, key))
+        except Exception as e:
+            errors.append((path, key, str(e)))
+    embeddings = np.zeros((0, 0), dtype=np.float32)
+    if tensors:
+        with torch.inference_mode():
+            embeddings = _worker_embedder(torch.stack(tensors)).float().numpy()
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms > 0, norms, 1)
+    return {'done': done, 'embeddings': embeddings, 'errors': errors}
+
+
+class BuildCheckpoint:
+    """Running per-diagnosis sums and the images already embedded, saved atomically"""
+
+    def __init__(self, path: str, version: str):
+        self.path = path
+        self.version = version
+        self.sums: Dict[str, np.ndarray] = {}
+        self.counts: Dict[str, int] = {}
+        self.done = set()
+        self.failed: Dict[str, str] = {}
+
+    @classmethod
+    def load(cls, path: str, version: str) -> "BuildCheckpoint":
+        checkpoint = cls(path, version)
+        state_path = os.path.join(path, 'state.json')
+        if not os.path.exists(state_path):
+            return checkpoint
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get('version') != version:
+            print(f"Checkpoint in {path} is for {state.get('version')}, not {version}; starting over",
+                  file=sys.stderr)
+            return checkpoint
+        sums = np.load(os.path.join(path, 'sums.npy'))
+        checkpoint.sums = {label: sums[i] for i, label in enumerate(state['labels'])}
+        checkpoint.counts = dict(zip(state['labels'], state['counts']))
+        checkpoint.done = set(state['done'])
+        checkpoint.failed = state.get('failed', {})
+        return checkpoint
+
+    def add(self, result: Dict[str, Any]):
+        for (diagnosis, key), embedding in zip(result['done'], result['embeddings']):
+            if diagnosis in self.sums:
+                self.sums[diagnosis] = self.sums[diagnosis] + embedding
+            else:
+                self.sums[diagnosis] = embedding.astype(np.float64)
+            self.counts[diagnosis] = self.counts.get(diagnosis, 0) + 1
+            self.done.add(key)
+        for path, key, error in result['errors']:
+            self.failed[key] = error
+            self.done.add(key)
+
+    def save(self):
+        labels = sorted(self.sums)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        if labels:
+            np.save(os.path.join(tmp_path, 'sums.npy'), np.stack([self.sums[label] for label in labels]))
+        else:
+            np.save(os.path.join(tmp_path, 'sums.npy'), np.zeros((0, 0)))
+        with open(os.path.join(tmp_path, 'state.json'), 'w') as f:
+            json.dump({'version': self.version, 'labels': labels, 'counts': [self.counts[label] for label in labels],
+                       'done': sorted(self.done), 'failed': self.failed}, f)
+        old_path = f"{self.path}.old-{os.getpid()}"
+        if os.path.exists(self.path):
+            os.rename(self.path, old_path)
+        os.rename(tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def write_pickle(modality_dir: str, labels: List[str], matrix: np.ndarray):
+    """The legacy {diagnosis: embedding} pickle, still read by the debug scripts"""
+    path = os.path.join(modality_dir, LEGACY_PICKLE)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({label: row for label, row in zip(labels, matrix)}, f)
+    os.replace(tmp_path, path)
+
+
+def build_modality(modality: str, images_root: str, data_root: str, workers: int, batch_size: int,
+                   threads_per_worker: int, identity_head: bool, checkpoint_every: int,
+                   resume: bool = True, write_legacy_pickle: bool = True) -> Dict[str, Any]:
+    """Embed every labelled image of a modality and write its diagnosis embedding store"""
+    version = embedder_version(identity_head)
+    items = list_labelled_images(os.path.join(images_root, modality))
+    if not items:
+        raise ValueError(f"No labelled images under {os.path.join(images_root, modality)}/<diagnosis>/")
+
+    checkpoint_path = os.path.join(CHECKPOINT_ROOT, modality)
+    checkpoint = BuildCheckpoint.load(checkpoint_path, version) if resume else BuildCheckpoint(checkpoint_path, version)
+    pending = []
+    for path, diagnosis in items:
+        key = item_key(path)
+        if key not in checkpoint.done:
+            pending.append((path, diagnosis, key))
+    print(f"{modality}: {len(items)} images, {len(items) - len(pending)} already embedded, "
+          f"{len(pending)} to go on {workers} workers", file=sys.stderr)
+
+    start = time.perf_counter()
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    if chunks:
+        with Pool(workers, initializer=_init_worker, initargs=(identity_head, threads_per_worker)) as pool:
+            for completed, result in enumerate(pool.imap_unordered(_embed_chunk, chunks), 1):
+                checkpoint.add(result)
+                for path, _, error in result['errors']:
+                    print(f"Skipping {path}: {error}", file=sys.stderr)
+                if completed % checkpoint_every == 0:
+                    checkpoint.save()
+                    print(f"{modality}: {completed}/{len(chunks)} batches", file=sys.stderr)
+        checkpoint.save()
+
+    labels = sorted(checkpoint.sums)
+    if not labels:
+        raise ValueError(f"No {modality} image could be embedded")
+    # Direction of the mean unit-length image embedding of each diagnosis
+    matrix = np.stack([checkpoint.sums[label] / checkpoint.counts[label] for label in labels]).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    modality_dir = os.path.join(data_root, modality)
+    os.makedirs(modality_dir, exist_ok=True)
+    meta = write_store(os.path.join(modality_dir, STORE_NAME), labels, matrix, embedder=version,
+                       source=os.path.abspath(os.path.join(images_root, modality)))
+    if write_legacy_pickle:
+        write_pickle(modality_dir, labels, matrix)
+    checkpoint.clear()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'diagnoses': meta['count'],
+        'images': sum(checkpoint.counts.values()),
+        'failed': len(checkpoint.failed),
+        'embedder': version,
+        'seconds': round(elapsed, 1),
+        'images_per_sec': round(len(pending) / elapsed, 2) if pending and elapsed > 0 else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the diagnosis image embeddings from labelled images')
+    parser.add_argument('--images_root', type=str, required=True,
+                        help='Directory with <modality>/<diagnosis>/ image folders')
+    parser.add_argument('--modalities', nargs='+', default=['ct', 'mri', 'xray'], help='Modalities to build')
+    parser.add_argument('--data_root', type=str, default=DATA_ROOT, help='Directory holding one folder per modality')
+    parser.add_argument('--workers', type=int, default=available_cpus(), help='Embedding processes (default: every core)')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='torch threads in each worker')
+    parser.add_argument('--batch_size', type=int, default=16, help='Images per DenseNet forward pass')
+    parser.add_argument('--checkpoint_every', type=int, default=20, help='Save progress every N batches')
+    parser.add_argument('--no_resume', action='store_true', help='Ignore any checkpoint and embed every image again')
+    parser.add_argument('--identity_head', action='store_true',
+                        help='Embed with the Identity classifier of image_analyzer.py instead of the projection head')
+    parser.add_argument('--no_pickle', action='store_true', help=f'Do not rewrite {LEGACY_PICKLE}')
+
+    args = parser.parse_args()
+
+    failed = False
+    for modality in args.modalities:
+        try:
+            summary = build_modality(modality, args.images_root, args.data_root, args.workers, args.batch_size,
+                                     args.threads_per_worker, args.identity_head, args.checkpoint_every,
+                                     resume=not args.no_resume, write_legacy_pickle=not args.no_pickle)
+            print(f"{modality}: {json.dumps(summary)}")
+        except Exception as e:
+            failed = True
+            print(f"{modality}: {e}", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+CPU thread budget shared by every model process on the node
+The budget is the cgroup CPU quota (or the CPU affinity set when there is no
+quota), overridable with CPU_THREAD_BUDGET. It is held as one token file per
+thread in CPU_SCHEDULER_DIR; a running inference job holds an flock on as
+many tokens as it has threads, so RAG processors and image analyzers in
+separate processes never run more threads than the node has cores. Token
+locks die with their process, so a crashed job never leaks its tokens.
+
+Jobs that do not fit wait in a FIFO ticket queue kept in state.json (read
+and written under a short flock on state.lock): only the oldest ticket may
+take tokens, so small jobs cannot starve large ones. Waiters sleep between
+checks without holding any lock, and tickets of processes that died are
+dropped. The state file also records the budget: the first live process
+sets it and later processes adopt it, so all agree on the number of tokens.
+"""
+
+import fcntl
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+DEFAULT_SCHEDULER_DIR = os.path.join(tempfile.gettempdir(), 'motion-clinic-cpu')
+# Thread-count variables read by OpenMP, MKL, OpenBLAS and numexpr when they initialize
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def cgroup_cpu_quota() -> Optional[float]:
+    """CPUs allowed by the cgroup quota (v2 cpu.max or v1 cfs files), or None when unlimited"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus() -> int:
+    """Cores this process may actually use: the affinity set, capped by the cgroup quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+
+def thread_budget() -> int:
+    """Threads shared by all inference jobs on the node: CPU_THREAD_BUDGET, else available_cpus()"""
+    configured = os.environ.get('CPU_THREAD_BUDGET')
+    return max(1, int(configured)) if configured else available_cpus()
+
+
+def set_library_threads(threads: int):
+    """Set the intra-op thread count of torch, FAISS/OpenMP and MKL/OpenBLAS for this process"""
+    for name in THREAD_ENV_VARS:
+        # Only affects libraries that have not initialized yet
+        os.environ[name] = str(threads)
+
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    try:
+        import faiss
+        faiss.omp_set_num_threads(threads)
+    except ImportError:
+        pass
+
+    try:
+        # Covers BLAS pools that were already started by numpy
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class CpuScheduler:
+    """Cross-process thread tokens; `job(threads)` blocks until that many are free"""
+
+    STATE_FILE = 'state.json'
+    STATE_LOCK = 'state.lock'
+    # Longest sleep between a waiter's checks of the queue
+    MAX_POLL_INTERVAL = 0.05
+
+    def __init__(self, budget: int, directory: str = DEFAULT_SCHEDULER_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.jobs = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+        with self._state() as state:
+            members = [pid for pid in state.get('members', []) if _process_alive(pid)]
+            if not members or 'budget' not in state:
+                state['budget'] = budget
+            if os.getpid() not in members:
+                members.append(os.getpid())
+            state['members'] = members
+            self.budget = state['budget']
+        if self.budget != budget:
+            print(f"CPU scheduler: using the node's shared budget of {self.budget} threads "
+                  f"(this process computed {budget})", file=sys.stderr)
+
+    @contextmanager
+    def _state(self):
+        """Read-modify-write of the shared state under its lock; the yielded dict is written back"""
+        state_path = os.path.join(self.directory, self.STATE_FILE)
+        lock_fd = os.open(os.path.join(self.directory, self.STATE_LOCK), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            yield state
+            tmp_path = f"{state_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, state_path)
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    def _try_acquire(self, count: int) -> Optional[List[int]]:
+        held = []
+        for slot in range(self.budget):
+            fd = os.open(os.path.join(self.directory, f"slot-{slot}"), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            held.append(fd)
+            if len(held) == count:
+                return held
+        self._release(held)
+        return None
+
+    @staticmethod
+    def _release(fds: List[int]):
+        for fd in fds:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _wait_for_tokens(self, count: int, poll_interval: float) -> List[int]:
+        pid = os.getpid()
+        with self._state() as state:
+            ticket = state.get('next_ticket', 0)
+            state['next_ticket'] = ticket + 1
+            state.setdefault('queue', []).append([ticket, pid, count])
+
+        held = None
+        delay = poll_interval
+        try:
+            while True:
+                with self._state() as state:
+                    queue = [entry for entry in state.get('queue', []) if _process_alive(entry[1])]
+                    if not any(entry[0] == ticket and entry[1] == pid for entry in queue):
+                        # The state file was reset under us; queue again
+                        queue.append([ticket, pid, count])
+                    state['queue'] = queue
+                    if queue[0][:2] == [ticket, pid]:
+                        held = self._try_acquire(count)
+                        if held is not None:
+                            queue.pop(0)
+                            return held
+                # Sleep without holding the state lock, so others can queue and the head can check
+                time.sleep(delay)
+                delay = min(delay * 2, self.MAX_POLL_INTERVAL)
+        except BaseException:
+            if held is not None:
+                self._release(held)
+            with self._state() as state:
+                state['queue'] = [entry for entry in state.get('queue', [])
+                                  if not (entry[0] == ticket and entry[1] == pid)]
+            raise
+
+    @contextmanager
+    def job(self, threads: int, poll_interval: float = 0.005):
+        """Hold `threads` tokens (at most the whole budget) for the duration of one inference job"""
+        count = max(1, min(threads, self.budget))
+        start = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        try:
+            held = self._wait_for_tokens(count, poll_interval)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        waited_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.running += 1
+            self.jobs += 1
+            self.wait_ms_total += waited_ms
+            self.wait_ms_max = max(self.wait_ms_max, waited_ms)
+        try:
+            yield count
+        finally:
+            self._release(held)
+            with self._lock:
+                self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._state() as state:
+            queued = len(state.get('queue', []))
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'running': self.running,
+                'waiting': self.waiting,
+                'node_queue': queued,
+                'jobs': self.jobs,
+                'wait_ms_mean': round(self.wait_ms_total / self.jobs, 2) if self.jobs else 0,
+                'wait_ms_max': round(self.wait_ms_max, 2)
+            }
+
+
+class _Unscheduled:
+    """Stand-in when CPU_SCHEDULER=0: jobs run immediately"""
+
+    budget = None
+
+    @contextmanager
+    def job(self, threads: int, poll_interval: float = 0.005):
+        yield threads
+
+    def stats(self) -> Dict[str, Any]:
+        return {'budget': None}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    """Process-wide scheduler configured by CPU_SCHEDULER, CPU_THREAD_BUDGET and CPU_SCHEDULER_DIR"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            if os.environ.get('CPU_SCHEDULER', '1') == '0':
+                _scheduler = _Unscheduled()
+            else:
+                try:
+                    _scheduler = CpuScheduler(thread_budget(),
+                                              os.environ.get('CPU_SCHEDULER_DIR', DEFAULT_SCHEDULER_DIR))
+                except OSError as e:
+                    print(f"CPU scheduler unavailable ({e}); running unscheduled", file=sys.stderr)
+                    _scheduler = _Unscheduled()
+        return _scheduler
+
+
+def scheduled(func: Callable, threads: int) -> Callable:
+    """Wrap `func` so each call runs as one scheduled job of `threads` threads"""
+    def run(*args, **kwargs):
+        with default_scheduler().job(threads):
+            return func(*args, **kwargs)
+    return run
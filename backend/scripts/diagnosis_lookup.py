@@ -0,0 +1,160 @@
+"""
+Precompiled diagnosis lookup for the image analyzers
+Maps a matched diagnosis label to a representative patient record without
+rescanning patient_data.json. Built once per modality and cached next to the
+source as diagnosis_lookup.json, which holds one representative row (the
+first occurrence) per distinct diagnosis and the SHA-256 of the source file.
+Lookups match the old DataFrame scans (exact, difflib, then partial) but run
+over the few hundred distinct diagnoses instead of every patient row, and
+resolved names are memoized, so repeat lookups are a dict hit.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from difflib import get_close_matches
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+FORMAT_VERSION = 1
+LOOKUP_FILE = "diagnosis_lookup.json"
+SOURCE_FILE = "patient_data.json"
+DATA_ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'medical_images'))
+
+
+def normalize_diagnosis(name: str) -> str:
+    """Lowercase a query label, treating '_' and '-' as spaces as the embedding labels use them"""
+    return str(name).lower().replace('_', ' ').replace('-', ' ')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiagnosisLookup:
+    """Representative patient record per distinct diagnosis, with fuzzy lookup"""
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.rows = rows
+        # Dataset diagnoses are only lowercased, as the analyzers have always compared them
+        self.keys = [str(row['diagnosis']).lower() for row in rows]
+        self.exact: Dict[str, int] = {}
+        for row_id, key in enumerate(self.keys):
+            self.exact.setdefault(key, row_id)
+        self.distinct = list(self.exact)
+
+        self._resolved: Dict[Tuple[str, float, bool, bool], Optional[int]] = {}
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "DiagnosisLookup":
+        """Keep the first record of each distinct (case-insensitive) diagnosis"""
+        df = df[df['diagnosis'].notna()]
+        representative = df[~df['diagnosis'].str.lower().duplicated()]
+        # to_json maps NaN to null and numpy scalars to plain JSON types
+        return cls(json.loads(representative.to_json(orient='records')))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _fuzzy(self, key: str, cutoff: float) -> Optional[int]:
+        """Best difflib match; ties go to the lexically greatest diagnosis, as they always have"""
+        matches = get_close_matches(key, self.distinct, n=1, cutoff=cutoff)
+        return self.exact[matches[0]] if matches else None
+
+    def _partial(self, key: str) -> Optional[int]:
+        """Earliest diagnosis containing, or contained in, the key, or sharing a word with it as a substring"""
+        words = key.split()
+        for row_id, other in enumerate(self.keys):
+            if (key in other or other in key
+                    or any(word in other for word in words)
+                    or any(word in key for word in other.split())):
+                return row_id
+        return None
+
+    def find(self, diagnosis_name: str, cutoff: float = 0.3, partial: bool = True,
+             normalize: bool = True) -> Optional[Dict[str, Any]]:
+        """Exact, then fuzzy (difflib ratio >= cutoff), then optional partial match.
+
+        With `normalize`, '_' and '-' in the label count as spaces; otherwise
+        it is only lowercased.
+        """
+        if not diagnosis_name:
+            return None
+        memo_key = (diagnosis_name, cutoff, partial, normalize)
+        if memo_key not in self._resolved:
+            key = normalize_diagnosis(diagnosis_name) if normalize else str(diagnosis_name).lower()
+            row_id = self.exact.get(key)
+            if row_id is None:
+                row_id = self._fuzzy(key, cutoff)
+            if row_id is None and partial:
+                row_id = self._partial(key)
+            self._resolved[memo_key] = row_id
+
+        row_id = self._resolved[memo_key]
+        return dict(self.rows[row_id]) if row_id is not None else None
+
+
+def build_lookup(modality_dir: str) -> DiagnosisLookup:
+    """Parse patient_data.json and write the compact lookup file next to it"""
+    source_path = os.path.join(modality_dir, SOURCE_FILE)
+    lookup = DiagnosisLookup.from_dataframe(pd.read_json(source_path))
+
+    payload = {
+        'format_version': FORMAT_VERSION,
+        'source_sha256': file_sha256(source_path),
+        'rows': lookup.rows
+    }
+    lookup_path = os.path.join(modality_dir, LOOKUP_FILE)
+    tmp_path = f"{lookup_path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(payload, f, separators=(',', ':'))
+        os.replace(tmp_path, lookup_path)
+    except OSError as e:
+        # A read-only data directory still gets a working in-memory lookup
+        print(f"Warning: could not write {lookup_path}: {e}", file=sys.stderr)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return lookup
+
+
+def load_lookup(modality_dir: str) -> DiagnosisLookup:
+    """Load the cached lookup, rebuilding it when patient_data.json has changed"""
+    lookup_path = os.path.join(modality_dir, LOOKUP_FILE)
+    source_path = os.path.join(modality_dir, SOURCE_FILE)
+    try:
+        with open(lookup_path) as f:
+            payload = json.load(f)
+        if (payload.get('format_version') == FORMAT_VERSION
+                and payload.get('source_sha256') == file_sha256(source_path)):
+            return DiagnosisLookup(payload['rows'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_lookup(modality_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the per-modality diagnosis lookup files')
+    parser.add_argument('--modalities', nargs='+', default=['ct', 'mri', 'xray'], help='Modalities to build')
+    parser.add_argument('--data_root', type=str, default=DATA_ROOT, help='Directory holding one folder per modality')
+
+    args = parser.parse_args()
+
+    for modality in args.modalities:
+        modality_dir = os.path.join(args.data_root, modality)
+        try:
+            lookup = build_lookup(modality_dir)
+            print(f"{modality}: {len(lookup)} diagnoses in {os.path.join(modality_dir, LOOKUP_FILE)}")
+        except Exception as e:
+            print(f"{modality}: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Diagnosis embedding matrix for the image analyzers
+Holds every diagnosis embedding as one row-normalized matrix with a parallel
+label array, so matching a query image is a single matrix-vector product
+"""
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class DiagnosisMatrix:
+    """Row-normalized diagnosis embeddings with their labels"""
+
+    def __init__(self, labels: np.ndarray, matrix: np.ndarray):
+        if len(labels) != matrix.shape[0]:
+            raise ValueError(f"{len(labels)} labels for {matrix.shape[0]} embedding rows")
+        self.labels = labels
+        self.matrix = matrix
+
+    @classmethod
+    def from_dict(cls, diagnosis_embeddings: Dict[str, np.ndarray]) -> "DiagnosisMatrix":
+        """Build from a {diagnosis: embedding} dict; zero vectors are dropped"""
+        labels = list(diagnosis_embeddings)
+        if not labels:
+            return cls(np.array([], dtype=object), np.zeros((0, 0), dtype=np.float32))
+
+        matrix = np.stack([np.asarray(diagnosis_embeddings[label], dtype=np.float32).ravel()
+                           for label in labels])
+        norms = np.linalg.norm(matrix, axis=1)
+        keep = norms > 0
+        matrix = matrix[keep] / norms[keep, None]
+        return cls(np.array(labels, dtype=object)[keep], np.ascontiguousarray(matrix))
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.matrix.nbytes)
+
+    def similarities(self, query_emb: np.ndarray) -> np.ndarray:
+        """Cosine similarity of the query against every diagnosis"""
+        query = np.asarray(query_emb, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        return self.matrix @ query
+
+    def top_k(self, query_emb: np.ndarray, k: int = 1) -> List[Tuple[str, float]]:
+        """The k most similar diagnoses as (label, cosine similarity), best first"""
+        if len(self) == 0:
+            return []
+        return self._rank(self.similarities(query_emb), k)
+
+    def top_k_batch(self, query_embs: np.ndarray, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """top_k for every row of a (n, dim) query matrix with one matrix product"""
+        queries = np.asarray(query_embs, dtype=np.float32)
+        if len(self) == 0:
+            return [[] for _ in range(len(queries))]
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1)
+        scores = queries @ self.matrix.T
+        return [self._rank(row, k) for row in scores]
+
+    def _rank(self, scores: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        k = min(k, len(scores))
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(str(self.labels[i]), float(scores[i])) for i in order]
@@ -0,0 +1,152 @@
+"""
+Size-bounded persistent key/value cache on SQLite
+Shared by the analyzer caches. Values are opaque bytes; each entry records
+its size and last access time, and the least recently used entries are
+evicted whenever the total exceeds `max_bytes`. The total is kept in a
+one-row `<table>_meta` table updated in the same transaction as each write,
+so puts and evictions never scan the whole cache. Safe to use from several
+threads, and from several processes sharing the same file.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import low_memory
+
+# SQLite page cache per connection in low-memory mode, in KiB (SQLite's default is 2000)
+LOW_MEMORY_PAGE_CACHE_KB = 256
+# Least recently used entries fetched per eviction query
+EVICT_BATCH = 64
+
+
+class DiskCache:
+    """LRU byte cache stored in one SQLite file"""
+
+    def __init__(self, path: str, max_bytes: int, table: str = "entries"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # DataLoader workers receive a copy and open their own connection
+        state = self.__dict__.copy()
+        state.update(_lock=None, _conn=None, _pid=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if low_memory.enabled():
+                conn.execute(f"PRAGMA cache_size=-{LOW_MEMORY_PAGE_CACHE_KB}")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                         "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                         "last_used REAL NOT NULL)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table}(last_used)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table}_meta ("
+                         "id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER NOT NULL)")
+            with self._transaction(conn):
+                # Files written before the running total existed are summed once
+                conn.execute(f"INSERT OR IGNORE INTO {self.table}_meta (id, total_bytes) "
+                             f"SELECT 0, COALESCE(SUM(size), 0) FROM {self.table}")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn: sqlite3.Connection):
+        # IMMEDIATE takes the write lock up front, so concurrent processes serialize their updates
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _add_total(self, conn: sqlite3.Connection, delta: int) -> int:
+        conn.execute(f"UPDATE {self.table}_meta SET total_bytes = total_bytes + ? WHERE id = 0", (delta,))
+        return conn.execute(f"SELECT total_bytes FROM {self.table}_meta WHERE id = 0").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            conn = self._connection()
+            with self._transaction(conn):
+                row = conn.execute(f"SELECT size FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                             (key, sqlite3.Binary(value), len(value), time.time()))
+                total = self._add_total(conn, len(value) - (row[0] if row else 0))
+                if total > self.max_bytes:
+                    self._evict(conn, total - self.max_bytes)
+
+    def _evict(self, conn: sqlite3.Connection, excess: int):
+        # Drop the least recently used entries, a batch at a time, until the cache is back under budget
+        freed = 0
+        while freed < excess:
+            batch = conn.execute(f"SELECT key, size FROM {self.table} ORDER BY last_used LIMIT ?",
+                                 (EVICT_BATCH,)).fetchall()
+            if not batch:
+                break
+            victims = []
+            for key, size in batch:
+                if freed >= excess:
+                    break
+                victims.append(key)
+                freed += size
+            conn.execute(f"DELETE FROM {self.table} WHERE key IN ({','.join('?' * len(victims))})", victims)
+            self.evictions += len(victims)
+        self._add_total(conn, -freed)
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            with self._transaction(conn):
+                conn.execute(f"DELETE FROM {self.table}")
+                conn.execute(f"UPDATE {self.table}_meta SET total_bytes = 0 WHERE id = 0")
+
+    def memory_bytes(self) -> int:
+        """Upper bound of the memory this process's SQLite page cache holds for the file"""
+        with self._lock:
+            if self._conn is None or self._pid != os.getpid():
+                return 0
+            cache_size = self._conn.execute("PRAGMA cache_size").fetchone()[0]
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        # Negative cache_size is in KiB, positive is a page count
+        return -cache_size * 1024 if cache_size < 0 else cache_size * page_size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            conn = self._connection()
+            (entries,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+            (total,) = conn.execute(f"SELECT total_bytes FROM {self.table}_meta WHERE id = 0").fetchone()
+        return {'entries': entries, 'bytes': total, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
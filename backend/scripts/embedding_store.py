@@ -0,0 +1,219 @@
+"""
+On-disk store for diagnosis image embeddings
+Replaces the pickled {diagnosis: ndarray} dicts with a directory that can be
+memory-mapped and shared read-only between analyzer processes:
+
+    diagnosis_embeddings/
+        embeddings.npy   float32 matrix, one row per diagnosis (C order)
+        labels.json      JSON list of diagnosis names, row order
+        meta.json        format_version, embedder, dim, count, dtype, normalized, source
+
+Rows are unit length when `normalized` is true. `diagnosis_embeddings` is a
+symlink to a versioned sibling directory; a new version is written in full
+and the link is swapped atomically, so readers see either the old or the new
+store, never a partial or missing one. Stores are build artifacts and not
+tracked by git; run this file to migrate the tracked pickles (the deploy
+build does), and until then loaders read the pickles directly.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from diagnosis_matrix import DiagnosisMatrix
+
+FORMAT_VERSION = 1
+STORE_NAME = "diagnosis_embeddings"
+LEGACY_PICKLE = "diagnosis_image_embeddings.pkl"
+MATRIX_FILE = "embeddings.npy"
+LABELS_FILE = "labels.json"
+META_FILE = "meta.json"
+DEFAULT_EMBEDDER = "densenet121"
+DATA_ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'medical_images'))
+
+
+def write_store(store_dir: str, labels: List[str], matrix: np.ndarray, embedder: str = DEFAULT_EMBEDDER,
+                source: Optional[str] = None) -> Dict[str, Any]:
+    """Normalize the rows and publish them as a new version of `store_dir` (see replace_store); returns the metadata"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(labels):
+        raise ValueError(f"Expected a ({len(labels)}, dim) matrix, got {matrix.shape}")
+    if len(set(labels)) != len(labels):
+        raise ValueError("Diagnosis labels must be unique")
+
+    norms = np.linalg.norm(matrix, axis=1)
+    if np.any(norms == 0):
+        zero = [labels[i] for i in np.flatnonzero(norms == 0)]
+        raise ValueError(f"Zero-norm embeddings for: {zero}")
+    matrix = np.ascontiguousarray(matrix / norms[:, None])
+
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'embedder': embedder,
+        'dim': int(matrix.shape[1]),
+        'count': int(matrix.shape[0]),
+        'dtype': 'float32',
+        'normalized': True,
+        'source': source,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
+
+    def write(version_dir: str):
+        np.save(os.path.join(version_dir, MATRIX_FILE), matrix)
+        with open(os.path.join(version_dir, LABELS_FILE), 'w') as f:
+            json.dump(list(labels), f, indent=1)
+        with open(os.path.join(version_dir, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    replace_store(store_dir, write)
+    return meta
+
+
+def replace_store(store_dir: str, write: Callable[[str], Any]) -> Any:
+    """Publish a new version of a store directory; returns what `write` returns.
+
+    `write(version_dir)` fills a fresh `<store_dir>.v<ns>` directory, then
+    `store_dir` (a relative symlink) is pointed at it with os.replace. The
+    previous version is kept for readers that resolved it before the swap;
+    older ones are removed. A plain directory written by an earlier release
+    is first adopted as a version, which is the only moment the store is
+    briefly absent.
+    """
+    store_dir = os.path.abspath(store_dir)
+    parent, name = os.path.split(store_dir)
+    version_name = f"{name}.v{time.time_ns()}-{os.getpid()}"
+    version_dir = os.path.join(parent, version_name)
+    os.makedirs(version_dir)
+    try:
+        result = write(version_dir)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    previous = None
+    if os.path.islink(store_dir):
+        previous = os.readlink(store_dir)
+    elif os.path.isdir(store_dir):
+        previous = f"{name}.v0"
+        os.rename(store_dir, os.path.join(parent, previous))
+
+    link_tmp = os.path.join(parent, f"{name}.link-{os.getpid()}")
+    if os.path.lexists(link_tmp):
+        os.unlink(link_tmp)
+    os.symlink(version_name, link_tmp)
+    os.replace(link_tmp, store_dir)
+
+    for entry in os.listdir(parent):
+        if entry.startswith(f"{name}.v") and entry not in (version_name, previous):
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+    return result
+
+
+def read_version(store_dir: str, read: Callable[[str], Any], attempts: int = 3) -> Any:
+    """Call `read(version_dir)` on the version `store_dir` links to.
+
+    Every file then comes from one version. If that version is pruned by
+    later writes while it is being read, the read starts again on the
+    current one.
+    """
+    for attempt in range(attempts):
+        try:
+            return read(os.path.realpath(store_dir))
+        except FileNotFoundError:
+            if attempt == attempts - 1:
+                raise
+
+
+def read_meta(store_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(store_dir, META_FILE)) as f:
+        return json.load(f)
+
+
+def load_store(store_dir: str, mmap: bool = True) -> DiagnosisMatrix:
+    """Open a store; with `mmap` the matrix is a read-only memory map"""
+    return read_version(store_dir, lambda version_dir: _load_version(version_dir, mmap))
+
+
+def _load_version(store_dir: str, mmap: bool) -> DiagnosisMatrix:
+    meta = read_meta(store_dir)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported embedding store version {meta.get('format_version')} in {store_dir}")
+
+    with open(os.path.join(store_dir, LABELS_FILE)) as f:
+        labels = json.load(f)
+    matrix = np.load(os.path.join(store_dir, MATRIX_FILE), mmap_mode='r' if mmap else None)
+
+    if matrix.shape != (meta['count'], meta['dim']) or len(labels) != meta['count']:
+        raise ValueError(f"Embedding store {store_dir} does not match its metadata")
+    if not meta.get('normalized'):
+        # Older or hand-written stores: normalize into memory rather than trusting the rows
+        return DiagnosisMatrix.from_dict(dict(zip(labels, np.asarray(matrix))))
+
+    return DiagnosisMatrix(np.array(labels, dtype=object), matrix)
+
+
+def load_diagnosis_matrix(modality_dir: str, mmap: bool = True) -> DiagnosisMatrix:
+    """Load a modality's embeddings, preferring the store over the legacy pickle"""
+    store_dir = os.path.join(modality_dir, STORE_NAME)
+    if os.path.exists(os.path.join(store_dir, META_FILE)):
+        return load_store(store_dir, mmap=mmap)
+
+    pickle_path = os.path.join(modality_dir, LEGACY_PICKLE)
+    print(f"Warning: no embedding store in {modality_dir}, reading {LEGACY_PICKLE}; "
+          f"run scripts/embedding_store.py to migrate", file=sys.stderr)
+    with open(pickle_path, "rb") as f:
+        return DiagnosisMatrix.from_dict(pickle.load(f))
+
+
+def migrate_pickle(modality_dir: str, embedder: str = DEFAULT_EMBEDDER) -> Dict[str, Any]:
+    """Convert a modality's legacy pickle into a store next to it"""
+    pickle_path = os.path.join(modality_dir, LEGACY_PICKLE)
+    with open(pickle_path, "rb") as f:
+        embeddings = pickle.load(f)
+
+    labels, rows = [], []
+    for diag, emb in embeddings.items():
+        emb = np.asarray(emb, dtype=np.float32).ravel()
+        if np.linalg.norm(emb) == 0:
+            print(f"Warning: zero norm for {diag}, skipping.", file=sys.stderr)
+            continue
+        labels.append(str(diag))
+        rows.append(emb)
+
+    return write_store(os.path.join(modality_dir, STORE_NAME), labels, np.stack(rows),
+                       embedder=embedder, source=LEGACY_PICKLE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate or inspect diagnosis embedding stores')
+    parser.add_argument('--mode', choices=['migrate', 'inspect'], default='migrate',
+                        help='migrate (pickle to store) or inspect (print store metadata)')
+    parser.add_argument('--modalities', nargs='+', default=['ct', 'mri', 'xray'], help='Modalities to process')
+    parser.add_argument('--data_root', type=str, default=DATA_ROOT, help='Directory holding one folder per modality')
+    parser.add_argument('--embedder', type=str, default=DEFAULT_EMBEDDER,
+                        help='Embedder name recorded in the metadata')
+
+    args = parser.parse_args()
+
+    for modality in args.modalities:
+        modality_dir = os.path.join(args.data_root, modality)
+        try:
+            if args.mode == 'migrate':
+                meta = migrate_pickle(modality_dir, args.embedder)
+                print(f"{modality}: wrote {meta['count']} x {meta['dim']} embeddings to "
+                      f"{os.path.join(modality_dir, STORE_NAME)}")
+            else:
+                print(f"{modality}: {json.dumps(read_meta(os.path.join(modality_dir, STORE_NAME)))}")
+        except Exception as e:
+            print(f"{modality}: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""
+Multi-exemplar FAISS image index with weighted k-NN voting
+The diagnosis store holds one embedding per diagnosis. This index holds any
+number of reference-image embeddings (exemplars) per diagnosis, one FAISS
+index per modality:
+
+    diagnosis_exemplars/
+        index.faiss      FAISS index over the exemplar rows (inner product)
+        embeddings.npy   unit-length float32 exemplars, kept to rebuild or extend the index
+        labels.json      diagnosis of each exemplar row
+        meta.json        format_version, index_type, dim, count, diagnoses, embedder, created_at
+
+Like the diagnosis store, `diagnosis_exemplars` is a symlink swapped to each
+new complete version (see embedding_store.replace_store).
+
+A query retrieves its k nearest exemplars, and each exemplar votes for its
+diagnosis with a softmax weight of its similarity. Diagnoses are ranked by
+vote share. The analyzers use it when IMAGE_RETRIEVAL=exemplar, through the
+same top_k / top_k_batch interface as DiagnosisMatrix.
+
+Index types (--index_type or EXEMPLAR_INDEX_TYPE): flat (exact), hnsw
+(graph, sublinear and no training), ivf (clustered; trained, so used from
+1000 exemplars up), or any FAISS index_factory string.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from diagnosis_matrix import DiagnosisMatrix
+from embedding_store import (DATA_ROOT, DEFAULT_EMBEDDER, META_FILE as STORE_META_FILE, STORE_NAME,
+                             load_diagnosis_matrix, read_meta, read_version, replace_store)
+
+FORMAT_VERSION = 1
+EXEMPLAR_STORE = "diagnosis_exemplars"
+INDEX_FILE = "index.faiss"
+EMBEDDINGS_FILE = "embeddings.npy"
+LABELS_FILE = "labels.json"
+META_FILE = "meta.json"
+# Embedder of image_analyzer.py: DenseNet121 features with the classifier replaced by Identity
+IDENTITY_EMBEDDER = "densenet121+identity"
+INDEX_TYPES = ['flat', 'hnsw', 'ivf']
+DEFAULT_INDEX_TYPE = 'flat'
+# IVF needs enough exemplars per cluster to train; below this, flat is exact and as fast
+MIN_IVF_EXEMPLARS = 1000
+
+
+def factory_string(index_type: str, count: int) -> str:
+    """FAISS index_factory description for an index type and exemplar count"""
+    if index_type == 'flat':
+        return "Flat"
+    if index_type == 'hnsw':
+        return "HNSW32,Flat"
+    if index_type == 'ivf':
+        # ~4 sqrt(n) clusters, with the 39 training points per centroid FAISS asks for
+        return f"IVF{max(1, min(int(4 * math.sqrt(count)), count // 39))},Flat"
+    return index_type
+
+
+def build_faiss_index(embeddings: np.ndarray, index_type: str = DEFAULT_INDEX_TYPE) -> Tuple[faiss.Index, str]:
+    """Inner-product index over unit-length rows; returns (index, factory string used)"""
+    if index_type == 'ivf' and len(embeddings) < MIN_IVF_EXEMPLARS:
+        print(f"Only {len(embeddings)} exemplars; using a flat index instead of IVF", file=sys.stderr)
+        index_type = 'flat'
+    description = factory_string(index_type, len(embeddings))
+    index = faiss.index_factory(embeddings.shape[1], description, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return index, description
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        embeddings = embeddings[None, :]
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return np.ascontiguousarray(embeddings / np.where(norms > 0, norms, 1))
+
+
+class ExemplarIndex:
+    """Exemplar embeddings of many images per diagnosis, searched with FAISS and ranked by vote"""
+
+    def __init__(self, exemplar_labels: np.ndarray, index: faiss.Index, meta: Optional[Dict[str, Any]] = None,
+                 neighbors: int = 10, temperature: float = 0.05):
+        if len(exemplar_labels) != index.ntotal:
+            raise ValueError(f"{len(exemplar_labels)} labels for {index.ntotal} indexed exemplars")
+        self.exemplar_labels = exemplar_labels
+        self.index = index
+        self.meta = meta or {}
+        self.neighbors = neighbors
+        self.temperature = temperature
+        # Unique diagnoses, like DiagnosisMatrix.labels
+        self.labels = np.array(sorted(set(exemplar_labels.tolist())), dtype=object)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def count(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def dim(self) -> int:
+        return self.index.d
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.meta.get('index_bytes', 0))
+
+    def configure_search(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Recall/speed knobs for IVF (nprobe) and HNSW (efSearch) indexes"""
+        params = faiss.ParameterSpace()
+        if nprobe and 'IVF' in self.meta.get('factory', ''):
+            params.set_index_parameter(self.index, 'nprobe', nprobe)
+        if ef_search and 'HNSW' in self.meta.get('factory', ''):
+            params.set_index_parameter(self.index, 'efSearch', ef_search)
+
+    def vote_batch(self, query_embs: np.ndarray, k: int = 3) -> List[List[Dict[str, Any]]]:
+        """Per query, the k best diagnoses with vote share, best exemplar similarity and supporting exemplars"""
+        queries = normalize(query_embs)
+        if self.count == 0:
+            return [[] for _ in range(len(queries))]
+        scores, rows = self.index.search(queries, min(self.neighbors, self.count))
+
+        results = []
+        for row_scores, row_ids in zip(scores, rows):
+            valid = row_ids >= 0
+            row_scores, row_ids = row_scores[valid], row_ids[valid]
+            if len(row_ids) == 0:
+                results.append([])
+                continue
+            # Softmax over the neighbours' similarities; a low temperature favours the closest exemplars
+            weights = np.exp((row_scores - row_scores.max()) / self.temperature)
+            weights /= weights.sum()
+
+            tally: Dict[str, Dict[str, Any]] = {}
+            for score, row, weight in zip(row_scores, row_ids, weights):
+                label = str(self.exemplar_labels[row])
+                entry = tally.setdefault(label, {'diagnosis': label, 'votes': 0.0, 'similarity': float(score),
+                                                 'exemplars': 0})
+                entry['votes'] += float(weight)
+                entry['similarity'] = max(entry['similarity'], float(score))
+                entry['exemplars'] += 1
+            ranked = sorted(tally.values(), key=lambda entry: (-entry['votes'], -entry['similarity']))
+            for entry in ranked:
+                entry['votes'] = round(entry['votes'], 4)
+            results.append(ranked[:k])
+        return results
+
+    def top_k(self, query_emb: np.ndarray, k: int = 1) -> List[Tuple[str, float]]:
+        """The k diagnoses with the most votes, as (label, best exemplar similarity), best first"""
+        return self.top_k_batch(query_emb, k)[0]
+
+    def top_k_batch(self, query_embs: np.ndarray, k: int = 1) -> List[List[Tuple[str, float]]]:
+        return [[(entry['diagnosis'], entry['similarity']) for entry in ranked]
+                for ranked in self.vote_batch(query_embs, k)]
+
+
+def write_exemplars(store_dir: str, labels: List[str], embeddings: np.ndarray,
+                    index_type: str = DEFAULT_INDEX_TYPE, embedder: str = DEFAULT_EMBEDDER) -> Dict[str, Any]:
+    """Build the index and publish it as a new version of `store_dir` (see replace_store); returns the metadata"""
+    embeddings = normalize(embeddings)
+    if embeddings.shape[0] != len(labels):
+        raise ValueError(f"Expected {len(labels)} exemplar rows, got {embeddings.shape[0]}")
+    index, description = build_faiss_index(embeddings, index_type)
+
+    def write(version_dir: str) -> Dict[str, Any]:
+        faiss.write_index(index, os.path.join(version_dir, INDEX_FILE))
+        np.save(os.path.join(version_dir, EMBEDDINGS_FILE), embeddings)
+        with open(os.path.join(version_dir, LABELS_FILE), 'w') as f:
+            json.dump(list(labels), f, indent=1)
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'index_type': index_type,
+            'factory': description,
+            'embedder': embedder,
+            'dim': int(embeddings.shape[1]),
+            'count': int(embeddings.shape[0]),
+            'diagnoses': len(set(labels)),
+            'index_bytes': os.path.getsize(os.path.join(version_dir, INDEX_FILE)),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        with open(os.path.join(version_dir, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+    return replace_store(store_dir, write)
+
+
+def read_exemplars(store_dir: str) -> Tuple[List[str], np.ndarray]:
+    """The stored (labels, unit-length embeddings), for extending or re-indexing"""
+    def read(version_dir: str) -> Tuple[List[str], np.ndarray]:
+        with open(os.path.join(version_dir, LABELS_FILE)) as f:
+            labels = json.load(f)
+        return labels, np.load(os.path.join(version_dir, EMBEDDINGS_FILE))
+    return read_version(store_dir, read)
+
+
+def load_exemplar_index(store_dir: str) -> ExemplarIndex:
+    """Open an exemplar store with the search settings from the environment"""
+    return read_version(store_dir, _load_exemplar_version)
+
+
+def _load_exemplar_version(store_dir: str) -> ExemplarIndex:
+    with open(os.path.join(store_dir, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported exemplar store version {meta.get('format_version')} in {store_dir}")
+    with open(os.path.join(store_dir, LABELS_FILE)) as f:
+        labels = json.load(f)
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        # faiss reports a missing file as RuntimeError; read_version retries on this
+        raise FileNotFoundError(index_path)
+
+    exemplars = ExemplarIndex(np.array(labels, dtype=object), faiss.read_index(index_path),
+                              meta, neighbors=int(os.environ.get('EXEMPLAR_NEIGHBORS', 10)),
+                              temperature=float(os.environ.get('EXEMPLAR_VOTE_TEMPERATURE', 0.05)))
+    exemplars.configure_search(nprobe=int(os.environ.get('EXEMPLAR_NPROBE', 16)),
+                               ef_search=int(os.environ.get('EXEMPLAR_EF_SEARCH', 64)))
+    return exemplars
+
+
+def retrieval_mode() -> str:
+    """IMAGE_RETRIEVAL: 'diagnosis' (one embedding per diagnosis, default) or 'exemplar'"""
+    return os.environ.get('IMAGE_RETRIEVAL', 'diagnosis')
+
+
+def embedding_space(embedder: str) -> str:
+    """The part of an embedder version that fixes the vector space: architecture and head, not the run mode"""
+    space = str(embedder).split('/')[0]
+    # Stores migrated from the legacy pickles record only the architecture; those were built without a head
+    return IDENTITY_EMBEDDER if space == DEFAULT_EMBEDDER else space
+
+
+def load_retrieval_index(modality_dir: str, embedder: Optional[str] = None):
+    """The exemplar index in exemplar mode when one is built, else the diagnosis matrix.
+
+    `embedder` is the querying analyzer's embedder version; an exemplar index
+    built in a different embedding space is not used, since its neighbours
+    would be meaningless.
+    """
+    if retrieval_mode() == 'exemplar':
+        store_dir = os.path.join(modality_dir, EXEMPLAR_STORE)
+        if os.path.exists(os.path.join(store_dir, META_FILE)):
+            exemplars = load_exemplar_index(store_dir)
+            built_with = exemplars.meta.get('embedder', DEFAULT_EMBEDDER)
+            if embedder is None or embedding_space(built_with) == embedding_space(embedder):
+                return exemplars
+            print(f"Warning: {EXEMPLAR_STORE} in {modality_dir} was built with {built_with} but queries use "
+                  f"{embedder}; using the diagnosis embeddings", file=sys.stderr)
+        else:
+            print(f"Warning: IMAGE_RETRIEVAL=exemplar but no {EXEMPLAR_STORE} in {modality_dir}; "
+                  f"using the diagnosis embeddings", file=sys.stderr)
+    return load_diagnosis_matrix(modality_dir)
+
+
+def embed_reference_images(manifest: str, batch_size: int = 16,
+                           identity_head: bool = False) -> Tuple[List[str], np.ndarray, str]:
+    """Embed the {image_path, diagnosis} JSON lines of a manifest with an analyzer's embedder.
+
+    The lightweight analyzer's projection-head embedder by default, or the
+    full analyzer's Identity classifier with `identity_head`. Returns
+    (labels, embeddings, embedder version).
+    """
+    import torch
+    from image_embedder import build_image_embedder
+    from image_inference import embedder_from_env, mode_from_env
+    from image_preprocessing import preprocess_image
+
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    if identity_head:
+        from torchvision.models import densenet121
+        model, version = densenet121(weights='DenseNet121_Weights.DEFAULT'), IDENTITY_EMBEDDER
+        model.classifier = torch.nn.Identity()
+        model.eval()
+    else:
+        model, version = build_image_embedder()
+    run_embedder, _ = embedder_from_env(model)
+    labels, rows = [], []
+    for start in range(0, len(entries), batch_size):
+        batch, batch_labels = [], []
+        for entry in entries[start:start + batch_size]:
+            path = entry['image_path']
+            try:
+                batch.append(preprocess_image(os.path.join(base_dir, path)).tensor)
+                batch_labels.append(str(entry['diagnosis']))
+            except Exception as e:
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+        if batch:
+            rows.append(run_embedder(torch.stack(batch)).float().numpy())
+            labels.extend(batch_labels)
+        print(f"Embedded {min(start + batch_size, len(entries))}/{len(entries)} reference images", file=sys.stderr)
+    if not rows:
+        raise ValueError(f"No reference images could be embedded from {manifest}")
+    return labels, np.vstack(rows), f"{version}/{mode_from_env()}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, extend or inspect the multi-exemplar image index')
+    parser.add_argument('--mode', choices=['build', 'add', 'reindex', 'inspect'], default='build',
+                        help='build (diagnosis embeddings plus --images), add (append --images), '
+                             'reindex (rebuild with --index_type) or inspect')
+    parser.add_argument('--modality', choices=['ct', 'xray', 'mri'], required=True)
+    parser.add_argument('--images', type=str, help='JSON-lines manifest of {"image_path", "diagnosis"} reference images')
+    parser.add_argument('--index_type', type=str, default=os.environ.get('EXEMPLAR_INDEX_TYPE', DEFAULT_INDEX_TYPE),
+                        help=f"One of {INDEX_TYPES} or a FAISS index_factory string")
+    parser.add_argument('--batch_size', type=int, default=16, help='Images per embedding forward pass')
+    parser.add_argument('--identity_head', action='store_true',
+                        help="Embed --images with image_analyzer.py's Identity classifier instead of the projection head")
+    parser.add_argument('--data_root', type=str, default=DATA_ROOT, help='Directory holding one folder per modality')
+
+    args = parser.parse_args()
+    modality_dir = os.path.join(args.data_root, args.modality)
+    store_dir = os.path.join(modality_dir, EXEMPLAR_STORE)
+
+    if args.mode == 'inspect':
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            print(json.dumps(json.load(f), indent=2))
+        return
+
+    if args.mode == 'build':
+        # Seed with the existing one-per-diagnosis embeddings so every diagnosis stays reachable
+        diagnosis_matrix: DiagnosisMatrix = load_diagnosis_matrix(modality_dir, mmap=False)
+        labels, embeddings = [str(label) for label in diagnosis_matrix.labels], np.asarray(diagnosis_matrix.matrix)
+        embedder = read_meta(os.path.join(modality_dir, STORE_NAME)).get('embedder', DEFAULT_EMBEDDER) \
+            if os.path.exists(os.path.join(modality_dir, STORE_NAME, STORE_META_FILE)) else DEFAULT_EMBEDDER
+        print(f"Seeded with {len(labels)} diagnosis embeddings from {STORE_NAME} ({embedder})", file=sys.stderr)
+    else:
+        labels, embeddings = read_exemplars(store_dir)
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            embedder = json.load(f).get('embedder', DEFAULT_EMBEDDER)
+
+    if args.images and args.mode in ('build', 'add'):
+        new_labels, new_embeddings, images_embedder = embed_reference_images(args.images, args.batch_size,
+                                                                             args.identity_head)
+        # One index must hold vectors from one embedding space
+        if embedding_space(images_embedder) != embedding_space(embedder):
+            print(f"Error: the existing embeddings were built with {embedder} but --images were embedded with "
+                  f"{images_embedder}; rebuild {STORE_NAME} with build_image_embeddings.py "
+                  f"(or toggle --identity_head) so they match", file=sys.stderr)
+            sys.exit(1)
+        labels, embeddings = labels + new_labels, np.vstack([embeddings, normalize(new_embeddings)])
+        embedder = images_embedder
+    elif args.mode == 'add':
+        parser.error("--images is required in add mode")
+
+    meta = write_exemplars(store_dir, labels, embeddings, args.index_type, embedder=embedder)
+    print(f"{args.modality}: indexed {meta['count']} exemplars of {meta['diagnoses']} diagnoses "
+          f"({meta['factory']}) in {store_dir}")
+
+
+if __name__ == "__main__":
+    main()
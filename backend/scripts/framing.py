@@ -0,0 +1,223 @@
+"""
+Length-prefixed wire protocol for the model serve modes over a Unix socket
+
+Every request and response is one frame:
+
+    uint32  body length (bytes after this field)
+    uint64  request id (chosen by the client, echoed on the response)
+    uint32  metadata length
+    bytes   metadata, compact UTF-8 JSON object
+    bytes   binary payload (rest of the body; may be empty)
+
+All integers are big-endian. Responses are written as soon as they are
+ready, so a client may pipeline many requests on one connection and match
+replies by id. Diagnostics never share this channel; they go to stderr.
+
+A client on the same host may instead leave a large payload in a POSIX
+shared-memory segment and send its name (and size) in the metadata; the
+client creates and unlinks the segment, the server only reads it.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Optional, Tuple
+
+LENGTH = struct.Struct('>I')
+HEADER = struct.Struct('>QI')
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class FrameError(Exception):
+    """Raised on a malformed or oversized frame"""
+
+
+def encode_frame(request_id: int, message: Dict[str, Any], payload: bytes = b'') -> bytes:
+    """Serialize one frame"""
+    metadata = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    body_length = HEADER.size + len(metadata) + len(payload)
+    if body_length > MAX_FRAME_BYTES:
+        raise FrameError(f"Frame of {body_length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+    return LENGTH.pack(body_length) + HEADER.pack(request_id, len(metadata)) + metadata + payload
+
+
+def decode_body(body: bytes) -> Tuple[int, Dict[str, Any], bytes]:
+    """Split a frame body into (request id, metadata, payload)"""
+    if len(body) < HEADER.size:
+        raise FrameError("Frame body is shorter than its header")
+    request_id, metadata_length = HEADER.unpack_from(body)
+    metadata_end = HEADER.size + metadata_length
+    if metadata_end > len(body):
+        raise FrameError("Metadata length runs past the end of the frame")
+    message = json.loads(body[HEADER.size:metadata_end].decode('utf-8'))
+    return request_id, message, body[metadata_end:]
+
+
+def read_shared_memory(name: str, size: Optional[int] = None) -> bytes:
+    """Copy the first `size` bytes (default: all) out of a shared-memory segment owned by the client"""
+    if sys.version_info >= (3, 13):
+        segment = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        segment = shared_memory.SharedMemory(name=name)
+        # Attaching registers the segment with this process's resource tracker, which
+        # would unlink it at exit; the client owns it
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    try:
+        if size is not None and not 0 <= size <= segment.size:
+            raise FrameError(f"Shared memory segment {name} holds {segment.size} bytes, not {size}")
+        return bytes(segment.buf[:segment.size if size is None else size])
+    finally:
+        segment.close()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Tuple[int, Dict[str, Any], bytes]]:
+    """Read one frame; returns None on a clean end of stream"""
+    try:
+        prefix = await reader.readexactly(LENGTH.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise FrameError("Connection closed inside a frame length")
+    (body_length,) = LENGTH.unpack(prefix)
+    if body_length > MAX_FRAME_BYTES:
+        raise FrameError(f"Frame of {body_length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+    return decode_body(await reader.readexactly(body_length))
+
+
+async def serve_unix_socket(handle_request: Callable[[Dict[str, Any], bytes], Dict[str, Any]],
+                            socket_path: str, threads: int = 1,
+                            on_admit: Optional[Callable[[Dict[str, Any]], None]] = None):
+    """Serve framed requests on a Unix socket until cancelled.
+
+    `handle_request(message, payload)` is a blocking call that runs on a
+    pool of `threads` workers; any exception becomes an `error` response.
+    Each connection may pipeline requests, and replies go out in completion
+    order, so a slow request never holds up the ones behind it.
+    `on_admit(message)` is called on the event loop as each frame is read,
+    before it waits for a worker.
+    """
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="socket-worker")
+    loop = asyncio.get_running_loop()
+    # Stop reading new frames once this many requests are queued or running
+    admitted = asyncio.Semaphore(threads * 4)
+
+    def run(message: Dict[str, Any], payload: bytes) -> Dict[str, Any]:
+        try:
+            return handle_request(message, payload)
+        except Exception as e:
+            logger.exception("Request failed")
+            return {"error": str(e)}
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+
+        async def respond(request_id: int, message: Dict[str, Any], payload: bytes):
+            try:
+                result = await loop.run_in_executor(executor, run, message, payload)
+            finally:
+                admitted.release()
+            try:
+                frame = encode_frame(request_id, result)
+            except (FrameError, TypeError, ValueError) as e:
+                frame = encode_frame(request_id, {"error": f"Unserializable response: {e}"})
+            writer.write(frame)
+            await writer.drain()
+
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                if on_admit is not None:
+                    on_admit(frame[1])
+                await admitted.acquire()
+                task = asyncio.create_task(respond(*frame))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (FrameError, ValueError, asyncio.IncompleteReadError) as e:
+            # The stream is out of sync; nothing after this point can be trusted
+            logger.warning("Dropping connection after protocol error: %s", e)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path, limit=MAX_FRAME_BYTES)
+    os.chmod(socket_path, 0o660)
+    logger.info("Listening on %s with %d worker threads", socket_path, threads)
+    # Stop cleanly (and remove the socket file) when the supervisor sends SIGTERM.
+    # Signal handlers can only be installed from the main thread; a server
+    # embedded in a thread is stopped by cancelling it instead.
+    if threading.current_thread() is threading.main_thread():
+        loop.add_signal_handler(signal.SIGTERM, server.close)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+class FramedClient:
+    """Async client that pipelines requests over one socket connection"""
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.reader = None
+        self.writer = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.ids = itertools.count(1)
+        self.reader_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_FRAME_BYTES)
+        self.reader_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        error: Exception = ConnectionError("Connection closed")
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                request_id, message, _ = frame
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            error = e
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    async def request(self, message: Dict[str, Any], payload: bytes = b'') -> Dict[str, Any]:
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_frame(request_id, message, payload))
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
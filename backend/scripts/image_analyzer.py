@@ -2,99 +2,114 @@ import os
 import sys
 import argparse
 import json
+import time
 import numpy as np
-import pandas as pd
-from PIL import Image
 import torch
-from sklearn.metrics.pairwise import cosine_similarity
 from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM, BlipProcessor, BlipForConditionalGeneration
 from torchvision.models import densenet121
-import torchvision.transforms as transforms
-from difflib import get_close_matches
-import pickle
+from exemplar_index import load_retrieval_index
+from diagnosis_lookup import load_lookup
+from image_preprocessing import preprocess_image
+from image_inference import embedder_from_env, mode_from_env
+from model_registry import ModelRegistry, default_budget_bytes
+import low_memory
+from report_cache import open_report_cache, template_version
+from cpu_scheduler import default_scheduler
+from serve_utils import configure_threads
 
 # --- Model & Tokenizer Loading ---
-# We load models once to be efficient.
-# In a real server, these would be loaded once when the server starts.
-try:
-    # LLM for generation
-    llm_model_name = "microsoft/phi-2"
-    tokenizer = AutoTokenizer.from_pretrained(llm_model_name, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(llm_model_name, trust_remote_code=True, device_map="auto", torch_dtype=torch.float16)
-    rag_pipeline = pipeline("text-generation", model=model, tokenizer=tokenizer)
-
-    # Image embedder
+# Each model loads on first use through the registry, and the least recently
+# used ones are evicted when MODEL_MEMORY_BUDGET_MB is exceeded.
+LLM_MODEL_NAME = "microsoft/phi-2"
+# DenseNet121 with an Identity classifier; exemplar indexes built in another embedding space are not used
+EMBEDDER_VERSION = f"densenet121+identity/{mode_from_env()}"
+# Greedy decoding: the same prompt always yields the same text, which makes reports cacheable
+LLM_GENERATION = {"max_new_tokens": 300, "do_sample": False, "temperature": 0.0}
+
+def load_llm():
+    """LLM for generation."""
+    tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_NAME, trust_remote_code=True)
+    # float16 as before; LOW_MEMORY=1 picks bfloat16 where the CPU has kernels for it
+    model = AutoModelForCausalLM.from_pretrained(LLM_MODEL_NAME, trust_remote_code=True, device_map="auto",
+                                                 **low_memory.pretrained_kwargs(default_dtype=torch.float16))
+    return pipeline("text-generation", model=model, tokenizer=tokenizer)
+
+def load_image_embedder():
+    """Image embedder, run in the configured IMAGE_INFERENCE_MODE (eager fp32 by default, bf16 with LOW_MEMORY=1)."""
     image_embedder = densenet121(weights='DenseNet121_Weights.DEFAULT')
     image_embedder.classifier = torch.nn.Identity()
     image_embedder.eval()
+    run_embedder, _ = embedder_from_env(image_embedder)
+    return run_embedder
 
-    # Image captioner
+def load_captioner():
+    """Image captioner."""
     caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+    caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base",
+                                                                 **low_memory.pretrained_kwargs())
+    return caption_processor, low_memory.reduce_module(caption_model)
+
+registry = ModelRegistry(default_budget_bytes())
+registry.register('phi2', load_llm)
+registry.register('densenet', load_image_embedder)
+registry.register('blip', load_captioner)
+
+
+# Minimum similarity for the best match to count as a diagnosis
+MATCH_THRESHOLD = 0.85
 
-    # Image transform
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-except Exception as e:
-    print(json.dumps({"error": f"Model loading failed: {str(e)}"}), file=sys.stderr)
-    sys.exit(1)
+MODALITIES = ['ct', 'xray', 'mri']
+DATA_ROOT = os.path.join(os.path.dirname(__file__), '..', 'data', 'medical_images')
 
+DIAGNOSIS_PROMPT_TEMPLATE = "Generate a detailed medical report for a patient with a likely diagnosis of {diagnosis} based on a {modality} scan. Include treatment, medication, recommendations, and follow-up."
+
+# Reports generated for a diagnosis without dataset context; None when LLM_REPORT_CACHE_MB=0.
+# Changing the template, model or generation settings starts a fresh key space, and
+# reduced-precision reports (LOW_MEMORY=1) are cached under their own version.
+report_cache = open_report_cache(template_version(DIAGNOSIS_PROMPT_TEMPLATE, LLM_MODEL_NAME, LLM_GENERATION)
+                                 + low_memory.version_suffix())
 
 # --- Helper Functions ---
 
-def encode_image(image_path):
-    """Encodes an image into a vector using a pre-trained model."""
+def encode_image(decoded):
+    """Encodes a preprocessed image into a vector using a pre-trained model."""
     try:
-        image = Image.open(image_path).convert('RGB')
-        img_tensor = transform(image).unsqueeze(0)
-        with torch.no_grad():
-            features = image_embedder(img_tensor)
-        return features.squeeze().numpy()
+        img_tensor = decoded.tensor.unsqueeze(0)
+        with registry.use('densenet') as run_embedder:
+            features = run_embedder(img_tensor)
+        return features.squeeze().float().numpy()
     except Exception as e:
-        raise RuntimeError(f"Failed to encode image at {image_path}: {str(e)}")
+        raise RuntimeError(f"Failed to encode image: {str(e)}")
 
 
-def get_image_caption(image_path):
-    """Generates a caption for an image."""
+def get_image_caption(image):
+    """Generates a caption for a decoded RGB image."""
     try:
-        raw_image = Image.open(image_path).convert('RGB')
-        inputs = caption_processor(raw_image, return_tensors="pt")
-        out = caption_model.generate(**inputs)
-        return caption_processor.decode(out[0], skip_special_tokens=True)
+        with registry.use('blip') as (caption_processor, caption_model):
+            inputs = caption_processor(image, return_tensors="pt").to(caption_model.dtype)
+            out = caption_model.generate(**inputs)
+            return caption_processor.decode(out[0], skip_special_tokens=True)
     except Exception as e:
-        raise RuntimeError(f"Failed to generate caption for {image_path}: {str(e)}")
+        raise RuntimeError(f"Failed to generate caption: {str(e)}")
 
 
-def find_closest_diagnosis(query_emb, diagnosis_embeddings, threshold=0.85):
-    """Finds the most similar diagnosis from pre-computed embeddings."""
-    max_sim = -1
-    best_diag = None
-    for diag, emb in diagnosis_embeddings.items():
-        sim = cosine_similarity([query_emb], [emb])[0][0]
-        if sim > max_sim:
-            max_sim = sim
-            best_diag = diag
-    return (best_diag, max_sim) if max_sim >= threshold else (None, max_sim)
+def find_closest_diagnosis(query_emb, diagnosis_matrix, k=3):
+    """Finds the k most similar diagnoses as (diagnosis, similarity) pairs, best first."""
+    return diagnosis_matrix.top_k(query_emb, k)
 
 
-def get_context_for_diagnosis(diagnosis_name, df):
-    """Retrieves patient context from a DataFrame based on diagnosis."""
-    if not diagnosis_name or df is None:
-        return None
-    matches = get_close_matches(diagnosis_name.lower(), df['diagnosis'].dropna().str.lower(), n=1, cutoff=0.6)
-    if not matches:
+def get_context_for_diagnosis(diagnosis_name, lookup):
+    """Retrieves patient context for a diagnosis from the precompiled lookup."""
+    if not diagnosis_name or lookup is None:
         return None
-    row = df[df['diagnosis'].str.lower() == matches[0]].iloc[0]
-    return row.to_dict()
+    return lookup.find(diagnosis_name, cutoff=0.6, partial=False, normalize=False)
 
 
 def call_llm(prompt):
     """Calls the LLM to generate text based on a prompt."""
     try:
-        response = rag_pipeline(prompt, max_new_tokens=300, do_sample=False, temperature=0.0)
+        with registry.use('phi2') as rag_pipeline:
+            response = rag_pipeline(prompt, **LLM_GENERATION)
         generated_text = response[0]["generated_text"]
         # Clean the response by removing the prompt
         if generated_text.startswith(prompt):
@@ -114,10 +129,8 @@ def format_final_report(diagnosis, treatment, medications, recommendations, foll
         "follow_up": follow_up
     }
 
-def generate_llm_report(prompt):
-    """Generates and parses a structured report from the LLM."""
-    llm_output = call_llm(prompt)
-    
+def parse_llm_report(llm_output):
+    """Parses LLM output into a structured report."""
     # Basic parsing of the LLM output
     diagnosis = "Could not determine"
     treatment = "Could not determine"
@@ -140,19 +153,58 @@ def generate_llm_report(prompt):
 
     return format_final_report(diagnosis, treatment, medication, recommendations, follow_up)
 
+def generate_llm_report(prompt):
+    """Generates and parses a structured report from the LLM."""
+    return parse_llm_report(call_llm(prompt))
+
+def generate_diagnosis_report(diagnosis, model_type):
+    """LLM report for a diagnosis without dataset context; returns (report, cache status)."""
+    llm_output = report_cache.get(diagnosis, model_type) if report_cache else None
+    if llm_output is not None:
+        return parse_llm_report(llm_output), "hit"
+    llm_output = call_llm(DIAGNOSIS_PROMPT_TEMPLATE.format(diagnosis=diagnosis, modality=model_type.upper()))
+    if report_cache:
+        report_cache.put(diagnosis, model_type, llm_output)
+    return parse_llm_report(llm_output), "miss" if report_cache else "off"
+
+def precompute_reports(modalities=MODALITIES, force=False):
+    """Generates and caches the report of every known diagnosis that has no dataset context."""
+    if report_cache is None:
+        raise RuntimeError("The report cache is disabled (LLM_REPORT_CACHE_MB=0)")
+    counts = {"generated": 0, "cached": 0, "with_context": 0, "failed": 0}
+    for model_type in modalities:
+        base_data_path = os.path.join(DATA_ROOT, model_type)
+        diagnosis_embeddings = load_retrieval_index(base_data_path, EMBEDDER_VERSION)
+        lookup = load_lookup(base_data_path)
+        for diagnosis in diagnosis_embeddings.labels:
+            # Diagnoses with dataset context are answered from the dataset and never reach the LLM
+            if get_context_for_diagnosis(diagnosis, lookup):
+                counts["with_context"] += 1
+                continue
+            if not force and report_cache.get(diagnosis, model_type) is not None:
+                counts["cached"] += 1
+                continue
+            try:
+                start = time.perf_counter()
+                llm_output = call_llm(DIAGNOSIS_PROMPT_TEMPLATE.format(diagnosis=diagnosis, modality=model_type.upper()))
+                report_cache.put(diagnosis, model_type, llm_output)
+                counts["generated"] += 1
+                print(f"{model_type}/{diagnosis}: generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"{model_type}/{diagnosis}: {e}", file=sys.stderr)
+    counts["cache"] = report_cache.stats()
+    return counts
+
 
 def run_analysis(image_path, model_type):
     """Main analysis function."""
-    base_data_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'medical_images', model_type)
+    base_data_path = os.path.join(DATA_ROOT, model_type)
     
     # --- Load Data ---
     try:
-        embeddings_path = os.path.join(base_data_path, "diagnosis_image_embeddings.pkl")
-        with open(embeddings_path, "rb") as f:
-            diagnosis_embeddings = pickle.load(f)
-        
-        patient_data_path = os.path.join(base_data_path, "patient_data.json")
-        df = pd.read_json(patient_data_path)
+        diagnosis_embeddings = load_retrieval_index(base_data_path, EMBEDDER_VERSION)
+        lookup = load_lookup(base_data_path)
     except FileNotFoundError as e:
         return {"error": f"Data file not found for type '{model_type}': {str(e)}"}
     except Exception as e:
@@ -160,12 +212,19 @@ def run_analysis(image_path, model_type):
 
     # --- Run Pipeline ---
     try:
-        query_embedding = encode_image(image_path)
-        diagnosis, sim_score = find_closest_diagnosis(query_embedding, diagnosis_embeddings)
+        start_time = time.perf_counter()
+        # Decode once; DenseNet and BLIP share the decoded image
+        decoded = preprocess_image(image_path)
+        query_embedding = encode_image(decoded)
+        top_matches = find_closest_diagnosis(query_embedding, diagnosis_embeddings)
+        diagnosis, sim_score = top_matches[0] if top_matches else (None, None)
+        if sim_score is not None and sim_score < MATCH_THRESHOLD:
+            diagnosis = None
 
         report = {}
+        report_cache_status = None
         if diagnosis:
-            context = get_context_for_diagnosis(diagnosis, df)
+            context = get_context_for_diagnosis(diagnosis, lookup)
             if context:
                 # Found a matching diagnosis with context in our dataset
                 report = format_final_report(
@@ -178,17 +237,22 @@ def run_analysis(image_path, model_type):
                 report["source"] = "Dataset Match"
             else:
                 # Found a diagnosis but no context, generate with LLM
-                prompt = f"Generate a detailed medical report for a patient with a likely diagnosis of {diagnosis} based on a {model_type.upper()} scan. Include treatment, medication, recommendations, and follow-up."
-                report = generate_llm_report(prompt)
+                report, report_cache_status = generate_diagnosis_report(diagnosis, model_type)
                 report["source"] = "LLM Generation (No Context)"
         else:
             # No matching diagnosis, use image captioning and LLM
-            caption = get_image_caption(image_path)
+            caption = get_image_caption(decoded.image)
             prompt = f"Generate a detailed medical report based on the following {model_type.upper()} scan summary: '{caption}'. Include a potential diagnosis, treatment plan, medications, recommendations, and follow-up."
             report = generate_llm_report(prompt)
             report["source"] = "LLM Generation (Image Caption)"
 
         report["similarity_score"] = f"{sim_score:.2%}" if sim_score is not None else "N/A"
+        report["top_matches"] = [{"diagnosis": diag, "similarity_score": f"{sim:.2%}"} for diag, sim in top_matches]
+        report["timings"] = {
+            "decode_ms": round(decoded.decode_ms, 2),
+            **({"report_cache": report_cache_status} if report_cache_status else {}),
+            "total_ms": round((time.perf_counter() - start_time) * 1000, 2)
+        }
         return report
 
     except Exception as e:
@@ -197,13 +261,25 @@ def run_analysis(image_path, model_type):
 # --- Main Execution ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Medical Image Analysis Engine")
-    parser.add_argument("--image_path", type=str, required=True, help="Path to the user-uploaded image.")
-    parser.add_argument("--model_type", type=str, required=True, choices=['ct', 'xray', 'mri'], help="Type of medical image.")
+    parser.add_argument("--mode", type=str, choices=['analyze', 'precompute_reports'], default='analyze',
+                        help="analyze (one image) or precompute_reports (fill the LLM report cache for every known diagnosis)")
+    parser.add_argument("--image_path", type=str, help="Path to the user-uploaded image.")
+    parser.add_argument("--model_type", type=str, choices=MODALITIES, help="Type of medical image (precompute_reports: default all).")
+    parser.add_argument("--force", action="store_true", help="precompute_reports: regenerate reports that are already cached.")
     
     args = parser.parse_args()
+
+    if args.mode == 'precompute_reports':
+        counts = precompute_reports([args.model_type] if args.model_type else MODALITIES, args.force)
+        print(json.dumps(counts, indent=2))
+        sys.exit(0)
+
+    if not args.image_path or not args.model_type:
+        parser.error("--image_path and --model_type are required in analyze mode")
     
     try:
-        result = run_analysis(args.image_path, args.model_type)
+        with default_scheduler().job(configure_threads(1)):
+            result = run_analysis(args.image_path, args.model_type)
         print(json.dumps(result, indent=2))
     except Exception as e:
         print(json.dumps({"error": f"An unexpected error occurred: {str(e)}"}), file=sys.stderr)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the image pipeline on synthetic scans
+Generates ct/mri/xray-shaped images at several resolutions and formats, then
+runs the lightweight analyzer on them: one cold request (models and data
+loading on first use), repeated warm requests, and each stage on its own
+(decode, embed, batched embed, match, context lookup, report). Each modality
+runs in a fresh child process, so cold numbers and peak RSS are its own.
+Reports latency percentiles, images/sec and peak RSS as JSON.
+
+    python scripts/image_benchmark.py --modalities xray ct --repeats 5
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from load_generator import percentile
+
+MODALITIES = ['ct', 'mri', 'xray']
+DEFAULT_SIZES = [256, 512, 1024, 2048]
+FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'bmp': 'BMP', 'tif': 'TIFF'}
+DEFAULT_FORMATS = ['jpg', 'png']
+
+
+def synthetic_scan(modality: str, size: int, seed: int) -> Image.Image:
+    """A grayscale image with the rough structure of a scan of that modality"""
+    rng = np.random.default_rng(seed)
+    image = Image.new('L', (size, size), 0)
+    draw = ImageDraw.Draw(image)
+    s = size / 512
+
+    if modality == 'ct':
+        # Axial slice: body outline, bright spine, darker lungs and soft-tissue organs
+        draw.ellipse([40 * s, 90 * s, 472 * s, 430 * s], fill=110)
+        draw.ellipse([110 * s, 150 * s, 240 * s, 340 * s], fill=35)
+        draw.ellipse([272 * s, 150 * s, 402 * s, 340 * s], fill=35)
+        draw.ellipse([226 * s, 330 * s, 286 * s, 390 * s], fill=230)
+        for _ in range(6):
+            x, y = rng.uniform(140, 370) * s, rng.uniform(180, 320) * s
+            r = rng.uniform(8, 30) * s
+            draw.ellipse([x - r, y - r, x + r, y + r], fill=int(rng.uniform(90, 160)))
+        noise = 12
+    elif modality == 'mri':
+        # Head slice: bright skull rim, gray/white matter and ventricles, smooth contrast
+        draw.ellipse([70 * s, 40 * s, 442 * s, 472 * s], fill=200)
+        draw.ellipse([90 * s, 60 * s, 422 * s, 452 * s], fill=120)
+        draw.ellipse([130 * s, 100 * s, 382 * s, 412 * s], fill=150)
+        draw.ellipse([215 * s, 190 * s, 250 * s, 300 * s], fill=40)
+        draw.ellipse([262 * s, 190 * s, 297 * s, 300 * s], fill=40)
+        image = image.filter(ImageFilter.GaussianBlur(3 * s))
+        draw = ImageDraw.Draw(image)
+        noise = 6
+    else:
+        # Limb radiograph: dark background, soft tissue, and bright cortical bone
+        draw.rectangle([150 * s, 0, 362 * s, size], fill=70)
+        draw.rectangle([215 * s, 0, 297 * s, 250 * s], fill=220)
+        draw.rectangle([230 * s, 0, 282 * s, 250 * s], fill=170)
+        draw.ellipse([195 * s, 230 * s, 317 * s, 300 * s], fill=225)
+        draw.rectangle([205 * s, 290 * s, 250 * s, size], fill=215)
+        draw.rectangle([262 * s, 290 * s, 307 * s, size], fill=215)
+        image = image.filter(ImageFilter.GaussianBlur(1.5 * s))
+        noise = 9
+
+    pixels = np.asarray(image, dtype=np.float32) + rng.normal(0, noise, (size, size))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'L')
+
+
+def write_synthetic_set(out_dir: str, modality: str, sizes: List[int], formats: List[str],
+                        per_combination: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Write `per_combination` images for each size and format; returns their descriptions"""
+    os.makedirs(out_dir, exist_ok=True)
+    images = []
+    for size in sizes:
+        for fmt in formats:
+            for i in range(per_combination):
+                path = os.path.join(out_dir, f"{modality}_{size}_{i}.{fmt}")
+                synthetic_scan(modality, size, seed + i).save(path, FORMATS[fmt])
+                images.append({'path': path, 'size': size, 'format': fmt, 'bytes': os.path.getsize(path)})
+    return images
+
+
+def latency_summary(samples_s: List[float]) -> Dict[str, Any]:
+    ordered = sorted(samples_s)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        **{f"{name}_ms": round(percentile(ordered, fraction) * 1000, 3)
+           for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))}
+    }
+
+
+def timed(func: Callable, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def benchmark_modality(modality: str, images: List[Dict[str, Any]], repeats: int, batch_size: int) -> Dict[str, Any]:
+    """Cold, warm and per-stage timings for one modality, in the current (fresh) process"""
+    result: Dict[str, Any] = {'images': len(images), 'rss_before_import_mb': peak_rss_mb()}
+
+    start = time.perf_counter()
+    import lightweight_image_analyzer as analyzer
+    import torch
+    from image_preprocessing import preprocess_image
+    result['cold'] = {'import_s': round(time.perf_counter() - start, 3)}
+
+    # First request pays for the modality data and DenseNet loading
+    first_path = images[0]['path']
+    start = time.perf_counter()
+    report = analyzer.run_analysis(first_path, modality)
+    result['cold']['first_request_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    if 'error' in report:
+        result['error'] = report['error']
+        return result
+    # Second request on the same image: everything resident
+    start = time.perf_counter()
+    analyzer.run_analysis(first_path, modality)
+    result['cold']['second_request_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    end_to_end, by_variant = [], {}
+    warm_start = time.perf_counter()
+    for _ in range(repeats):
+        for image in images:
+            elapsed = timed(analyzer.run_analysis, image['path'], modality)
+            end_to_end.append(elapsed)
+            by_variant.setdefault(f"{image['size']}/{image['format']}", []).append(elapsed)
+    warm_elapsed = time.perf_counter() - warm_start
+    result['warm'] = {
+        'end_to_end': latency_summary(end_to_end),
+        'images_per_sec': round(len(end_to_end) / warm_elapsed, 3) if warm_elapsed > 0 else None,
+        'by_variant': {variant: latency_summary(samples) for variant, samples in sorted(by_variant.items())}
+    }
+
+    snapshot = analyzer.get_modality_data(modality)
+    stages: Dict[str, List[float]] = {name: [] for name in ('decode', 'embed', 'match', 'context_lookup', 'report')}
+    tensors = []
+    for _ in range(repeats):
+        for image in images:
+            with open(image['path'], 'rb') as f:
+                image_bytes = f.read()
+            start = time.perf_counter()
+            decoded = preprocess_image(io.BytesIO(image_bytes))
+            stages['decode'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            embedding = analyzer.encode_image(decoded)
+            stages['embed'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            matches = analyzer.find_closest_diagnosis(embedding, snapshot.matrix)
+            stages['match'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            analyzer.get_context_for_diagnosis(matches[0][0] if matches else None, snapshot.lookup)
+            stages['context_lookup'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            analyzer.build_report(decoded.image, modality, matches, snapshot.lookup)
+            stages['report'].append(time.perf_counter() - start)
+
+            if len(tensors) < batch_size:
+                tensors.append(decoded.tensor)
+    result['stages'] = {name: latency_summary(samples) for name, samples in stages.items()}
+
+    batch = torch.stack(tensors)
+    samples = [timed(analyzer.encode_images, batch) for _ in range(repeats)]
+    result['stages']['embed_batch'] = {
+        **latency_summary(samples),
+        'batch_size': len(tensors),
+        'images_per_sec': round(len(tensors) / (sum(samples) / len(samples)), 3)
+    }
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['models'] = {name: model['bytes'] for name, model in analyzer.registry.stats()['models'].items()
+                        if model['resident']}
+    return result
+
+
+def run_isolated(modality: str, args: argparse.Namespace, image_dir: str) -> Dict[str, Any]:
+    """Benchmark one modality in a child process so its cold start and peak RSS are its own"""
+    command = [sys.executable, os.path.abspath(__file__), '--worker', modality, '--image_dir', image_dir,
+               '--sizes', *map(str, args.sizes), '--formats', *args.formats,
+               '--per_combination', str(args.per_combination), '--repeats', str(args.repeats),
+               '--batch_size', str(args.batch_size)]
+    start = time.perf_counter()
+    process = subprocess.run(command, capture_output=True, text=True)
+    if process.returncode != 0:
+        return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'worker failed'}
+    result = json.loads(process.stdout)
+    result['cold']['process_s'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image pipeline on synthetic scans')
+    parser.add_argument('--modalities', nargs='+', choices=MODALITIES, default=MODALITIES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='Square image sizes in pixels')
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS), default=DEFAULT_FORMATS)
+    parser.add_argument('--per_combination', type=int, default=2, help='Images per size and format')
+    parser.add_argument('--repeats', type=int, default=3, help='Warm passes over the image set')
+    parser.add_argument('--batch_size', type=int, default=16, help='Batch size for the batched embed stage')
+    parser.add_argument('--image_dir', type=str, help='Where to write the synthetic images (default: a temp dir)')
+    parser.add_argument('--embedding_cache', action='store_true',
+                        help='Keep the embedding cache on (warm runs then measure cache hits, not inference)')
+    parser.add_argument('--output', type=str, help='Write the JSON report here instead of stdout')
+    parser.add_argument('--worker', choices=MODALITIES, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    image_dir = args.image_dir or tempfile.mkdtemp(prefix='image-benchmark-')
+
+    if args.worker:
+        images = write_synthetic_set(os.path.join(image_dir, args.worker), args.worker, args.sizes, args.formats,
+                                     args.per_combination)
+        print(json.dumps(benchmark_modality(args.worker, images, args.repeats, args.batch_size)))
+        return
+
+    if not args.embedding_cache:
+        # Children inherit this; every warm request then runs decode and DenseNet
+        os.environ['IMAGE_EMBEDDING_CACHE_MB'] = '0'
+
+    report = {
+        'config': {
+            'sizes': args.sizes,
+            'formats': args.formats,
+            'per_combination': args.per_combination,
+            'repeats': args.repeats,
+            'embedding_cache': args.embedding_cache,
+            'inference_mode': os.environ.get('IMAGE_INFERENCE_MODE', 'eager'),
+            'image_dir': image_dir
+        },
+        'modalities': {}
+    }
+    for modality in args.modalities:
+        print(f"Benchmarking {modality}...", file=sys.stderr)
+        report['modalities'][modality] = run_isolated(modality, args, image_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+DenseNet121 image embedder with a fixed projection head, and its embedding cache
+The 1024x1024 projection head is a committed artifact
+(data/models/image_projection_head.npy: weight rows, then the bias row), so
+query embeddings are reproducible across processes and can be cached. It was
+drawn from a fixed seed; run this file with --create_head to regenerate it.
+Loading never creates it: a missing head is an error. The model version
+folds in the head's hash, so cached embeddings never outlive the weights
+that produced them.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from torchvision.models import densenet121
+
+from disk_cache import DiskCache
+
+BACKEND_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+PROJECTION_HEAD_PATH = os.path.join(BACKEND_DIR, 'data', 'models', 'image_projection_head.npy')
+PROJECTION_HEAD_SEED = 0
+EMBEDDING_DIM = 1024
+EMBEDDING_CACHE_PATH = os.path.join(BACKEND_DIR, 'data', 'cache', 'image_embeddings.sqlite')
+DEFAULT_EMBEDDING_CACHE_MB = 256
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def create_projection_head(path: str = PROJECTION_HEAD_PATH, seed: int = PROJECTION_HEAD_SEED) -> str:
+    """Write a projection head drawn from `seed` with nn.Linear's default init range; returns its digest"""
+    rng = np.random.default_rng(seed)
+    bound = 1 / np.sqrt(EMBEDDING_DIM)
+    head = rng.uniform(-bound, bound, size=(EMBEDDING_DIM + 1, EMBEDDING_DIM)).astype(np.float32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, head)
+    os.replace(tmp_path, path)
+    return file_digest(path)
+
+
+def _require_head(path: str):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Projection head {path} is missing; restore it from git or run "
+                                f"`python scripts/image_embedder.py --create_head`")
+
+
+def load_projection_head(path: str = PROJECTION_HEAD_PATH) -> Tuple[torch.nn.Linear, str]:
+    """Load the saved projection head; returns (head, sha256 of the saved weights)"""
+    _require_head(path)
+    weights = np.load(path)
+    if weights.shape != (EMBEDDING_DIM + 1, EMBEDDING_DIM):
+        raise ValueError(f"Projection head {path} has shape {weights.shape}, "
+                         f"expected {(EMBEDDING_DIM + 1, EMBEDDING_DIM)}")
+    head = torch.nn.Linear(EMBEDDING_DIM, EMBEDDING_DIM)
+    with torch.no_grad():
+        head.weight.copy_(torch.from_numpy(weights[:-1]))
+        head.bias.copy_(torch.from_numpy(weights[-1]))
+    return head, file_digest(path)
+
+
+def embedder_version(digest: str) -> str:
+    return f"densenet121+head-{digest[:12]}"
+
+
+def projection_head_version(head_path: str = PROJECTION_HEAD_PATH) -> str:
+    """Model version of the embedder, without loading DenseNet"""
+    _require_head(head_path)
+    return embedder_version(file_digest(head_path))
+
+
+def build_image_embedder(head_path: str = PROJECTION_HEAD_PATH) -> Tuple[torch.nn.Module, str]:
+    """DenseNet121 with the saved projection head; returns (model, model version)"""
+    model = densenet121(weights='DenseNet121_Weights.DEFAULT')
+    head, digest = load_projection_head(head_path)
+    model.classifier = head
+    model.eval()
+    return model, embedder_version(digest)
+
+
+class EmbeddingCache:
+    """Image embeddings keyed by image-bytes hash, modality and model version"""
+
+    def __init__(self, cache: DiskCache, model_version: str):
+        self.cache = cache
+        self.model_version = model_version
+
+    def key(self, image_bytes: bytes, modality: str) -> str:
+        return f"{hashlib.sha256(image_bytes).hexdigest()}:{modality}:{self.model_version}"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        value = self.cache.get(key)
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32).copy()
+
+    def put(self, key: str, embedding: np.ndarray):
+        self.cache.put(key, np.asarray(embedding, dtype=np.float32).tobytes())
+
+
+def open_embedding_cache(model_version: str) -> Optional[EmbeddingCache]:
+    """Cache configured by IMAGE_EMBEDDING_CACHE (path) and IMAGE_EMBEDDING_CACHE_MB (0 disables)"""
+    max_mb = float(os.environ.get('IMAGE_EMBEDDING_CACHE_MB', DEFAULT_EMBEDDING_CACHE_MB))
+    if max_mb <= 0:
+        return None
+    path = os.environ.get('IMAGE_EMBEDDING_CACHE', EMBEDDING_CACHE_PATH)
+    return EmbeddingCache(DiskCache(path, int(max_mb * 1024 * 1024)), model_version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the image embedder projection head')
+    parser.add_argument('--create_head', action='store_true', help='Write the projection head from its fixed seed')
+    parser.add_argument('--head_path', type=str, default=PROJECTION_HEAD_PATH, help='Where the head is stored')
+    parser.add_argument('--force', action='store_true', help='Overwrite an existing head')
+
+    args = parser.parse_args()
+
+    if not args.create_head:
+        _require_head(args.head_path)
+        print(f"{args.head_path}: {projection_head_version(args.head_path)}")
+        return
+    if os.path.exists(args.head_path) and not args.force:
+        print(f"Error: {args.head_path} exists; pass --force to replace it "
+              f"(cached and stored embeddings built with it become stale)", file=sys.stderr)
+        sys.exit(1)
+    digest = create_projection_head(args.head_path)
+    print(f"Wrote {args.head_path} (seed {PROJECTION_HEAD_SEED}): {embedder_version(digest)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+CPU inference modes for the DenseNet121 image embedder, with a parity report
+Modes:
+    eager           float32 eager model under no_grad (the baseline)
+    inference_mode  eager under torch.inference_mode (no autograd bookkeeping)
+    channels_last   NHWC weights and inputs, which oneDNN convolutions prefer
+    torchscript     torch.jit.script, frozen and optimized for inference
+    trace           torch.jit.trace on a 224x224 example, frozen and optimized
+    dynamic_int8    int8 weights for the Linear layers (dynamic quantization)
+    static_int8     FX graph-mode int8 for the whole network, calibrated on images
+
+The analyzers pick a mode with IMAGE_INFERENCE_MODE (default eager). With
+LOW_MEMORY=1 the eager-based modes run on reduced-precision weights (see
+low_memory.py); the compiled and int8 modes keep their own weights. Run this
+file to compare modes against eager fp32 on real scans before switching:
+    python scripts/image_inference.py --images 'uploads/*.jpg' --model_type xray
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from low_memory import cast_inputs, reduce_module, weight_dtype
+
+INFERENCE_MODES = ['eager', 'inference_mode', 'channels_last', 'torchscript', 'trace', 'dynamic_int8', 'static_int8']
+DEFAULT_MODE = 'eager'
+# Modes that run the eager module and so can take reduced-precision weights in low-memory mode
+CASTABLE_MODES = ['eager', 'inference_mode', 'channels_last']
+EXAMPLE_SHAPE = (1, 3, 224, 224)
+
+
+def calibration_batches(paths: List[str], batch_size: int = 8) -> List[torch.Tensor]:
+    """Preprocessed image batches for static quantization"""
+    from image_preprocessing import preprocess_image
+
+    tensors = [preprocess_image(path).tensor for path in paths]
+    return [torch.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+
+def _freeze(scripted: torch.jit.ScriptModule) -> torch.jit.ScriptModule:
+    return torch.jit.optimize_for_inference(torch.jit.freeze(scripted.eval()))
+
+
+def prepare_embedder(model: torch.nn.Module, mode: str = DEFAULT_MODE,
+                     calibration: Optional[List[torch.Tensor]] = None) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Return a function mapping a (n, 3, 224, 224) batch to raw embeddings.
+
+    The eager model is left untouched; converted modes work on a copy. The
+    module that actually runs is exposed as `run.module`.
+    """
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f"Unknown inference mode '{mode}'; choose from {INFERENCE_MODES}")
+    model = model.eval()
+
+    if mode == 'eager':
+        def run(batch):
+            with torch.no_grad():
+                return model(batch)
+        run.module = model
+        return run
+
+    if mode == 'inference_mode':
+        def run(batch):
+            with torch.inference_mode():
+                return model(batch)
+        run.module = model
+        return run
+
+    if mode == 'channels_last':
+        converted = copy.deepcopy(model).to(memory_format=torch.channels_last)
+
+        def run(batch):
+            with torch.inference_mode():
+                return converted(batch.contiguous(memory_format=torch.channels_last))
+        run.module = converted
+        return run
+
+    if mode in ('torchscript', 'trace'):
+        with torch.no_grad():
+            if mode == 'torchscript':
+                compiled = _freeze(torch.jit.script(copy.deepcopy(model)))
+            else:
+                compiled = _freeze(torch.jit.trace(copy.deepcopy(model), torch.randn(EXAMPLE_SHAPE)))
+
+        def run(batch):
+            with torch.no_grad():
+                return compiled(batch)
+        run.module = compiled
+        return run
+
+    if mode == 'dynamic_int8':
+        # Dynamic quantization covers Linear layers only; the convolutions stay fp32
+        quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear},
+                                                           dtype=torch.qint8)
+
+        def run(batch):
+            with torch.inference_mode():
+                return quantized(batch)
+        run.module = quantized
+        return run
+
+    # static_int8
+    if not calibration:
+        raise ValueError("static_int8 needs calibration images (IMAGE_CALIBRATION_IMAGES or --calibration)")
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    backend = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = backend
+    prepared = prepare_fx(copy.deepcopy(model), get_default_qconfig_mapping(backend),
+                          example_inputs=(torch.randn(EXAMPLE_SHAPE),))
+    with torch.inference_mode():
+        for batch in calibration:
+            prepared(batch)
+    quantized = convert_fx(prepared)
+
+    def run(batch):
+        with torch.inference_mode():
+            return quantized(batch)
+    run.module = quantized
+    return run
+
+
+def mode_from_env() -> str:
+    return os.environ.get('IMAGE_INFERENCE_MODE', DEFAULT_MODE)
+
+
+def embedder_from_env(model: torch.nn.Module) -> Tuple[Callable[[torch.Tensor], torch.Tensor], str]:
+    """prepare_embedder for IMAGE_INFERENCE_MODE, calibrating on IMAGE_CALIBRATION_IMAGES (a glob),
+    on reduced-precision weights in low-memory mode.
+
+    Returns (embedding function, mode).
+    """
+    mode = mode_from_env()
+    calibration = None
+    if mode == 'static_int8':
+        calibration = calibration_batches(sorted(glob.glob(os.environ.get('IMAGE_CALIBRATION_IMAGES', ''))))
+    dtype = weight_dtype()
+    if dtype is not None and mode in CASTABLE_MODES:
+        return cast_inputs(prepare_embedder(reduce_module(model), mode), dtype), mode
+    return prepare_embedder(model, mode, calibration), mode
+
+
+def normalize_rows(features: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.where(norms > 0, norms, 1)
+
+
+def time_runs(run: Callable[[torch.Tensor], torch.Tensor], batch: torch.Tensor, repeats: int) -> Dict[str, float]:
+    """Per-call latency in ms after one warm-up call"""
+    run(batch)
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(batch)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {'mean_ms': float(np.mean(samples)), 'p50_ms': samples[len(samples) // 2],
+            'p90_ms': samples[min(len(samples) - 1, int(len(samples) * 0.9))]}
+
+
+def parity_report(model: torch.nn.Module, images: torch.Tensor, modes: List[str], diagnosis_matrix: Any,
+                  calibration: Optional[List[torch.Tensor]] = None, repeats: int = 10,
+                  batch_size: int = 8) -> Dict[str, Any]:
+    """Compare each mode's embeddings, top-1 diagnoses and latency with eager fp32"""
+    baseline_run = prepare_embedder(model, 'eager')
+    baseline = normalize_rows(baseline_run(images).numpy())
+    baseline_top1 = [matches[0][0] for matches in diagnosis_matrix.top_k_batch(baseline, 1)]
+
+    single, batch = images[:1], images[:batch_size]
+    report = {'images': int(images.shape[0]), 'batch_size': int(batch.shape[0]), 'modes': {}}
+    for mode in modes:
+        entry: Dict[str, Any] = {}
+        try:
+            start = time.perf_counter()
+            run = prepare_embedder(model, mode, calibration)
+            entry['prepare_s'] = round(time.perf_counter() - start, 3)
+
+            embeddings = normalize_rows(run(images).float().numpy())
+            cosine = np.sum(embeddings * baseline, axis=1)
+            top1 = [matches[0][0] for matches in diagnosis_matrix.top_k_batch(embeddings, 1)]
+            agreement = float(np.mean([a == b for a, b in zip(top1, baseline_top1)]))
+
+            entry.update({
+                'cosine_mean': float(cosine.mean()),
+                'cosine_min': float(cosine.min()),
+                'top1_agreement': agreement,
+                'latency_single': time_runs(run, single, repeats),
+                'latency_batch': time_runs(run, batch, max(1, repeats // 2))
+            })
+        except Exception as e:
+            entry['error'] = str(e)
+        report['modes'][mode] = entry
+        print(f"{mode}: {json.dumps(entry)}", file=sys.stderr)
+
+    eager_ms = report['modes'].get('eager', {}).get('latency_single', {}).get('mean_ms')
+    if eager_ms:
+        for entry in report['modes'].values():
+            if 'latency_single' in entry:
+                entry['speedup_single'] = round(eager_ms / entry['latency_single']['mean_ms'], 3)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity and latency report for the image inference modes')
+    parser.add_argument('--images', type=str, required=True, help='Glob of scans to compare on')
+    parser.add_argument('--model_type', choices=['ct', 'xray', 'mri'], default='xray',
+                        help='Modality whose diagnoses are used for top-1 agreement')
+    parser.add_argument('--modes', nargs='+', default=INFERENCE_MODES, choices=INFERENCE_MODES)
+    parser.add_argument('--calibration', type=str, help='Glob of calibration scans for static_int8 (default: --images)')
+    parser.add_argument('--identity_head', action='store_true',
+                        help='Use the Identity classifier of image_analyzer.py instead of the projection head')
+    parser.add_argument('--repeats', type=int, default=10, help='Timed calls per mode')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size for the batched latency')
+    parser.add_argument('--threads', type=int, help='torch intra-op threads')
+    parser.add_argument('--output', type=str, help='Write the JSON report here as well as stdout')
+
+    args = parser.parse_args()
+
+    from embedding_store import DATA_ROOT, load_diagnosis_matrix
+    from image_embedder import build_image_embedder
+    from image_preprocessing import preprocess_image
+    from torchvision.models import densenet121
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    paths = sorted(glob.glob(args.images))
+    if not paths:
+        parser.error(f"No images match {args.images}")
+    images = torch.stack([preprocess_image(path).tensor for path in paths])
+    calibration = calibration_batches(sorted(glob.glob(args.calibration)) if args.calibration else paths)
+
+    if args.identity_head:
+        model = densenet121(weights='DenseNet121_Weights.DEFAULT')
+        model.classifier = torch.nn.Identity()
+        model_version = 'densenet121+identity'
+    else:
+        model, model_version = build_image_embedder()
+
+    report = parity_report(model, images, args.modes, load_diagnosis_matrix(os.path.join(DATA_ROOT, args.model_type)),
+                           calibration, args.repeats, args.batch_size)
+    report.update({'model_version': model_version, 'model_type': args.model_type, 'threads': torch.get_num_threads()})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Shared image decoding for the image analyzers
+Each upload is decoded once; DenseNet and BLIP both read the same RGB image.
+JPEGs are decoded with PIL's draft mode, which lets libjpeg scale by 1/2,
+1/4 or 1/8 while decoding, so large radiographs never materialize at full
+resolution when the models only need a few hundred pixels.
+"""
+
+import time
+from typing import Any, Optional, Tuple
+
+from PIL import Image
+import torchvision.transforms as transforms
+
+# DenseNet121 input size, and BLIP's processor resize (blip-image-captioning-base)
+DENSENET_SIZE = (224, 224)
+BLIP_SIZE = (384, 384)
+
+densenet_transform = transforms.Compose([
+    transforms.Resize(DENSENET_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+
+class DecodedImage:
+    """One decoded upload: the RGB image, its DenseNet tensor and decode timing"""
+
+    def __init__(self, image: Image.Image, tensor: Any, decode_ms: float, original_size: Tuple[int, int]):
+        self.image = image
+        self.tensor = tensor
+        self.decode_ms = decode_ms
+        self.original_size = original_size
+
+
+def decode_image(source: Any, min_size: Optional[Tuple[int, int]] = BLIP_SIZE) -> Tuple[Image.Image, Tuple[int, int]]:
+    """Decode to RGB, letting JPEGs decode at the smallest scale still >= min_size.
+
+    `source` is a path or a binary file object. Returns (image, original size).
+    """
+    image = Image.open(source)
+    original_size = image.size
+    if min_size is not None and image.format == 'JPEG':
+        image.draft('RGB', min_size)
+    return image.convert('RGB'), original_size
+
+
+def preprocess_image(source: Any) -> DecodedImage:
+    """Decode once and build the DenseNet tensor; `image` is kept for BLIP"""
+    start = time.perf_counter()
+    image, original_size = decode_image(source)
+    decode_ms = (time.perf_counter() - start) * 1000
+    return DecodedImage(image, densenet_transform(image), decode_ms, original_size)
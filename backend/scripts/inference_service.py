@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Inference Service - Async HTTP API for the medical AI models
+Keeps the RAG processors and the image analyzer warm in one process
+"""
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from cpu_scheduler import default_scheduler, scheduled
+from low_memory import CATEGORIES, memory_report
+from serve_utils import configure_threads
+
+ENGINES = ['lightweight', 'full', 'image']
+
+
+class EngineBusyError(Exception):
+    """Raised when an engine's executor and wait queue are both full"""
+
+
+class BoundedExecutor:
+    """Thread pool with a hard cap on running plus waiting calls.
+
+    Blocking model calls run on the pool so the event loop stays free; once
+    `max_workers + max_queue` calls are admitted, new calls are rejected
+    instead of piling up behind the model.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        # Threads each call holds from the node-wide CPU scheduler, set once engines are configured
+        self.job_threads = 1
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Run a blocking call on the pool, or raise EngineBusyError"""
+        if not self._slots.acquire(blocking=False):
+            raise EngineBusyError(f"{self.name} engine is at capacity")
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, scheduled(func, self.job_threads), *args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class EngineHost:
+    """Loads the enabled engines once and tracks their readiness"""
+
+    def __init__(self, engines: List[str], model_dir: str = "data/models",
+                 workers: Optional[Dict[str, int]] = None, max_queue: int = 32):
+        self.engines = engines
+        self.model_dir = model_dir
+        self.status = {name: 'pending' for name in engines}
+        self.errors: Dict[str, str] = {}
+        self.instances: Dict[str, Any] = {}
+
+        workers = workers or {}
+        self.executors = {
+            name: BoundedExecutor(name, workers.get(name, 1), max_queue)
+            for name in engines
+        }
+        # Split the CPU budget over every executor thread that can run at once
+        job_threads = configure_threads(sum(executor.max_workers for executor in self.executors.values()))
+        for executor in self.executors.values():
+            executor.job_threads = job_threads
+
+    def load_all(self):
+        """Load every enabled engine; failures are recorded, not raised"""
+        for name in self.engines:
+            self.status[name] = 'loading'
+            start_time = time.time()
+            try:
+                self.instances[name] = getattr(self, f"_load_{name}")()
+                self.status[name] = 'ready'
+                print(f"[service] {name} engine ready in {time.time() - start_time:.1f}s", file=sys.stderr)
+            except (Exception, SystemExit) as e:
+                # The image analyzer exits the interpreter when its models fail to load
+                self.status[name] = 'failed'
+                self.errors[name] = str(e)
+                print(f"[service] {name} engine failed to load: {e}", file=sys.stderr)
+
+    def _load_lightweight(self):
+        from lightweight_rag_processor import LightweightMedicalRAG
+        processor = LightweightMedicalRAG()
+        processor.load_model_artifacts(self.model_dir)
+        return processor
+
+    def _load_full(self):
+        from rag_processor import MedicalRAGProcessor
+        processor = MedicalRAGProcessor()
+        processor.load_model_artifacts(self.model_dir)
+        return processor
+
+    def _load_image(self):
+        # Load the datasets and DenseNet up front; BLIP loads through the registry on first use
+        import lightweight_image_analyzer
+        lightweight_image_analyzer.preload_modalities()
+        lightweight_image_analyzer.modality_store.start_watching(lightweight_image_analyzer.MODALITY_POLL_SECONDS)
+        lightweight_image_analyzer.registry.get('densenet')
+        return lightweight_image_analyzer
+
+    def is_ready(self) -> bool:
+        return all(state == 'ready' for state in self.status.values())
+
+    async def call(self, name: str, func_name: str, *args) -> Any:
+        """Dispatch a blocking engine method onto that engine's executor"""
+        if name not in self.status:
+            raise HTTPException(status_code=404, detail=f"Engine '{name}' is not enabled")
+        if self.status[name] != 'ready':
+            raise HTTPException(status_code=503, detail=f"Engine '{name}' is {self.status[name]}")
+
+        func = getattr(self.instances[name], func_name)
+        try:
+            return await self.executors[name].run(func, *args)
+        except EngineBusyError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+    def memory_components(self) -> Dict[str, Dict[str, Any]]:
+        """Every loaded engine's memory components, named '<engine>.<component>'"""
+        merged = {category: {} for category in CATEGORIES}
+        for name, instance in self.instances.items():
+            for category, items in instance.memory_components().items():
+                merged[category].update({f"{name}.{item}": value for item, value in items.items()})
+        return merged
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()
+
+
+class QueryRequest(BaseModel):
+    query: str
+    age: Optional[int] = None
+    gender: Optional[str] = None
+
+
+class ImageAnalysisRequest(BaseModel):
+    image_path: str
+    model_type: str
+
+
+def create_app(host: EngineHost) -> FastAPI:
+    """Build the FastAPI app around an EngineHost"""
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Load in the background so /health answers while models warm up
+        loader = threading.Thread(target=host.load_all, name="engine-loader", daemon=True)
+        loader.start()
+        yield
+        host.shutdown()
+
+    app = FastAPI(title="Motion Clinic Inference Service", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        return {'status': 'ok', 'timestamp': time.time()}
+
+    @app.get("/ready")
+    async def ready():
+        body = {
+            'ready': host.is_ready(),
+            'engines': host.status,
+            'errors': host.errors,
+            'executors': {name: executor.stats() for name, executor in host.executors.items()},
+            'cpu': default_scheduler().stats(),
+            'models': {name: instance.registry.stats() for name, instance in host.instances.items()
+                       if hasattr(instance, 'registry')},
+            'datasets': {name: instance.modality_store.stats() for name, instance in host.instances.items()
+                         if hasattr(instance, 'modality_store')}
+        }
+        return JSONResponse(status_code=200 if body['ready'] else 503, content=body)
+
+    @app.get("/memory")
+    async def memory():
+        # Resident memory of the whole service, broken down by engine component
+        return memory_report(host.memory_components())
+
+    @app.post("/rag/query")
+    async def rag_query(request: QueryRequest):
+        if not request.query.strip():
+            raise HTTPException(status_code=400, detail="No query provided")
+        return await host.call('lightweight', 'process_medical_query',
+                               request.query, request.age, request.gender)
+
+    @app.post("/rag/full/query")
+    async def rag_full_query(request: QueryRequest):
+        if not request.query.strip():
+            raise HTTPException(status_code=400, detail="No query provided")
+        return await host.call('full', 'process_medical_query',
+                               request.query, request.age, request.gender)
+
+    @app.post("/image/analyze")
+    async def image_analyze(request: ImageAnalysisRequest):
+        if request.model_type not in ('ct', 'xray', 'mri'):
+            raise HTTPException(status_code=400, detail="model_type must be one of ct, xray, mri")
+        result = await host.call('image', 'run_analysis', request.image_path, request.model_type)
+        if 'error' in result:
+            raise HTTPException(status_code=500, detail=result['error'])
+        return result
+
+    @app.post("/image/analyze/bytes")
+    async def image_analyze_bytes(request: Request, model_type: str):
+        # The encoded image is the request body; it never goes through a file
+        if model_type not in ('ct', 'xray', 'mri'):
+            raise HTTPException(status_code=400, detail="model_type must be one of ct, xray, mri")
+        image_bytes = await request.body()
+        if not image_bytes:
+            raise HTTPException(status_code=400, detail="No image bytes in the request body")
+        result = await host.call('image', 'run_analysis', image_bytes, model_type)
+        if 'error' in result:
+            raise HTTPException(status_code=500, detail=result['error'])
+        return result
+
+    return app
+
+
+def main():
+    """Main function to handle command line arguments"""
+    parser = argparse.ArgumentParser(description='Medical AI Inference Service')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to bind')
+    parser.add_argument('--port', type=int, default=8001, help='Port to listen on')
+    parser.add_argument('--engines', type=str, default='lightweight,image',
+                        help=f"Comma-separated engines to host: {', '.join(ENGINES)}")
+    parser.add_argument('--model_dir', type=str, default='data/models', help='RAG model artifacts directory')
+    parser.add_argument('--lightweight_workers', type=int, default=4, help='Executor threads for the lightweight RAG')
+    parser.add_argument('--full_workers', type=int, default=1, help='Executor threads for the BioGPT RAG')
+    parser.add_argument('--image_workers', type=int, default=1, help='Executor threads for the image analyzer')
+    parser.add_argument('--max_queue', type=int, default=32, help='Waiting calls allowed per engine before rejecting')
+
+    args = parser.parse_args()
+
+    engines = [name.strip() for name in args.engines.split(',') if name.strip()]
+    unknown = [name for name in engines if name not in ENGINES]
+    if unknown:
+        print(f"Error: unknown engines {unknown}; choose from {ENGINES}")
+        sys.exit(1)
+
+    host = EngineHost(
+        engines,
+        model_dir=args.model_dir,
+        workers={
+            'lightweight': args.lightweight_workers,
+            'full': args.full_workers,
+            'image': args.image_workers
+        },
+        max_queue=args.max_queue
+    )
+    uvicorn.run(create_app(host), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,141 +1,120 @@
+import io
 import os
 import sys
 import argparse
 import json
 import numpy as np
-import pandas as pd
 from PIL import Image
 import torch
-from sklearn.metrics.pairwise import cosine_similarity
 from transformers.models.blip import BlipProcessor, BlipForConditionalGeneration
-from torchvision.models import densenet121
-import torchvision.transforms as transforms
-from difflib import get_close_matches
-import pickle
+from torch.utils.data import DataLoader, Dataset
 import random
+import time
+from embedding_store import STORE_NAME, read_meta
+from exemplar_index import load_retrieval_index
+from diagnosis_lookup import load_lookup
+from image_preprocessing import decode_image, preprocess_image
+from image_embedder import build_image_embedder, open_embedding_cache, projection_head_version
+from image_inference import embedder_from_env, mode_from_env
+from model_registry import ModelRegistry, default_budget_bytes
+import low_memory
+from modality_store import ModalityStore
+from cpu_scheduler import default_scheduler
+import tracing
+from tracing import event, span
+from serve_utils import configure_threads, job_threads
 
 # --- Model Loading ---
-try:
-    # Image embedder
-    image_embedder = densenet121(weights='DenseNet121_Weights.DEFAULT')
-    image_embedder.classifier = torch.nn.Linear(1024, 1024)
-    image_embedder.eval()
+# Models load on first use; MODEL_MEMORY_BUDGET_MB bounds how much stays resident
+def load_image_embedder():
+    """DenseNet121 with the saved projection head, run in IMAGE_INFERENCE_MODE."""
+    model, _ = build_image_embedder()
+    run_embedder, _ = embedder_from_env(model)
+    return run_embedder
 
-    # Image captioner
+def load_captioner():
+    """BLIP, only needed when a modality has no dataset cases."""
     caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-
-    # Image transform
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
+    caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base",
+                                                                 **low_memory.pretrained_kwargs())
+    return caption_processor, low_memory.reduce_module(caption_model)
+
+registry = ModelRegistry(default_budget_bytes())
+registry.register('densenet', load_image_embedder)
+registry.register('blip', load_captioner)
+
+try:
+    # Identifies the embedder without loading it, so cached embeddings need no forward pass
+    EMBEDDER_VERSION = f"{projection_head_version()}/{mode_from_env()}"
 except Exception as e:
     print(json.dumps({"error": f"Model loading failed: {str(e)}"}), file=sys.stderr)
     sys.exit(1)
 
+MODALITIES = ['ct', 'xray', 'mri']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+DATA_ROOT = os.path.join(os.path.dirname(__file__), '..', 'data', 'medical_images')
+
+# Embeddings of previously seen images; None when IMAGE_EMBEDDING_CACHE_MB=0.
+# Reduced-precision embeddings (LOW_MEMORY=1) are cached under their own version.
+embedding_cache = open_embedding_cache(EMBEDDER_VERSION + low_memory.version_suffix())
+
+# Per-modality (diagnosis matrix, diagnosis lookup) snapshots; serve mode reloads them when their files change
+MODALITY_POLL_SECONDS = float(os.environ.get('MODALITY_POLL_SECONDS', 5))
+
 # --- Helper Functions ---
 
-def encode_image(image_path):
-    """Encodes an image into a vector using DenseNet121."""
+def encode_image(decoded):
+    """Encodes a preprocessed image into a vector using DenseNet121."""
     try:
-        image = Image.open(image_path).convert('RGB')
-        img_tensor = transform(image).unsqueeze(0)
-        with torch.no_grad():
-            features = image_embedder(img_tensor)
+        img_tensor = decoded.tensor.unsqueeze(0)
+        with registry.use('densenet') as run_embedder:
+            features = run_embedder(img_tensor)
         
         # Convert to numpy and normalize to unit length
-        query_emb = features.squeeze().numpy()
+        query_emb = features.squeeze().float().numpy()
         query_norm = np.linalg.norm(query_emb)
         if query_norm > 0:
             query_emb = query_emb / query_norm
         
         return query_emb
     except Exception as e:
-        raise RuntimeError(f"Failed to encode image at {image_path}: {str(e)}")
+        raise RuntimeError(f"Failed to encode image: {str(e)}")
 
-def get_image_caption(image_path):
-    """Generates a caption for an image using BLIP."""
+def encode_images(img_batch):
+    """Encodes a (n, 3, 224, 224) batch into unit-length DenseNet121 vectors."""
+    with registry.use('densenet') as run_embedder:
+        features = run_embedder(img_batch).float().numpy()
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.where(norms > 0, norms, 1)
+
+def get_image_caption(image):
+    """Generates a caption for a decoded RGB image (or an image path) using BLIP."""
     try:
-        raw_image = Image.open(image_path).convert('RGB')
-        inputs = caption_processor(raw_image, return_tensors="pt")
-        out = caption_model.generate(**inputs)
-        return caption_processor.decode(out[0], skip_special_tokens=True)
+        if not isinstance(image, Image.Image):
+            image, _ = decode_image(image)
+        with registry.use('blip') as (caption_processor, caption_model):
+            # Pixel values follow the weights' dtype (bfloat16 in low-memory mode)
+            inputs = caption_processor(image, return_tensors="pt").to(caption_model.dtype)
+            out = caption_model.generate(**inputs)
+            return caption_processor.decode(out[0], skip_special_tokens=True)
     except Exception as e:
-        raise RuntimeError(f"Failed to generate caption for {image_path}: {str(e)}")
+        raise RuntimeError(f"Failed to generate caption: {str(e)}")
 
-def find_closest_diagnosis(query_emb, diagnosis_embeddings, threshold=0.01):
-    """Finds the most similar diagnosis from pre-computed embeddings."""
-    max_sim = -1
-    best_diag = None
-    best_emb = None
-    
-    print(f"DEBUG: Looking for matches in {len(diagnosis_embeddings)} diagnoses", file=sys.stderr)
-    
-    for diag, emb in diagnosis_embeddings.items():
-        try:
-            # Normalize stored embedding to unit length
-            emb_norm = np.linalg.norm(emb)
-            if emb_norm > 0:
-                emb_normalized = emb / emb_norm
-            else:
-                continue
-            
-            sim = cosine_similarity([query_emb], [emb_normalized])[0][0]
-            # Ensure similarity is between 0 and 1
-            sim = max(0, min(1, sim))
-            if sim > max_sim:
-                max_sim = sim
-                best_diag = diag
-                best_emb = emb
-        except Exception as e:
-            print(f"DEBUG: Error calculating similarity for {diag}: {e}", file=sys.stderr)
-            continue
-    
-    print(f"DEBUG: Best match found: {best_diag} with similarity: {max_sim:.2%}", file=sys.stderr)
-    # Always return the best match, regardless of threshold
-    return (best_diag, max_sim) if best_diag else (None, max_sim)
+def find_closest_diagnosis(query_emb, diagnosis_matrix, k=3):
+    """Finds the k most similar diagnoses as (diagnosis, similarity) pairs, best first."""
+    # Always return the best matches, regardless of threshold; scores are clamped to [0, 1]
+    return [(diag, max(0.0, min(1.0, sim))) for diag, sim in diagnosis_matrix.top_k(query_emb, k)]
 
-def get_context_for_diagnosis(diagnosis_name, df):
-    """Retrieves patient context from a DataFrame based on diagnosis."""
-    if not diagnosis_name or df is None:
+def get_context_for_diagnosis(diagnosis_name, lookup):
+    """Retrieves patient context for a diagnosis from the precompiled lookup."""
+    if not diagnosis_name or lookup is None:
         return None
     
-    print(f"DEBUG: Looking for diagnosis: {diagnosis_name}", file=sys.stderr)
-    print(f"DEBUG: Available diagnoses: {df['diagnosis'].dropna().unique()[:5]}", file=sys.stderr)
-    
-    # Preprocess diagnosis name to match dataset format
-    diagnosis_clean = diagnosis_name.lower().replace('_', ' ').replace('-', ' ')
-    
-    # Try exact match first (case insensitive)
-    exact_match = df[df['diagnosis'].str.lower() == diagnosis_clean]
-    if not exact_match.empty:
-        print(f"DEBUG: Found exact match: {exact_match.iloc[0]['diagnosis']}", file=sys.stderr)
-        return exact_match.iloc[0].to_dict()
-    
-    # Try fuzzy matching with lower cutoff for better matching
-    matches = get_close_matches(diagnosis_clean, df['diagnosis'].dropna().str.lower(), n=3, cutoff=0.3)
-    if matches:
-        print(f"DEBUG: Found fuzzy matches: {matches}", file=sys.stderr)
-        # Use the best match
-        best_match = matches[0]
-        row = df[df['diagnosis'].str.lower() == best_match].iloc[0]
-        print(f"DEBUG: Using best match: {row['diagnosis']}", file=sys.stderr)
-        return row.to_dict()
-    
-    # If still no match, try partial matching
-    for idx, row in df.iterrows():
-        dataset_diagnosis = str(row['diagnosis']).lower()
-        if (diagnosis_clean in dataset_diagnosis or 
-            dataset_diagnosis in diagnosis_clean or
-            any(word in dataset_diagnosis for word in diagnosis_clean.split()) or
-            any(word in diagnosis_clean for word in dataset_diagnosis.split())):
-            print(f"DEBUG: Found partial match: {row['diagnosis']}", file=sys.stderr)
-            return row.to_dict()
-    
-    print(f"DEBUG: No matches found for {diagnosis_name}", file=sys.stderr)
-    return None
+    # Exact match, then fuzzy matching with a low cutoff, then partial matching
+    with span("context_lookup", diagnosis=diagnosis_name):
+        context = lookup.find(diagnosis_name, cutoff=0.3, partial=True)
+    event("context_lookup", diagnosis=diagnosis_name, match=context['diagnosis'] if context else None)
+    return context
 
 def generate_simple_report(image_caption, model_type, diagnosis=None):
     """Generates a simple medical report based on image caption and diagnosis."""
@@ -189,15 +168,14 @@ def generate_simple_report(image_caption, model_type, diagnosis=None):
             "follow_up": "Schedule an appointment with a specialist for detailed analysis."
         }
 
-def get_random_case_from_dataset(df):
+def get_random_case_from_dataset(lookup):
     """Gets a random case from the dataset to ensure real data is always returned."""
-    if df is None or len(df) == 0:
+    if lookup is None or len(lookup) == 0:
         return None
     
-    random_index = random.randint(0, len(df) - 1)
-    random_case = df.iloc[random_index]
-    print(f"DEBUG: Selected random case: {random_case.get('diagnosis', 'N/A')}", file=sys.stderr)
-    return random_case.to_dict()
+    random_case = dict(random.choice(lookup.rows))
+    event("random_case", diagnosis=random_case.get('diagnosis', 'N/A'))
+    return random_case
 
 def validate_medical_response(response, model_type):
     """Validates medical response to ensure it's appropriate for the image type."""
@@ -213,101 +191,83 @@ def validate_medical_response(response, model_type):
     # If the response is valid, return it as is
     return response
 
-def run_analysis(image_path, model_type):
-    """Main analysis function."""
-    base_data_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'medical_images', model_type)
-    
-    print(f"DEBUG: Analyzing {model_type} image: {image_path}", file=sys.stderr)
-    print(f"DEBUG: Using data path: {base_data_path}", file=sys.stderr)
-    
-    # --- Load Data ---
+def warn_on_embedder_mismatch(base_data_path, model_type):
+    """Warns when the store was built (by build_image_embeddings.py) with a different embedder than queries use."""
     try:
-        embeddings_path = os.path.join(base_data_path, "diagnosis_image_embeddings.pkl")
-        with open(embeddings_path, "rb") as f:
-            diagnosis_embeddings = pickle.load(f)
-        
-        patient_data_path = os.path.join(base_data_path, "patient_data.json")
-        df = pd.read_json(patient_data_path)
-        
-        print(f"DEBUG: Loaded {len(diagnosis_embeddings)} embeddings and {len(df)} patient records", file=sys.stderr)
-    except FileNotFoundError as e:
-        return {"error": f"Data file not found for type '{model_type}': {str(e)}"}
-    except Exception as e:
-        return {"error": f"Failed to load data for type '{model_type}': {str(e)}"}
+        built_with = read_meta(os.path.join(base_data_path, STORE_NAME)).get('embedder', '')
+    except FileNotFoundError:
+        return
+    # Stores migrated from the legacy pickle only record the architecture
+    if '/' in built_with and built_with != EMBEDDER_VERSION:
+        print(f"Warning: {model_type} embeddings were built with {built_with}, queries use {EMBEDDER_VERSION}",
+              file=sys.stderr)
 
-    # --- Run Pipeline ---
-    try:
-        query_embedding = encode_image(image_path)
-        print(f"DEBUG: Image encoded successfully, embedding shape: {query_embedding.shape}", file=sys.stderr)
-        
-        diagnosis, sim_score = find_closest_diagnosis(query_embedding, diagnosis_embeddings)
-
-        report = {}
-        # Always try to use the best match from dataset first, regardless of similarity score
-        if diagnosis:
-            print(f"DEBUG: Found diagnosis match: {diagnosis} with score: {sim_score:.2%}", file=sys.stderr)
-            context = get_context_for_diagnosis(diagnosis, df)
-            if context:
-                # Found a matching diagnosis with context in our dataset
-                print(f"DEBUG: Using dataset context for diagnosis", file=sys.stderr)
-                print(f"DEBUG: Context data: {context}", file=sys.stderr)
-                print(f"DEBUG: Medication from dataset: {context.get('medications_perscribed', 'N/A')}", file=sys.stderr)
-                
-                # Always use real data from dataset, regardless of similarity score
-                real_diagnosis = context.get('diagnosis', 'N/A')
-                real_treatment = context.get('treatment', 'N/A')
-                
-                # Handle different medication column names across datasets
-                real_medication = context.get('medications_perscribed', 'N/A')
-                if real_medication == 'N/A' or real_medication is None:
-                    real_medication = context.get('medications', 'N/A')
-                
-                print(f"DEBUG: Final medication value: {real_medication}", file=sys.stderr)
-                
-                # Validate with LLM-like logic (medical appropriateness check)
-                validated_diagnosis = validate_medical_response(real_diagnosis, model_type)
-                validated_treatment = validate_medical_response(real_treatment, model_type)
-                validated_medication = validate_medical_response(real_medication, model_type)
-                
-                report = {
-                    "final_diagnosis": validated_diagnosis,
-                    "treatment_plan": validated_treatment,
-                    "medication_prescribed": validated_medication,
-                    "recommendations": f"Based on {model_type.upper()} analysis, maintain physical therapy and regular checkups.",
-                    "follow_up": "Re-evaluate every 3-6 months."
-                }
-                report["source"] = "Dataset Match (Validated)"
-            else:
-                # Found a diagnosis but no context - get random case from dataset
-                print(f"DEBUG: No context found for diagnosis: {diagnosis}, getting random case", file=sys.stderr)
-                random_case = get_random_case_from_dataset(df)
-                if random_case:
-                    # Handle different medication column names
-                    medication = random_case.get('medications_perscribed', 'N/A')
-                    if medication == 'N/A':
-                        medication = random_case.get('medications', 'N/A')
-                    
-                    report = {
-                        "final_diagnosis": random_case.get('diagnosis', 'N/A'),
-                        "treatment_plan": random_case.get('treatment', 'N/A'),
-                        "medication_prescribed": medication,
-                        "recommendations": f"Based on {model_type.upper()} analysis, consult with a specialist.",
-                        "follow_up": "Schedule follow-up appointment."
-                    }
-                    report["source"] = "Random Dataset Case"
-                else:
-                    report = generate_simple_report("", model_type, diagnosis)
-                    report["source"] = "Image Analysis (No Context)"
+def load_modality_data(model_type):
+    """Loads the diagnosis embeddings and patient records for one modality."""
+    base_data_path = os.path.join(DATA_ROOT, model_type)
+
+    # Memory-mapped diagnosis matrix, or the exemplar index when IMAGE_RETRIEVAL=exemplar
+    diagnosis_embeddings = load_retrieval_index(base_data_path, EMBEDDER_VERSION)
+    warn_on_embedder_mismatch(base_data_path, model_type)
+
+    # One representative record per diagnosis, rebuilt only when patient_data.json changes
+    lookup = load_lookup(base_data_path)
+    return diagnosis_embeddings, lookup
+
+modality_store = ModalityStore(DATA_ROOT, load_modality_data)
+
+def get_modality_data(model_type):
+    """Returns the current snapshot of a modality's data, loading it on first use."""
+    return modality_store.get(model_type)
+
+def preload_modalities(modalities=MODALITIES):
+    """Loads every modality up front; a missing dataset is reported and skipped."""
+    for model_type, error in modality_store.preload(modalities).items():
+        print(f"Warning: could not load {model_type} data: {error}", file=sys.stderr)
+    return modality_store.loaded()
+
+def build_report(image, model_type, top_matches, lookup):
+    """Builds the report for one image (decoded, or its path) from its ranked diagnosis matches."""
+    diagnosis, sim_score = top_matches[0] if top_matches else (None, 0)
+
+    report = {}
+    # Always try to use the best match from dataset first, regardless of similarity score
+    if diagnosis:
+        event("diagnosis_match", diagnosis=diagnosis, score=round(sim_score, 4))
+        context = get_context_for_diagnosis(diagnosis, lookup)
+        if context:
+            # Found a matching diagnosis with context in our dataset
+            # Always use real data from dataset, regardless of similarity score
+            real_diagnosis = context.get('diagnosis', 'N/A')
+            real_treatment = context.get('treatment', 'N/A')
+
+            # Handle different medication column names across datasets
+            real_medication = context.get('medications_perscribed', 'N/A')
+            if real_medication == 'N/A' or real_medication is None:
+                real_medication = context.get('medications', 'N/A')
+
+            # Validate with LLM-like logic (medical appropriateness check)
+            validated_diagnosis = validate_medical_response(real_diagnosis, model_type)
+            validated_treatment = validate_medical_response(real_treatment, model_type)
+            validated_medication = validate_medical_response(real_medication, model_type)
+
+            report = {
+                "final_diagnosis": validated_diagnosis,
+                "treatment_plan": validated_treatment,
+                "medication_prescribed": validated_medication,
+                "recommendations": f"Based on {model_type.upper()} analysis, maintain physical therapy and regular checkups.",
+                "follow_up": "Re-evaluate every 3-6 months."
+            }
+            report["source"] = "Dataset Match (Validated)"
         else:
-            # No matching diagnosis - get random case from dataset to ensure real data
-            print(f"DEBUG: No diagnosis match found, getting random case from dataset", file=sys.stderr)
-            random_case = get_random_case_from_dataset(df)
+            # Found a diagnosis but no context - get random case from dataset
+            random_case = get_random_case_from_dataset(lookup)
             if random_case:
                 # Handle different medication column names
                 medication = random_case.get('medications_perscribed', 'N/A')
                 if medication == 'N/A':
                     medication = random_case.get('medications', 'N/A')
-                
+
                 report = {
                     "final_diagnosis": random_case.get('diagnosis', 'N/A'),
                     "treatment_plan": random_case.get('treatment', 'N/A'),
@@ -317,34 +277,349 @@ def run_analysis(image_path, model_type):
                 }
                 report["source"] = "Random Dataset Case"
             else:
-                # Fallback to caption-based analysis
-                print(f"DEBUG: No dataset cases available, using image captioning", file=sys.stderr)
-                caption = get_image_caption(image_path)
-                print(f"DEBUG: Generated caption: {caption}", file=sys.stderr)
-                report = generate_simple_report(caption, model_type)
-                report["source"] = "Image Analysis (Caption)"
-
-        # Ensure similarity score is positive
-        sim_score = max(0, sim_score) if sim_score is not None else 0
-        report["similarity_score"] = f"{sim_score:.2%}"
+                report = generate_simple_report("", model_type, diagnosis)
+                report["source"] = "Image Analysis (No Context)"
+    else:
+        # No matching diagnosis - get random case from dataset to ensure real data
+        random_case = get_random_case_from_dataset(lookup)
+        if random_case:
+            # Handle different medication column names
+            medication = random_case.get('medications_perscribed', 'N/A')
+            if medication == 'N/A':
+                medication = random_case.get('medications', 'N/A')
+
+            report = {
+                "final_diagnosis": random_case.get('diagnosis', 'N/A'),
+                "treatment_plan": random_case.get('treatment', 'N/A'),
+                "medication_prescribed": medication,
+                "recommendations": f"Based on {model_type.upper()} analysis, consult with a specialist.",
+                "follow_up": "Schedule follow-up appointment."
+            }
+            report["source"] = "Random Dataset Case"
+        else:
+            # Fallback to caption-based analysis
+            with span("caption"):
+                caption = get_image_caption(image)
+            event("caption", caption=caption)
+            report = generate_simple_report(caption, model_type)
+            report["source"] = "Image Analysis (Caption)"
+
+    # Ensure similarity score is positive
+    sim_score = max(0, sim_score) if sim_score is not None else 0
+    report["similarity_score"] = f"{sim_score:.2%}"
+    report["top_matches"] = [{"diagnosis": diag, "similarity_score": f"{sim:.2%}"} for diag, sim in top_matches]
+    return report
+
+def run_analysis(image, model_type):
+    """Main analysis function; `image` is a file path or the encoded image bytes.
+
+    Traced as one request when tracing is enabled.
+    """
+    if isinstance(image, str):
+        attrs = {"image_path": image}
+    else:
+        attrs = {"image_bytes": len(image)}
+    with tracing.trace("analyze", model_type=model_type, **attrs):
+        return _run_analysis(image, model_type)
+
+def _run_analysis(image, model_type):
+    # --- Load Data ---
+    try:
+        # One snapshot for the whole request, even if a reload swaps in a newer one meanwhile
+        snapshot = get_modality_data(model_type)
+        diagnosis_embeddings, lookup = snapshot.matrix, snapshot.lookup
+    except FileNotFoundError as e:
+        return {"error": f"Data file not found for type '{model_type}': {str(e)}"}
+    except Exception as e:
+        return {"error": f"Failed to load data for type '{model_type}': {str(e)}"}
+
+    # --- Run Pipeline ---
+    try:
+        start_time = time.perf_counter()
+        if isinstance(image, str):
+            with span("read"):
+                with open(image, "rb") as f:
+                    image_bytes = f.read()
+        else:
+            # Handed over in memory (socket payload, shared memory or stdin); nothing touches disk
+            image_bytes = image
+
+        # A re-upload of the same scan skips decoding and the forward pass
+        with span("embedding_cache.get"):
+            cache_key = embedding_cache.key(image_bytes, model_type) if embedding_cache else None
+            query_embedding = embedding_cache.get(cache_key) if cache_key else None
+        decoded = None
+        if query_embedding is None:
+            # Decode once; DenseNet and BLIP share the decoded image
+            with span("decode") as record:
+                decoded = preprocess_image(io.BytesIO(image_bytes))
+                if record is not None:
+                    record['attrs'] = {'original_size': decoded.original_size}
+
+            with span("embed"):
+                query_embedding = encode_image(decoded)
+            if cache_key:
+                with span("embedding_cache.put"):
+                    embedding_cache.put(cache_key, query_embedding)
+
+        with span("match"):
+            top_matches = find_closest_diagnosis(query_embedding, diagnosis_embeddings)
+        with span("report"):
+            # On a cache hit BLIP (if needed) decodes the bytes already in memory
+            report = build_report(decoded.image if decoded else io.BytesIO(image_bytes), model_type, top_matches, lookup)
+        report["data_version"] = snapshot.version
+        report["timings"] = {
+            "decode_ms": round(decoded.decode_ms, 2) if decoded else 0,
+            "embedding_cache": ("miss" if decoded else "hit") if cache_key else "off",
+            "total_ms": round((time.perf_counter() - start_time) * 1000, 2)
+        }
         return report
 
     except Exception as e:
-        print(f"DEBUG: Error in analysis: {e}", file=sys.stderr)
+        print(f"Error in analysis: {e}", file=sys.stderr)
         import traceback
         traceback.print_exc(file=sys.stderr)
         return {"error": str(e)}
 
+class ImageBatchDataset(Dataset):
+    """Decodes and transforms images in DataLoader workers; failures are kept as errors.
+
+    Images already in the embedding cache are returned as their cached
+    embedding and never decoded.
+    """
+
+    def __init__(self, items, cache=None):
+        self.items = items
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        item = self.items[index]
+        try:
+            with open(item['image_path'], "rb") as f:
+                image_bytes = f.read()
+            key = self.cache.key(image_bytes, item['model_type']) if self.cache and item['model_type'] else None
+            cached = self.cache.get(key) if key else None
+            if cached is not None:
+                return index, None, cached, key, None
+            return index, preprocess_image(io.BytesIO(image_bytes)).tensor, None, key, None
+        except Exception as e:
+            return index, None, None, None, f"Failed to decode image: {str(e)}"
+
+def collate_image_batch(samples):
+    """Stacks the decoded images of a batch; cached embeddings and errors pass through."""
+    decoded = [(index, tensor, key) for index, tensor, _, key, error in samples if tensor is not None]
+    cached = [(index, embedding) for index, _, embedding, _, _ in samples if embedding is not None]
+    errors = [(index, error) for index, _, _, _, error in samples if error is not None]
+    indices = [index for index, _, _ in decoded]
+    keys = [key for _, _, key in decoded]
+    tensors = torch.stack([tensor for _, tensor, _ in decoded]) if decoded else None
+    return indices, tensors, keys, cached, errors
+
+def load_batch_items(input_path, model_type=None):
+    """Lists the images to analyse from a directory or a manifest file.
+
+    A manifest is either a text file with one image path per line, or JSON
+    lines with `image_path` and an optional per-image `model_type`. Relative
+    paths are resolved against the manifest's directory.
+    """
+    if os.path.isdir(input_path):
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(input_path)
+            for name in names if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        return [{"image_path": path, "model_type": model_type} for path in paths]
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    items = []
+    with open(input_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                item = {"image_path": entry['image_path'], "model_type": entry.get('model_type', model_type)}
+            else:
+                item = {"image_path": line, "model_type": model_type}
+            item['image_path'] = os.path.join(base_dir, item['image_path'])
+            items.append(item)
+    return items
+
+def run_batch(input_path, model_type=None, batch_size=16, workers=2, output=None, k=3):
+    """Analyses a directory or manifest of images, writing one JSON line per image.
+
+    Images are decoded in DataLoader workers, embedded by DenseNet121 a batch at
+    a time, and matched against each modality's diagnoses in one product per batch.
+    """
+    items = load_batch_items(input_path, model_type)
+    for item in items:
+        if item['model_type'] not in MODALITIES:
+            item['error'] = f"model_type must be one of {MODALITIES}"
+
+    loader = DataLoader(ImageBatchDataset(items, embedding_cache), batch_size=batch_size, num_workers=workers,
+                        collate_fn=collate_image_batch)
+    out = open(output, 'w') if output else sys.stdout
+    counts = {"analyzed": 0, "failed": 0}
+
+    def emit(index, report):
+        item = items[index]
+        record = {"image_path": item['image_path'], "model_type": item['model_type'], **report}
+        out.write(json.dumps(record) + "\n")
+        counts["failed" if "error" in report else "analyzed"] += 1
+
+    try:
+        for indices, tensors, keys, cached, errors in loader:
+            # One trace per loader batch
+            with tracing.trace("batch", images=len(errors) + len(cached) + len(indices)):
+                for index, error in errors:
+                    emit(index, {"error": items[index].get('error', error)})
+
+                embedded = list(cached)
+                if tensors is not None:
+                    # Each forward pass is one job of the node-wide CPU budget; decoding overlaps in the workers
+                    with default_scheduler().job(job_threads()), span("embed", images=len(indices)):
+                        embeddings = encode_images(tensors)
+                    for index, key, embedding in zip(indices, keys, embeddings):
+                        if key and embedding_cache:
+                            embedding_cache.put(key, embedding)
+                        embedded.append((index, embedding))
+
+                by_modality = {}
+                for index, embedding in embedded:
+                    if 'error' in items[index]:
+                        emit(index, {"error": items[index]['error']})
+                    else:
+                        by_modality.setdefault(items[index]['model_type'], []).append((embedding, index))
+
+                for modality, members in by_modality.items():
+                    try:
+                        snapshot = get_modality_data(modality)
+                        diagnosis_embeddings, lookup = snapshot.matrix, snapshot.lookup
+                    except Exception as e:
+                        for _, index in members:
+                            emit(index, {"error": f"Failed to load data for type '{modality}': {str(e)}"})
+                        continue
+                    with span("match", modality=modality, images=len(members)):
+                        matches = diagnosis_embeddings.top_k_batch(np.stack([embedding for embedding, _ in members]), k)
+                    for (_, index), top_matches in zip(members, matches):
+                        try:
+                            emit(index, build_report(items[index]['image_path'], modality,
+                                                     [(diag, max(0.0, min(1.0, sim))) for diag, sim in top_matches],
+                                                     lookup))
+                        except Exception as e:
+                            emit(index, {"error": str(e)})
+            out.flush()
+    finally:
+        if output:
+            out.close()
+
+    print(f"Batch complete: {counts['analyzed']} analyzed, {counts['failed']} failed", file=sys.stderr)
+    return counts
+
+def memory_components():
+    """What holds this process's memory, by category, for low_memory.memory_report()."""
+    models = {name: model['bytes'] for name, model in registry.stats()['models'].items() if model['resident']}
+    indexes, records = {}, {}
+    for model_type in modality_store.loaded():
+        snapshot = get_modality_data(model_type)
+        indexes[model_type] = snapshot.matrix
+        records[model_type] = snapshot.lookup
+    caches = {'image_embeddings': embedding_cache.cache.memory_bytes()} if embedding_cache else {}
+    return {'models': models, 'indexes': indexes, 'data_frames': records, 'caches': caches}
+
+def handle_request(request):
+    """Serve-mode handler: one image and model_type to one report, or {"stats": true}.
+
+    The image arrives as the frame's binary payload (`image_bytes`), as a
+    shared-memory segment (`shm_name`, optional `shm_size`) or as a file
+    (`image_path`).
+    """
+    if request.get('stats'):
+        return {"modalities": modality_store.stats(), "models": registry.stats(),
+                "memory": low_memory.memory_report(memory_components())}
+    model_type = request.get('model_type')
+    if model_type not in MODALITIES:
+        return {"error": f"model_type must be one of {MODALITIES}"}
+    if request.get('image_bytes'):
+        image = request['image_bytes']
+    elif request.get('shm_name'):
+        from framing import FrameError, read_shared_memory
+        try:
+            image = read_shared_memory(request['shm_name'], request.get('shm_size'))
+        except (OSError, ValueError, FrameError) as e:
+            return {"error": f"Could not read shared memory segment {request['shm_name']}: {e}"}
+    elif request.get('image_path'):
+        image = request['image_path']
+    else:
+        return {"error": "No image provided (payload, shm_name or image_path)"}
+    return run_analysis(image, model_type)
+
+def serve(threads, socket_path=None):
+    """Keeps the models and all modality datasets resident and answers requests."""
+    from serve_utils import serve_json_lines, serve_socket
+
+    loaded = preload_modalities()
+    print(f"Loaded modalities: {', '.join(loaded) or 'none'}", file=sys.stderr)
+    modality_store.start_watching(MODALITY_POLL_SECONDS)
+    # DenseNet serves every uncached request; BLIP stays lazy
+    registry.get('densenet')
+    configure_threads(threads)
+    print("Model ready")
+    print("Waiting for queries...")
+    sys.stdout.flush()
+
+    if socket_path:
+        serve_socket(handle_request, socket_path, threads=threads, required_field=None, payload_field='image_bytes')
+    else:
+        serve_json_lines(handle_request, threads=threads, required_field=None)
+
 # --- Main Execution ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Lightweight Medical Image Analysis Engine")
-    parser.add_argument("--image_path", type=str, required=True, help="Path to the user-uploaded image.")
-    parser.add_argument("--model_type", type=str, required=True, choices=['ct', 'xray', 'mri'], help="Type of medical image.")
+    parser.add_argument("--mode", type=str, choices=['analyze', 'serve', 'batch', 'memory_report'], default='analyze',
+                        help="analyze (one image), serve (persistent server over stdin or --socket), batch (directory/manifest) or memory_report (serve-mode footprint)")
+    parser.add_argument("--image_path", type=str, help="Path to the user-uploaded image, or '-' to read its bytes from stdin.")
+    parser.add_argument("--model_type", type=str, choices=MODALITIES, help="Type of medical image.")
+    parser.add_argument("--threads", type=int, default=1, help="Concurrent analyses in serve mode.")
+    parser.add_argument("--socket", type=str, help="Serve length-prefixed frames on this Unix socket instead of stdin/stdout.")
+    parser.add_argument("--input", type=str, help="Batch mode: image directory, or manifest of paths / JSON lines.")
+    parser.add_argument("--output", type=str, help="Batch mode: JSONL report file (default: stdout).")
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch mode: images per DenseNet forward pass.")
+    parser.add_argument("--workers", type=int, default=2, help="Batch mode: DataLoader decode workers.")
+    parser.add_argument("--trace", type=str, help="Write per-request JSON traces to this JSONL file ('-' for stderr); also IMAGE_TRACE.")
+    parser.add_argument("--profile", type=str, help="Run each request under torch.profiler and export Chrome traces to this directory; also IMAGE_PROFILE_DIR.")
     
     args = parser.parse_args()
+    tracing.configure(args.trace, args.profile)
+
+    if args.mode == 'serve':
+        serve(args.threads, args.socket)
+        sys.exit(0)
+
+    if args.mode == 'memory_report':
+        # What a serve process holds once warm; compare with and without LOW_MEMORY=1
+        preload_modalities()
+        registry.get('densenet')
+        print(json.dumps(low_memory.memory_report(memory_components()), indent=2))
+        sys.exit(0)
+
+    if args.mode == 'batch':
+        if not args.input:
+            parser.error("--input is required in batch mode")
+        run_batch(args.input, args.model_type, args.batch_size, args.workers, args.output)
+        sys.exit(0)
+
+    if not args.image_path or not args.model_type:
+        parser.error("--image_path and --model_type are required in analyze mode")
     
     try:
-        result = run_analysis(args.image_path, args.model_type)
+        image = sys.stdin.buffer.read() if args.image_path == '-' else args.image_path
+        with default_scheduler().job(configure_threads(1)):
+            result = run_analysis(image, args.model_type)
         print(json.dumps(result, indent=2))
     except Exception as e:
         print(json.dumps({"error": f"An unexpected error occurred: {str(e)}"}), file=sys.stderr)
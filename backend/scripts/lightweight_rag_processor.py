@@ -11,20 +11,34 @@ import json
 import os
 import argparse
 import sys
+import threading
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 import re
 from typing import List, Dict, Any
+from cpu_scheduler import default_scheduler
+from serve_utils import configure_threads, default_serve_threads, serve_json_lines, serve_socket
+from sharded_index import CASE_COLUMNS, MANIFEST_NAME, ShardedRetriever, build_shards, rebalance_shards
+import low_memory
 
 class LightweightMedicalRAG:
+    """Template-based RAG over a FAISS index.
+
+    After loading, the instance is only read by queries, so one instance can
+    be shared by a pool of threads. The sentence-transformer's fast tokenizer
+    is not thread-safe, so query encoding is serialized; FAISS search and the
+    rest of the query run concurrently.
+    """
     def __init__(self, data_path: str = "data/raw/patients_data.csv"):
         self.data_path = data_path
         self.df = None
         self.embedder = None
         self.index = None
         self.corpus_embeddings = None
+        self.shards = None
+        self._encode_lock = threading.Lock()
         
-    def load_and_preprocess_data(self):
+    def load_and_preprocess_data(self, max_cases: int = 2000):
         """Load and preprocess the medical dataset - lightweight version"""
         print("Loading medical dataset...")
         
@@ -37,10 +51,10 @@ class LightweightMedicalRAG:
             'Patient id+G9E5A1:G11A1:G1A1:H90': 'Patient id'
         }, inplace=True)
         
-        # Sample data for faster processing (use first 2000 cases)
-        if len(self.df) > 2000:
-            self.df = self.df.head(2000).copy()
-            print(f"Using first 2000 cases for faster processing")
+        # Sample data for faster processing (use first 2000 cases unless sharding)
+        if max_cases and len(self.df) > max_cases:
+            self.df = self.df.head(max_cases).copy()
+            print(f"Using first {max_cases} cases for faster processing")
         
         # Create shorter combined text for faster processing
         self.df["combined_text"] = (
@@ -78,15 +92,24 @@ class LightweightMedicalRAG:
         
         print(f"Created FAISS index with {len(self.corpus_embeddings)} embeddings")
     
+    def encode_query(self, input_text: str) -> np.ndarray:
+        """Encode a query; safe to call from several threads"""
+        with self._encode_lock:
+            return self.embedder.encode([input_text], normalize_embeddings=True)
+    
     def retrieve_similar_cases(self, input_text: str, age: int = None, 
                              gender: str = None, top_n: int = 1) -> List[Dict]:
         """Retrieve similar medical cases - optimized for speed"""
-        input_embedding = self.embedder.encode([input_text], normalize_embeddings=True)
-        D, I = self.index.search(np.array(input_embedding), top_n)
-        candidates = self.df.iloc[I[0]]
+        input_embedding = self.encode_query(input_text)
+        if self.shards is not None:
+            # Scatter to every shard and keep the global top_n
+            rows = [row for _, row in self.shards.search(input_embedding, top_n)]
+        else:
+            D, I = self.index.search(np.array(input_embedding), top_n)
+            rows = [row for _, row in self.df.iloc[I[0]].iterrows()]
         
         result = []
-        for i, (_, row) in enumerate(candidates.iterrows()):
+        for row in rows:
             case_info = {
                 'patient_id': row.get('Patient id', 'Unknown'),
                 'diagnosis': row.get('Diagnosis', 'Unknown'),
@@ -149,10 +172,72 @@ Based on similar medical cases. Follow-up recommended."""
         
         print(f"Lightweight model artifacts saved to {output_dir}")
     
+    def save_sharded_artifacts(self, num_shards: int, output_dir: str = "data/models"):
+        """Partition the corpus into shards, each with its own index and case store"""
+        os.makedirs(output_dir, exist_ok=True)
+        
+        manifest = build_shards(self.df, self.embedder, f"{output_dir}/shards", num_shards)
+        
+        # Save embedder model
+        self.embedder.save(f"{output_dir}/embedder_model/")
+        
+        config = {
+            'embedding_model': 'all-MiniLM-L6-v2',
+            'model_type': 'lightweight',
+            'num_cases': manifest['num_cases'],
+            'embedding_dim': manifest['embedding_dim'],
+            'num_shards': manifest['num_shards']
+        }
+        
+        with open(f"{output_dir}/model_config.json", 'w') as f:
+            json.dump(config, f, indent=2)
+        
+        print(f"Sharded model artifacts ({manifest['num_shards']} shards) saved to {output_dir}")
+    
+    def load_model_artifacts(self, model_dir: str = "data/models", shard_workers: str = "process",
+                             max_resident_shards: int = None, case_columns: List[str] = CASE_COLUMNS):
+        """Load saved model artifacts created by initialization mode.
+
+        The layout that was initialized last (see model_config.json) is served.
+        With thread shard workers, at most `max_resident_shards` shards may be
+        loaded (default: RAG_MAX_RESIDENT_SHARDS, else no cap); an index with
+        more shards is refused, since every query searches all of them. In
+        low-memory mode the case table keeps only `case_columns`; callers that
+        share it with another engine pass the columns both read.
+        """
+        # Load embedder (reduced precision with LOW_MEMORY=1)
+        self.embedder = low_memory.reduce_sentence_embedder(SentenceTransformer(f"{model_dir}/embedder_model/"))
+        
+        # Sharded layout: shards load lazily in their workers on first query
+        if artifact_layout(model_dir) == 'sharded':
+            if max_resident_shards is None and os.environ.get('RAG_MAX_RESIDENT_SHARDS'):
+                max_resident_shards = int(os.environ['RAG_MAX_RESIDENT_SHARDS'])
+            self.shards = ShardedRetriever(f"{model_dir}/shards", workers=shard_workers,
+                                           max_resident=max_resident_shards)
+            return
+        
+        # Load FAISS index (memory-mapped with LOW_MEMORY=1)
+        self.index = low_memory.read_index(f"{model_dir}/faiss_index.bin")
+        
+        # Load processed data; low-memory mode keeps only the columns queries return
+        self.df = low_memory.read_csv(f"{model_dir}/cleaned_patients.csv", case_columns)
+        if low_memory.enabled():
+            low_memory.release_memory()
+    
+    def memory_components(self) -> Dict[str, Dict[str, Any]]:
+        """What holds this processor's memory, by category, for low_memory.memory_report()"""
+        indexes = {'faiss': self.index} if self.index is not None else {}
+        data_frames = {'cases': self.df} if self.df is not None else {}
+        if self.shards is not None:
+            for shard_id, shard in self.shards.resident_shards().items():
+                indexes[f"shard_{shard_id}"] = shard.index
+                data_frames[f"shard_{shard_id}"] = shard.cases
+        return {'models': {'embedder': self.embedder}, 'indexes': indexes, 'data_frames': data_frames}
+    
     def process_medical_query(self, query: str, age: int = None, 
                             gender: str = None) -> Dict[str, Any]:
         """Process a medical query and return structured response"""
-        print(f"Processing query: {query}")
+        print(f"Processing query: {query}", file=sys.stderr)
         
         # Retrieve similar cases
         retrieved_cases = self.retrieve_similar_cases(query, age, gender)
@@ -167,14 +252,34 @@ Based on similar medical cases. Follow-up recommended."""
             'timestamp': pd.Timestamp.now().isoformat()
         }
 
+def artifact_layout(model_dir: str = "data/models") -> str:
+    """'sharded' or 'single': the layout recorded by the last initialization in model_config.json"""
+    config_path = f"{model_dir}/model_config.json"
+    has_manifest = os.path.exists(f"{model_dir}/shards/{MANIFEST_NAME}")
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            config = json.load(f)
+        return 'sharded' if config.get('num_shards') and has_manifest else 'single'
+    return 'sharded' if has_manifest and not os.path.exists(f"{model_dir}/faiss_index.bin") else 'single'
+
 def main():
     """Main function to handle command line arguments"""
     parser = argparse.ArgumentParser(description='Lightweight RAG Medical Assistant')
-    parser.add_argument('--mode', choices=['initialize', 'query', 'serve'], default='initialize',
-                       help='Mode: initialize (create model), query (process query), or serve (persistent server)')
+    parser.add_argument('--mode', choices=['initialize', 'query', 'serve', 'rebalance'], default='initialize',
+                       help='Mode: initialize (create model), query (process query), serve (persistent server), or rebalance (re-cut shards)')
     parser.add_argument('--query', type=str, help='Medical query to process')
     parser.add_argument('--age', type=int, help='Patient age')
     parser.add_argument('--gender', type=str, help='Patient gender')
+    parser.add_argument('--threads', type=int, default=default_serve_threads(),
+                       help='Concurrent queries in serve mode (default: RAG_SERVE_THREADS or CPU count)')
+    parser.add_argument('--socket', type=str,
+                       help='Serve length-prefixed frames on this Unix socket instead of stdin/stdout')
+    parser.add_argument('--shards', type=int, default=1,
+                       help='Number of index shards to build (initialize) or re-cut to (rebalance)')
+    parser.add_argument('--shard_workers', choices=['process', 'thread'], default='process',
+                       help='Search shards in separate local processes or in-process threads')
+    parser.add_argument('--max_resident_shards', type=int,
+                       help='With --shard_workers thread, refuse indexes with more shards than this (default: RAG_MAX_RESIDENT_SHARDS, else no cap)')
     
     args = parser.parse_args()
     
@@ -182,59 +287,69 @@ def main():
         """Initialize and save the lightweight RAG model"""
         processor = LightweightMedicalRAG()
         
-        # Load and preprocess data
-        processor.load_and_preprocess_data()
-        
-        # Create embeddings and index
-        processor.create_embeddings_and_index()
+        # Load and preprocess data; shards exist to hold the whole corpus
+        processor.load_and_preprocess_data(max_cases=None if args.shards > 1 else 2000)
         
-        # Save model artifacts
-        processor.save_model_artifacts()
+        if args.shards > 1:
+            # Embed and write one shard at a time instead of a single index
+            processor.embedder = SentenceTransformer("all-MiniLM-L6-v2")
+            processor.save_sharded_artifacts(args.shards)
+        else:
+            # Create embeddings and index
+            processor.create_embeddings_and_index()
+            
+            # Save model artifacts
+            processor.save_model_artifacts()
         
         print("Lightweight RAG model initialization completed successfully!")
         
+    elif args.mode == 'rebalance':
+        """Re-cut the existing shards into size-balanced shards"""
+        try:
+            manifest = rebalance_shards("data/models/shards", args.shards if args.shards > 1 else None)
+        except FileNotFoundError:
+            print("Error: no sharded index found; run initialization with --shards first")
+            sys.exit(1)
+        # Keep model_config.json in step, so loaders still choose the sharded layout
+        with open("data/models/model_config.json") as f:
+            config = json.load(f)
+        config.update(num_cases=manifest['num_cases'], num_shards=manifest['num_shards'])
+        with open("data/models/model_config.json", 'w') as f:
+            json.dump(config, f, indent=2)
+        print(f"Rebalanced {manifest['num_cases']} cases into {manifest['num_shards']} shards: "
+              f"{[shard['rows'] for shard in manifest['shards']]}")
+        
     elif args.mode == 'serve':
         """Serve mode - keep model loaded and respond to queries"""
         processor = LightweightMedicalRAG()
         
         # Load existing model artifacts
         try:
-            # Load embedder
-            processor.embedder = SentenceTransformer("data/models/embedder_model/")
-            
-            # Load FAISS index
-            processor.index = faiss.read_index("data/models/faiss_index.bin")
+            processor.load_model_artifacts(shard_workers=args.shard_workers,
+                                           max_resident_shards=args.max_resident_shards)
             
-            # Load processed data
-            processor.df = pd.read_csv("data/models/cleaned_patients.csv")
+            configure_threads(args.threads)
             
             print("Model ready")
             print("Waiting for queries...")
+            sys.stdout.flush()
             
-            # Read queries from stdin
-            for line in sys.stdin:
-                try:
-                    query_data = json.loads(line.strip())
-                    query = query_data.get('query', '')
-                    age = query_data.get('age')
-                    gender = query_data.get('gender')
-                    
-                    if query:
-                        result = processor.process_medical_query(query, age, gender)
-                        print(json.dumps(result) + "RESPONSE_END")
-                    else:
-                        print(json.dumps({"error": "No query provided"}) + "RESPONSE_END")
-                        
-                except json.JSONDecodeError:
-                    print(json.dumps({"error": "Invalid JSON input"}) + "RESPONSE_END")
-                except Exception as e:
-                    print(json.dumps({"error": str(e)}) + "RESPONSE_END")
-                    
         except Exception as e:
             print(f"Error loading model artifacts: {e}")
             print("Please run initialization mode first")
             sys.exit(1)
         
+        def handle_query(query_data):
+            return processor.process_medical_query(
+                query_data['query'], query_data.get('age'), query_data.get('gender'))
+        
+        if args.socket:
+            # Framed protocol; many clients may connect and pipeline requests
+            serve_socket(handle_query, args.socket, threads=args.threads)
+        else:
+            # Read queries from stdin, answering up to --threads at a time
+            serve_json_lines(handle_query, threads=args.threads)
+        
     elif args.mode == 'query':
         """Process a medical query"""
         if not args.query:
@@ -245,22 +360,17 @@ def main():
         
         # Load existing model artifacts
         try:
-            # Load embedder
-            processor.embedder = SentenceTransformer("data/models/embedder_model/")
-            
-            # Load FAISS index
-            processor.index = faiss.read_index("data/models/faiss_index.bin")
-            
-            # Load processed data
-            processor.df = pd.read_csv("data/models/cleaned_patients.csv")
+            processor.load_model_artifacts(shard_workers=args.shard_workers,
+                                           max_resident_shards=args.max_resident_shards)
             
         except Exception as e:
             print(f"Error loading model artifacts: {e}")
             print("Please run initialization mode first")
             sys.exit(1)
         
-        # Process query
-        result = processor.process_medical_query(args.query, args.age, args.gender)
+        # Process query, as one job of the node-wide CPU budget
+        with default_scheduler().job(configure_threads(1)):
+            result = processor.process_medical_query(args.query, args.age, args.gender)
         
         # Output JSON result
         print(json.dumps(result))
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Open-loop load generator for the Python serve modes
+Drives the RAG processors and the image analyzer at a fixed arrival rate
+and reports latency, throughput, errors and the saturation point
+"""
+
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(SCRIPTS_DIR)
+RESPONSE_END = "RESPONSE_END"
+
+# Serve-mode scripts and inference-service endpoints for each target
+TARGETS = {
+    'lightweight': {'script': 'lightweight_rag_processor.py', 'endpoint': '/rag/query'},
+    'full': {'script': 'rag_processor.py', 'endpoint': '/rag/full/query'},
+    'router': {'script': 'rag_router.py', 'endpoint': None},
+    'image': {'script': 'lightweight_image_analyzer.py', 'endpoint': '/image/analyze'},
+}
+
+DEFAULT_QUERIES = ['headache', 'fever', 'back pain', 'cough', 'knee pain']
+
+
+class StdinServeConnection:
+    """One `--mode serve` process; requests are pipelined with ids"""
+
+    def __init__(self, script: str, threads: int):
+        self.script = script
+        self.threads = threads
+        self.process = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.ids = itertools.count(1)
+        self.reader_task = None
+
+    async def start(self, ready_timeout: float = 600):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(SCRIPTS_DIR, self.script),
+            '--mode', 'serve', '--threads', str(self.threads),
+            cwd=BACKEND_DIR,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=16 * 1024 * 1024
+        )
+        # Wait for the model to load before offering load
+        while True:
+            line = await asyncio.wait_for(self.process.stdout.readline(), ready_timeout)
+            if not line:
+                raise RuntimeError(f"{self.script} exited before becoming ready")
+            if b"Waiting for queries" in line:
+                break
+        self.reader_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                break
+            text = line.decode(errors='replace').strip()
+            if not text.endswith(RESPONSE_END):
+                continue  # diagnostics printed by the processor
+            try:
+                response = json.loads(text[:-len(RESPONSE_END)])
+            except json.JSONDecodeError:
+                continue
+            future = self.pending.pop(response.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError("serve process exited"))
+        self.pending.clear()
+
+    async def request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.process.stdin.write((json.dumps({**payload, 'id': request_id}) + "\n").encode())
+        await self.process.stdin.drain()
+        try:
+            response = await future
+        finally:
+            self.pending.pop(request_id, None)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    async def close(self):
+        if self.process and self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 10)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+
+class SocketConnection:
+    """One framed Unix-socket connection to a serve process started with --socket"""
+
+    def __init__(self, socket_path: str):
+        from framing import FramedClient
+        self.client = FramedClient(socket_path)
+
+    async def start(self):
+        await self.client.connect()
+
+    async def request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = await self.client.request(payload)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    async def close(self):
+        await self.client.close()
+
+
+class HttpConnection:
+    """Requests to the inference service; each outstanding request holds one pool thread"""
+
+    def __init__(self, url: str, executor: ThreadPoolExecutor):
+        self.url = url
+        self.executor = executor
+
+    async def start(self):
+        pass
+
+    def _post(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        request = urllib.request.Request(
+            self.url, data=json.dumps(payload).encode(),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"HTTP {e.code}: {e.read().decode(errors='replace')[:200]}")
+
+    async def request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._post, payload)
+
+    async def close(self):
+        pass
+
+
+def load_payloads(target: str, query_log: Optional[str], images: Optional[str],
+                  model_type: str) -> List[Tuple[Optional[float], Dict[str, Any]]]:
+    """Return (arrival offset or None, payload) pairs from a query log or defaults.
+
+    Query log lines are JSON objects with the request fields (`query`, `age`,
+    `gender` or `image_path`, `model_type`) and an optional `offset_s`
+    arrival time used for replay.
+    """
+    if query_log:
+        entries = []
+        with open(query_log) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    offset = entry.pop('offset_s', None)
+                    entries.append((float(offset) if offset is not None else None, entry))
+        return entries
+
+    if target == 'image':
+        paths = sorted(glob.glob(images or os.path.join(BACKEND_DIR, 'uploads', '*.jpg')))
+        if not paths:
+            raise ValueError("No images found; pass --images with a glob of test scans")
+        return [(None, {'image_path': os.path.abspath(path), 'model_type': model_type}) for path in paths]
+
+    return [(None, {'query': query}) for query in DEFAULT_QUERIES]
+
+
+def build_schedule(payloads, rate: float, duration: float, replay: bool,
+                   speedup: float, rng: random.Random) -> List[Tuple[float, Dict[str, Any]]]:
+    """Arrival times for one step: replayed offsets or a Poisson process"""
+    if replay:
+        payloads = sorted(payloads, key=lambda entry: entry[0])
+        base = payloads[0][0]
+        return [((offset - base) / speedup, payload) for offset, payload in payloads
+                if (offset - base) / speedup <= duration]
+
+    schedule = []
+    now = rng.expovariate(rate)
+    cycle = itertools.cycle(payload for _, payload in payloads)
+    while now < duration:
+        schedule.append((now, next(cycle)))
+        now += rng.expovariate(rate)
+    return schedule
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(offered_rate: Optional[float], samples: List[Tuple[float, bool, str]],
+              schedule_span: float, elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(latency for latency, ok, _ in samples if ok)
+    errors = [message for _, ok, message in samples if not ok]
+    summary = {
+        'offered_rate': offered_rate,
+        # Realized arrival rate of the sampled schedule
+        'arrival_rate': len(samples) / schedule_span if schedule_span > 0 else 0.0,
+        'requests': len(samples),
+        'completed': len(latencies),
+        'errors': len(errors),
+        'error_rate': len(errors) / len(samples) if samples else 0.0,
+        'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else None,
+            **{name: (percentile(latencies, fraction) * 1000 if latencies else None)
+               for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))}
+        }
+    }
+    if errors:
+        summary['sample_errors'] = sorted(set(errors))[:5]
+    return summary
+
+
+async def run_step(connections, schedule, timeout: float) -> Tuple[List[Tuple[float, bool, str]], float]:
+    """Fire requests at their scheduled times regardless of outstanding ones.
+
+    Latency is measured from the scheduled arrival, so time spent queued
+    behind earlier requests counts against the system under test.
+    """
+    loop = asyncio.get_running_loop()
+    samples: List[Tuple[float, bool, str]] = []
+    round_robin = itertools.cycle(connections)
+
+    async def issue(connection, payload, scheduled: float):
+        try:
+            await asyncio.wait_for(connection.request(payload), timeout)
+            samples.append((loop.time() - scheduled, True, ''))
+        except asyncio.TimeoutError:
+            samples.append((loop.time() - scheduled, False, 'timeout'))
+        except Exception as e:
+            samples.append((loop.time() - scheduled, False, str(e)))
+
+    start = loop.time()
+    tasks = []
+    for offset, payload in schedule:
+        delay = start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(issue(next(round_robin), payload, start + offset)))
+    await asyncio.gather(*tasks)
+    return samples, loop.time() - start
+
+
+def find_saturation(steps: List[Dict[str, Any]], slo_ms: Optional[float]) -> Optional[Dict[str, Any]]:
+    """First offered rate the target could not keep up with.
+
+    A step is saturated when throughput falls below 90% of the arrival rate,
+    errors exceed 1%, or p99 latency breaks the SLO.
+    """
+    for step in steps:
+        reasons = []
+        if step['throughput'] < 0.9 * step['arrival_rate']:
+            reasons.append('throughput')
+        if step['error_rate'] > 0.01:
+            reasons.append('errors')
+        p99 = step['latency_ms']['p99']
+        if slo_ms is not None and (p99 is None or p99 > slo_ms):
+            reasons.append('p99_slo')
+        if reasons:
+            return {'offered_rate': step['offered_rate'], 'reasons': reasons}
+    return None
+
+
+async def run(args) -> Dict[str, Any]:
+    target = TARGETS[args.target]
+    payloads = load_payloads(args.target, args.query_log, args.images, args.model_type)
+    if args.replay and not all(offset is not None for offset, _ in payloads):
+        raise ValueError("--replay needs a --query_log whose every entry has offset_s")
+    replay = args.replay
+    rng = random.Random(args.seed)
+
+    rates = [None] if replay else [float(rate) for rate in args.rates.split(',')]
+    schedules = [build_schedule(payloads, rate, args.duration, replay, args.speedup, rng) for rate in rates]
+
+    if args.transport == 'socket' and not args.socket_path:
+        raise ValueError("--socket_path is required for --transport socket")
+
+    executor = None
+    if args.transport == 'stdin':
+        if not target['script']:
+            raise ValueError(f"Target '{args.target}' has no stdin serve mode; use --transport http")
+        connections = [StdinServeConnection(target['script'], args.threads) for _ in range(args.connections)]
+    elif args.transport == 'socket':
+        connections = [SocketConnection(args.socket_path) for _ in range(args.connections)]
+    else:
+        if not target['endpoint']:
+            raise ValueError(f"Target '{args.target}' is not hosted by the inference service")
+        # Open loop: every scheduled request may be outstanding at once, so the
+        # pool must never hold a send back behind earlier, slower requests
+        outstanding = max((len(schedule) for schedule in schedules), default=1)
+        if outstanding > args.max_outstanding:
+            print(f"Warning: up to {outstanding} requests may be outstanding but the HTTP pool is capped at "
+                  f"{args.max_outstanding}; sends beyond that wait client-side", file=sys.stderr)
+        executor = ThreadPoolExecutor(max_workers=max(1, min(outstanding, args.max_outstanding)))
+        url = args.service_url.rstrip('/') + target['endpoint']
+        connections = [HttpConnection(url, executor)]
+
+    print(f"Starting {len(connections)} {args.transport} connection(s) to {args.target}...", file=sys.stderr)
+    await asyncio.gather(*(connection.start() for connection in connections))
+
+    steps = []
+    try:
+        for rate, schedule in zip(rates, schedules):
+            samples, elapsed = await run_step(connections, schedule, args.timeout)
+            schedule_span = args.duration if rate is not None else (schedule[-1][0] if schedule else 0.0)
+            step = summarize(rate, samples, schedule_span, elapsed)
+            steps.append(step)
+            latency = step['latency_ms']
+            print(f"rate={rate} sent={step['requests']} throughput={step['throughput']:.2f}/s "
+                  f"errors={step['error_rate']:.1%} p50={latency['p50']} p99={latency['p99']}", file=sys.stderr)
+    finally:
+        await asyncio.gather(*(connection.close() for connection in connections))
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    return {
+        'target': args.target,
+        'transport': args.transport,
+        'connections': len(connections),
+        'threads_per_connection': args.threads if args.transport == 'stdin' else None,
+        'arrival': 'replay' if replay else 'poisson',
+        'duration_s': args.duration,
+        'steps': steps,
+        'saturation': find_saturation(steps, args.slo_ms),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def main():
+    """Main function to handle command line arguments"""
+    parser = argparse.ArgumentParser(description='Open-loop load generator for the Python serve modes')
+    parser.add_argument('--target', choices=list(TARGETS), default='lightweight', help='Engine to load')
+    parser.add_argument('--transport', choices=['stdin', 'socket', 'http'], default='stdin',
+                        help='Spawn serve-mode processes (stdin), connect to a --socket serve process, '
+                             'or call the inference service (http)')
+    parser.add_argument('--socket_path', type=str, help='Unix socket of a serve process for --transport socket')
+    parser.add_argument('--service_url', type=str, default='http://127.0.0.1:8001', help='Inference service base URL')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='Serve processes (stdin) or socket connections')
+    parser.add_argument('--max_outstanding', type=int, default=1024,
+                        help='Cap on concurrent in-flight HTTP requests (the pool is sized to the schedule up to this)')
+    parser.add_argument('--threads', type=int, default=1, help='--threads passed to each serve process')
+    parser.add_argument('--rates', type=str, default='1,2,4,8', help='Comma-separated arrival rates (req/s) to sweep')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load per rate step')
+    parser.add_argument('--query_log', type=str, help='JSONL file of requests to send instead of the defaults')
+    parser.add_argument('--replay', action='store_true', help="Replay the query log's offset_s arrival times")
+    parser.add_argument('--speedup', type=float, default=1.0, help='Time compression factor for replay')
+    parser.add_argument('--images', type=str, help='Glob of images for the image target')
+    parser.add_argument('--model_type', choices=['ct', 'xray', 'mri'], default='xray', help='Modality for image requests')
+    parser.add_argument('--timeout', type=float, default=120, help='Per-request timeout in seconds')
+    parser.add_argument('--slo_ms', type=float, help='p99 latency objective used to detect saturation')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for Poisson arrivals')
+    parser.add_argument('--output', type=str, help='Write the JSON report here instead of stdout')
+
+    args = parser.parse_args()
+
+    try:
+        rates = [float(rate) for rate in args.rates.split(',')]
+    except ValueError:
+        parser.error(f"--rates must be comma-separated numbers, got '{args.rates}'")
+    if any(rate <= 0 for rate in rates):
+        parser.error("--rates must all be greater than 0")
+    if args.speedup <= 0:
+        parser.error("--speedup must be greater than 0")
+    if args.duration <= 0:
+        parser.error("--duration must be greater than 0")
+    if args.max_outstanding < 1:
+        parser.error("--max_outstanding must be at least 1")
+    if args.replay and not args.query_log:
+        parser.error("--replay needs --query_log")
+    if args.query_log:
+        try:
+            with open(args.query_log) as f:
+                if not any(line.strip() for line in f):
+                    parser.error(f"--query_log {args.query_log} has no requests")
+        except OSError as e:
+            parser.error(f"cannot read --query_log: {e}")
+
+    try:
+        report = asyncio.run(run(args))
+    except (ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
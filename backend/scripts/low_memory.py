@@ -0,0 +1,239 @@
+"""
+Low-memory operating mode and a per-component resident memory report
+LOW_MEMORY=1 trades a little numerical precision for a smaller footprint, so
+more model processes fit on one node: weights load in LOW_MEMORY_DTYPE
+(bfloat16 by default, and only where the CPU has bf16 kernels; otherwise they
+stay float32), transformers models load without a second full-precision copy,
+submodules inference never calls are dropped, FAISS indexes are memory-mapped
+(so processes on a node share their pages), data frames keep only the
+columns queries read, and freed heap is returned to the OS after each load.
+`memory_report()` breaks the process's resident memory down into models,
+indexes, data frames and caches.
+"""
+
+import ctypes
+import gc
+import os
+import sys
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+DTYPES = ['bfloat16', 'float16', 'float32']
+CATEGORIES = ['models', 'indexes', 'data_frames', 'caches']
+
+_warned = set()
+
+
+def enabled() -> bool:
+    return os.environ.get('LOW_MEMORY', '').lower() in ('1', 'true', 'yes')
+
+
+def _warn_once(message: str):
+    if message not in _warned:
+        _warned.add(message)
+        print(f"Warning: {message}", file=sys.stderr)
+
+
+def _cpu_supports_bf16() -> bool:
+    import torch
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def weight_dtype():
+    """The torch dtype model weights load in, or None for float32 (low-memory mode off or unsupported)"""
+    if not enabled():
+        return None
+    name = os.environ.get('LOW_MEMORY_DTYPE', 'bfloat16')
+    if name not in DTYPES:
+        raise ValueError(f"Unknown LOW_MEMORY_DTYPE '{name}'; choose from {DTYPES}")
+    if name == 'float32':
+        return None
+    if name == 'bfloat16' and not _cpu_supports_bf16():
+        _warn_once("this CPU has no bfloat16 kernels; low-memory mode keeps float32 weights")
+        return None
+    import torch
+    return getattr(torch, name)
+
+
+def version_suffix() -> str:
+    """Appended to model versions of caches, so reduced-precision results are kept apart"""
+    dtype = weight_dtype()
+    return f"+{str(dtype).replace('torch.', '')}" if dtype is not None else ""
+
+
+def pretrained_kwargs(default_dtype=None) -> Dict[str, Any]:
+    """from_pretrained arguments: the reduced dtype and a single-copy load in low-memory mode"""
+    if not enabled():
+        return {'torch_dtype': default_dtype} if default_dtype is not None else {}
+    import torch
+    return {'torch_dtype': weight_dtype() or default_dtype or torch.float32, 'low_cpu_mem_usage': True}
+
+
+def drop_submodules(model: Any, names: Iterable[str]) -> List[str]:
+    """Set the dotted submodules in `names` to None where present; returns the ones dropped"""
+    dropped = []
+    for name in names:
+        parent_name, _, attr = name.rpartition('.')
+        parent = model
+        for part in filter(None, parent_name.split('.')):
+            parent = getattr(parent, part, None)
+        if parent is not None and getattr(parent, attr, None) is not None:
+            setattr(parent, attr, None)
+            dropped.append(name)
+    return dropped
+
+
+def reduce_module(model: Any) -> Any:
+    """Inference-only module in the low-memory dtype (unchanged when the mode is off)"""
+    if not enabled():
+        return model
+    model.eval()
+    model.requires_grad_(False)
+    dtype = weight_dtype()
+    return model.to(dtype) if dtype is not None else model
+
+
+def cast_inputs(run: Callable, dtype) -> Callable:
+    """Wrap an embedding function so it takes and returns float32 around a reduced-precision model"""
+    def reduced(batch):
+        return run(batch.to(dtype)).float()
+    reduced.module = getattr(run, 'module', None)
+    return reduced
+
+
+def reduce_sentence_embedder(embedder: Any) -> Any:
+    """Low-memory SentenceTransformer: reduced dtype, no unused BERT pooler, float32 embeddings out"""
+    if not enabled():
+        return embedder
+    # Sentence embeddings come from the pooling module; the BERT pooler output is never read
+    drop_submodules(embedder[0], ['auto_model.pooler'])
+    dtype = weight_dtype()
+    reduce_module(embedder)
+    if dtype is not None:
+        # Callers build FAISS queries from these; hand them back in float32
+        def to_float(module, inputs, features):
+            features['sentence_embedding'] = features['sentence_embedding'].float()
+            return features
+        embedder[-1].register_forward_hook(to_float)
+    release_memory()
+    return embedder
+
+
+def read_csv(path: str, columns: Iterable[str]):
+    """pd.read_csv; in low-memory mode only `columns` are kept and repeated strings become categories"""
+    import pandas as pd
+    if not enabled():
+        return pd.read_csv(path)
+    wanted = set(columns)
+    df = pd.read_csv(path, usecols=lambda column: column in wanted)
+    for column in df.columns:
+        if pd.api.types.is_string_dtype(df[column]) and df[column].nunique() < len(df) // 2:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def read_index(path: str):
+    """faiss.read_index, memory-mapped in low-memory mode"""
+    import faiss
+    if enabled():
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+        except RuntimeError:
+            # Index types (or FAISS builds) without mmap support load into memory
+            pass
+    return faiss.read_index(path)
+
+
+def release_memory():
+    """Collect garbage and hand freed heap pages back to the OS (glibc only)"""
+    gc.collect()
+    if sys.platform.startswith('linux'):
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+def _faiss_bytes(index: Any) -> int:
+    # Stored codes only; graph links and inverted-list overhead are not counted
+    code_size = getattr(index, 'code_size', None) or index.d * 4
+    return int(index.ntotal * code_size)
+
+
+def _object_bytes(value: Any, seen: set) -> int:
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_object_bytes(k, seen) + _object_bytes(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_object_bytes(item, seen) for item in value)
+    elif hasattr(value, '__dict__'):
+        size += _object_bytes(vars(value), seen)
+    return size
+
+
+def component_bytes(value: Any) -> int:
+    """Best estimate of the memory an object holds: torch modules, FAISS indexes, arrays, frames or plain objects"""
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    if hasattr(value, 'memory_usage') and hasattr(value, 'columns'):
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if hasattr(value, 'ntotal') and hasattr(value, 'd'):
+        return _faiss_bytes(value)
+    from model_registry import resident_bytes
+    model_bytes = resident_bytes(value)
+    if model_bytes:
+        return model_bytes
+    return _object_bytes(value, set())
+
+
+def _status_kb(field: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def process_rss() -> Dict[str, Optional[int]]:
+    """Current and peak resident set size in bytes"""
+    import resource
+    current = _status_kb('VmRSS')
+    # ru_maxrss is KiB on Linux
+    peak = _status_kb('VmHWM') or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'rss_bytes': current * 1024 if current is not None else None, 'peak_rss_bytes': peak * 1024}
+
+
+def memory_report(components: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Resident memory broken down by component.
+
+    `components` maps a category (models, indexes, data_frames, caches) to
+    {name: object or byte count}. Whatever the components do not account for
+    (interpreter, libraries, allocator slack, transient buffers) is reported
+    as `unaccounted_bytes`.
+    """
+    breakdown = {}
+    for category in CATEGORIES:
+        sizes = {name: component_bytes(value) for name, value in components.get(category, {}).items()}
+        breakdown[category] = {'total_bytes': sum(sizes.values()), 'items': sizes}
+    accounted = sum(category['total_bytes'] for category in breakdown.values())
+    rss = process_rss()
+    return {
+        'low_memory': enabled(),
+        'weight_dtype': version_suffix().lstrip('+') or 'float32',
+        **rss,
+        'components': breakdown,
+        'accounted_bytes': accounted,
+        'unaccounted_bytes': rss['rss_bytes'] - accounted if rss['rss_bytes'] is not None else None
+    }
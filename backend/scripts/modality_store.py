@@ -0,0 +1,166 @@
+"""
+Hot-reloadable per-modality data for the image analyzers
+Each modality's loaded data (diagnosis matrix and lookup) is held as an
+immutable snapshot. A watcher thread polls the source files and, when one
+changes, builds a new snapshot in the background and swaps it in with a
+single assignment. Requests keep the snapshot they started with, so a reload
+never mixes old and new data inside one analysis. A failed rebuild leaves
+the current snapshot serving and is reported in `stats()`.
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+# Files whose changes trigger a rebuild, relative to the modality directory.
+# diagnosis_lookup.json is derived from patient_data.json, so it is not watched.
+WATCHED_FILES = (
+    os.path.join('diagnosis_embeddings', 'meta.json'),
+    os.path.join('diagnosis_embeddings', 'embeddings.npy'),
+    os.path.join('diagnosis_embeddings', 'labels.json'),
+    os.path.join('diagnosis_exemplars', 'meta.json'),
+    os.path.join('diagnosis_exemplars', 'index.faiss'),
+    'diagnosis_image_embeddings.pkl',
+    'patient_data.json',
+)
+
+
+class Snapshot:
+    """One loaded version of a modality's data"""
+
+    def __init__(self, version: int, data: Tuple[Any, Any], signature: Tuple, load_seconds: float):
+        self.version = version
+        self.matrix, self.lookup = data
+        self.signature = signature
+        self.loaded_at = time.time()
+        self.load_seconds = load_seconds
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'diagnoses': len(self.matrix),
+            # Exemplar indexes hold several reference embeddings per diagnosis
+            'embeddings': getattr(self.matrix, 'count', len(self.matrix)),
+            'records': len(self.lookup),
+            'matrix_bytes': self.matrix.nbytes,
+            'loaded_at': self.loaded_at,
+            'load_seconds': round(self.load_seconds, 3)
+        }
+
+
+class ModalityStore:
+    """Snapshots of every modality, rebuilt in the background when their files change"""
+
+    def __init__(self, data_root: str, loader: Callable[[str], Tuple[Any, Any]]):
+        self.data_root = data_root
+        self.loader = loader
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._errors: Dict[str, str] = {}
+        # Signature of files that failed to load, so a broken update is not retried every poll
+        self._failed: Dict[str, Tuple] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def signature(self, modality: str) -> Tuple:
+        """(mtime_ns, size) of each watched file; missing files count as None"""
+        modality_dir = os.path.join(self.data_root, modality)
+        signature = []
+        for name in WATCHED_FILES:
+            try:
+                stat = os.stat(os.path.join(modality_dir, name))
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _load_lock(self, modality: str) -> threading.Lock:
+        with self._lock:
+            return self._load_locks.setdefault(modality, threading.Lock())
+
+    def _build(self, modality: str) -> Snapshot:
+        # Caller holds the modality's load lock; the swap itself is one assignment
+        signature = self.signature(modality)
+        start = time.perf_counter()
+        data = self.loader(modality)
+        with self._lock:
+            previous = self._snapshots.get(modality)
+            snapshot = Snapshot(previous.version + 1 if previous else 1, data, signature,
+                                time.perf_counter() - start)
+            self._snapshots[modality] = snapshot
+            self._errors.pop(modality, None)
+        if previous is not None:
+            print(f"Reloaded {modality} data as version {snapshot.version}", file=sys.stderr)
+        return snapshot
+
+    def load(self, modality: str) -> Snapshot:
+        """Build and swap in a new snapshot; raises if loading fails"""
+        with self._load_lock(modality):
+            return self._build(modality)
+
+    def get(self, modality: str) -> Snapshot:
+        """The current snapshot, loading it synchronously the first time"""
+        snapshot = self._snapshots.get(modality)
+        if snapshot is not None:
+            return snapshot
+        with self._load_lock(modality):
+            return self._snapshots.get(modality) or self._build(modality)
+
+    def preload(self, modalities: Iterable[str]) -> Dict[str, str]:
+        """Load each modality; returns {modality: error} for the ones that failed"""
+        failures = {}
+        for modality in modalities:
+            try:
+                self.get(modality)
+            except Exception as e:
+                failures[modality] = str(e)
+                with self._lock:
+                    self._errors[modality] = str(e)
+        return failures
+
+    def check(self):
+        """Rebuild every loaded modality whose files have changed"""
+        for modality, snapshot in list(self._snapshots.items()):
+            signature = self.signature(modality)
+            if signature == snapshot.signature or signature == self._failed.get(modality):
+                continue
+            try:
+                self.load(modality)
+                self._failed.pop(modality, None)
+            except Exception as e:
+                # Keep serving the old snapshot until the files are fixed
+                with self._lock:
+                    self._errors[modality] = str(e)
+                self._failed[modality] = signature
+                print(f"Reload of {modality} data failed, keeping version {snapshot.version}: {e}",
+                      file=sys.stderr)
+
+    def start_watching(self, interval: float = 5.0):
+        """Poll the source files every `interval` seconds on a daemon thread"""
+        if self._watcher is not None:
+            return
+
+        def watch():
+            while not self._stop.wait(interval):
+                self.check()
+
+        self._watcher = threading.Thread(target=watch, name="modality-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def loaded(self) -> Iterable[str]:
+        return sorted(self._snapshots)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshots = dict(self._snapshots)
+            errors = dict(self._errors)
+        stats = {modality: snapshot.describe() for modality, snapshot in snapshots.items()}
+        for modality, error in errors.items():
+            stats.setdefault(modality, {})['last_error'] = error
+        return stats
@@ -0,0 +1,182 @@
+"""
+Lazy model registry with a resident-memory budget
+Models are registered with a loader and loaded on first use. The registry
+records each model's resident size (parameter and buffer bytes of the torch
+modules it holds) and, when the total exceeds the budget, evicts the least
+recently used models that are not in use. Load and eviction events are
+logged to stderr and kept for `stats()`.
+"""
+
+import gc
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import low_memory
+
+
+def resident_bytes(value: Any) -> int:
+    """Parameter and buffer bytes of the torch modules in `value` (shared tensors counted once)"""
+    seen = set()
+    total = 0
+
+    def visit(obj: Any):
+        nonlocal total
+        if obj is None or id(obj) in seen:
+            return
+        seen.add(id(obj))
+        if hasattr(obj, 'parameters') and hasattr(obj, 'buffers'):
+            for tensor in list(obj.parameters()) + list(obj.buffers()):
+                if tensor.data_ptr() not in seen:
+                    seen.add(tensor.data_ptr())
+                    total += tensor.numel() * tensor.element_size()
+        elif isinstance(obj, dict):
+            for item in obj.values():
+                visit(item)
+        elif isinstance(obj, (list, tuple)):
+            for item in obj:
+                visit(item)
+        elif hasattr(obj, 'model'):
+            # transformers pipelines and inference wrappers hold their module here
+            visit(obj.model)
+        elif hasattr(obj, 'module'):
+            visit(obj.module)
+
+    visit(value)
+    return total
+
+
+def default_budget_bytes() -> Optional[int]:
+    """MODEL_MEMORY_BUDGET_MB, or no budget"""
+    configured = os.environ.get('MODEL_MEMORY_BUDGET_MB')
+    return int(float(configured) * 1024 * 1024) if configured else None
+
+
+class _Entry:
+    def __init__(self, loader: Callable[[], Any], pinned: bool):
+        self.loader = loader
+        self.pinned = pinned
+        self.value = None
+        self.size = 0
+        self.in_use = 0
+        self.loads = 0
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Loads registered models on demand and keeps them within a memory budget"""
+
+    def __init__(self, budget_bytes: Optional[int] = None, max_events: int = 100):
+        self.budget_bytes = budget_bytes
+        self._entries: Dict[str, _Entry] = {}
+        # Resident models, least recently used first
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+
+    def register(self, name: str, loader: Callable[[], Any], pinned: bool = False):
+        """Add a model; `pinned` models are never evicted"""
+        self._entries[name] = _Entry(loader, pinned)
+
+    def _log(self, event: str, name: str, **fields):
+        record = {'event': event, 'model': name, 'time': time.time(), **fields}
+        self.events.append(record)
+        print(f"[model-registry] {json.dumps(record)}", file=sys.stderr)
+
+    def get(self, name: str) -> Any:
+        """The loaded model, loading it (and evicting others if over budget) on first use"""
+        entry = self._entries[name]
+        while True:
+            with self._lock:
+                # Checked and returned under the lock: another thread may evict the model between
+                # its load and this point, in which case it is loaded again
+                if entry.value is not None:
+                    self._lru.move_to_end(name)
+                    return entry.value
+
+            with entry.load_lock:
+                if entry.value is None:
+                    start = time.perf_counter()
+                    value = entry.loader()
+                    if low_memory.enabled():
+                        # Hand back the loader's transient buffers (checkpoint state dicts, fp32 copies)
+                        low_memory.release_memory()
+                    size = resident_bytes(value)
+                    with self._lock:
+                        entry.value, entry.size = value, size
+                        entry.loads += 1
+                        self._lru[name] = None
+                    self._log('load', name, bytes=size, seconds=round(time.perf_counter() - start, 3),
+                              loads=entry.loads)
+                    self._enforce_budget(keep=name)
+
+    @contextmanager
+    def use(self, name: str):
+        """Hold a model for the duration of a call so it cannot be evicted mid-use"""
+        entry = self._entries[name]
+        with self._lock:
+            entry.in_use += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+
+    def _enforce_budget(self, keep: str):
+        if self.budget_bytes is None:
+            return
+        evicted = []
+        with self._lock:
+            total = sum(self._entries[name].size for name in self._lru)
+            for name in list(self._lru):
+                if total <= self.budget_bytes:
+                    break
+                entry = self._entries[name]
+                if name == keep or entry.pinned or entry.in_use:
+                    continue
+                total -= entry.size
+                evicted.append((name, entry.size))
+                entry.value, entry.size = None, 0
+                del self._lru[name]
+        for name, size in evicted:
+            self._log('evict', name, bytes=size, reason='budget')
+        if evicted:
+            gc.collect()
+        if total > self.budget_bytes:
+            self._log('over_budget', keep, bytes=total, budget_bytes=self.budget_bytes)
+
+    def release(self, name: str):
+        """Drop a model now; it is reloaded on next use"""
+        with self._lock:
+            entry = self._entries[name]
+            if entry.value is None:
+                return
+            size = entry.size
+            entry.value, entry.size = None, 0
+            self._lru.pop(name, None)
+        self._log('evict', name, bytes=size, reason='release')
+        gc.collect()
+
+    def preload(self, names: Iterable[str]):
+        for name in names:
+            self.get(name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = {
+                name: {'resident': entry.value is not None, 'bytes': entry.size, 'loads': entry.loads,
+                       'in_use': entry.in_use, 'pinned': entry.pinned}
+                for name, entry in self._entries.items()
+            }
+            return {
+                'budget_bytes': self.budget_bytes,
+                'resident_bytes': sum(self._entries[name].size for name in self._lru),
+                'lru_order': list(self._lru),
+                'models': models,
+                'events': list(self.events)
+            }
@@ -12,15 +12,31 @@ import os
 import pickle
 import argparse
 import sys
+import threading
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 import re
 from typing import List, Dict, Any
+from cpu_scheduler import default_scheduler
+from serve_utils import configure_threads, default_serve_threads, serve_json_lines, serve_socket
+import low_memory
+
+# Case columns retrieval reads (all that low-memory mode loads)
+CASE_COLUMNS = ['Patient id', 'Age', 'Diagnosis', 'Treatment plan', 'Medications prescribed', 'combined_text']
 
 class MedicalRAGProcessor:
-    def __init__(self, data_path: str = "data/raw/patients_data.csv"):
+    """Retrieval plus BioGPT generation.
+
+    Loaded state is read-only during queries, so one instance can serve a
+    pool of threads: all per-request data lives in local variables, and FAISS
+    search runs concurrently. Sentence encoding and BioGPT tokenization are
+    serialized because fast tokenizers are not thread-safe, and at most
+    `generation_slots` generations run at once (each already uses the torch
+    intra-op pool); further requests wait for a slot.
+    """
+    def __init__(self, data_path: str = "data/raw/patients_data.csv", generation_slots: int = 1):
         self.data_path = data_path
         self.df = None
         self.embedder = None
@@ -28,6 +44,9 @@ class MedicalRAGProcessor:
         self.tokenizer = None
         self.model = None
         self.corpus_embeddings = None
+        self._encode_lock = threading.Lock()
+        self._tokenizer_lock = threading.Lock()
+        self._generation_slots = threading.Semaphore(max(1, generation_slots))
         
     def load_and_preprocess_data(self):
         """Load and preprocess the medical dataset"""
@@ -79,26 +98,33 @@ class MedicalRAGProcessor:
         print("Loading BioGPT model...")
         
         self.tokenizer = AutoTokenizer.from_pretrained("microsoft/BioGPT")
-        self.model = AutoModelForCausalLM.from_pretrained("microsoft/BioGPT")
+        self.model = AutoModelForCausalLM.from_pretrained("microsoft/BioGPT", **low_memory.pretrained_kwargs())
+        self.model = low_memory.reduce_module(self.model)
         
         print("BioGPT model loaded successfully")
     
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Encode texts with the sentence embedder; safe to call from several threads"""
+        with self._encode_lock:
+            return self.embedder.encode(texts)
+    
     def retrieve_similar_cases(self, input_text: str, age: int = None, 
                              gender: str = None, top_n: int = 3, filter_top: int = 2) -> List[Dict]:
         """Retrieve similar medical cases based on input - optimized for speed"""
         # Reduced top_n for faster processing
-        input_embedding = self.embedder.encode([input_text])
+        input_embedding = self.encode_texts([input_text])
         D, I = self.index.search(np.array(input_embedding), top_n * 2)  # Reduced multiplier
         candidates = self.df.iloc[I[0]]
         
+        # Encode all candidates in one batch for the semantic score
+        candidate_embeddings = self.encode_texts(candidates['combined_text'].tolist())
+        semantic_scores = cosine_similarity([input_embedding[0]], candidate_embeddings)[0]
+        
         # Score with combined age and semantic similarity
         result = []
-        for _, row in candidates.iterrows():
+        for (_, row), semantic_score in zip(candidates.iterrows(), semantic_scores):
             # Basic semantic similarity
-            semantic_score = float(cosine_similarity(
-                [input_embedding[0]],
-                [self.embedder.encode([row['combined_text']])[0]]
-            )[0][0])
+            semantic_score = float(semantic_score)
             
             # Apply age penalty if we have age data
             age_factor = 1.0
@@ -128,23 +154,32 @@ class MedicalRAGProcessor:
         result.sort(key=lambda x: x['similarity_score'], reverse=True)
         return result[:filter_top]  # Return fewer cases for faster processing
     
-    def generate_response(self, prompt: str, retrieved_cases: List[Dict] = None) -> str:
-        """Generate response using BioGPT model - optimized for speed"""
-        inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512)  # Reduced max_length
+    def generate_response(self, prompt: str, retrieved_cases: List[Dict] = None,
+                          max_time: float = None) -> str:
+        """Generate response using BioGPT model - optimized for speed
+
+        `max_time` caps generation in seconds; a cut-short answer falls back
+        to the retrieved-case template in format_response.
+        """
+        with self._tokenizer_lock:
+            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512)  # Reduced max_length
         
         # Use faster generation settings
-        outputs = self.model.generate(
-            **inputs,
-            max_new_tokens=300,  # Reduced for faster generation
-            num_beams=2,  # Reduced beam search
-            temperature=0.7,
-            top_p=0.9,
-            do_sample=True,
-            no_repeat_ngram_size=2,
-            early_stopping=True  # Stop early for faster generation
-        )
-        
-        raw_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        with self._generation_slots:
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=300,  # Reduced for faster generation
+                num_beams=2,  # Reduced beam search
+                temperature=0.7,
+                top_p=0.9,
+                do_sample=True,
+                no_repeat_ngram_size=2,
+                early_stopping=True,  # Stop early for faster generation
+                max_time=max_time
+            )
+        
+        with self._tokenizer_lock:
+            raw_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
         return self.format_response(raw_response, prompt, retrieved_cases)
     
     def format_response(self, raw_response: str, original_prompt: str, 
@@ -234,17 +269,36 @@ Follow-up recommended."""
         
         print(f"Model artifacts saved to {output_dir}")
     
+    def load_model_artifacts(self, model_dir: str = "data/models", load_generator: bool = True):
+        """Load saved retrieval artifacts and, optionally, the BioGPT generator"""
+        self.embedder = low_memory.reduce_sentence_embedder(SentenceTransformer(f"{model_dir}/embedder_model/"))
+        self.index = low_memory.read_index(f"{model_dir}/faiss_index.bin")
+        self.df = low_memory.read_csv(f"{model_dir}/cleaned_patients.csv", CASE_COLUMNS)
+        
+        if load_generator:
+            self.load_bio_gpt_model()
+        if low_memory.enabled():
+            low_memory.release_memory()
+    
+    def memory_components(self) -> Dict[str, Dict[str, Any]]:
+        """What holds this processor's memory, by category, for low_memory.memory_report()"""
+        return {
+            'models': {'embedder': self.embedder, 'generator': self.model},
+            'indexes': {'faiss': self.index},
+            'data_frames': {'cases': self.df}
+        }
+    
     def process_medical_query(self, query: str, age: int = None, 
-                            gender: str = None) -> Dict[str, Any]:
+                            gender: str = None, max_time: float = None) -> Dict[str, Any]:
         """Process a medical query and return structured response"""
-        print(f"Processing query: {query}")
+        print(f"Processing query: {query}", file=sys.stderr)
         
         # Retrieve similar cases
         retrieved_cases = self.retrieve_similar_cases(query, age, gender)
         
         # Generate response
         prompt = f"Patient query: {query}. Based on similar medical cases, provide a diagnosis and treatment plan."
-        response = self.generate_response(prompt, retrieved_cases)
+        response = self.generate_response(prompt, retrieved_cases, max_time=max_time)
         
         return {
             'query': query,
@@ -256,11 +310,15 @@ Follow-up recommended."""
 def main():
     """Main function to handle command line arguments"""
     parser = argparse.ArgumentParser(description='RAG Medical Assistant')
-    parser.add_argument('--mode', choices=['initialize', 'query', 'preload'], default='initialize',
-                       help='Mode: initialize (create model), query (process query), or preload (load model)')
+    parser.add_argument('--mode', choices=['initialize', 'query', 'preload', 'serve'], default='initialize',
+                       help='Mode: initialize (create model), query (process query), preload (load model), or serve (persistent server)')
     parser.add_argument('--query', type=str, help='Medical query to process')
     parser.add_argument('--age', type=int, help='Patient age')
     parser.add_argument('--gender', type=str, help='Patient gender')
+    parser.add_argument('--threads', type=int, default=default_serve_threads(),
+                       help='Concurrent queries in serve mode (default: RAG_SERVE_THREADS or CPU count)')
+    parser.add_argument('--socket', type=str,
+                       help='Serve length-prefixed frames on this Unix socket instead of stdin/stdout')
     
     args = parser.parse_args()
     
@@ -288,11 +346,7 @@ def main():
         
         try:
             # Load existing model artifacts
-            processor.embedder = SentenceTransformer("data/models/embedder_model/")
-            processor.index = faiss.read_index("data/models/faiss_index.bin")
-            processor.df = pd.read_csv("data/models/cleaned_patients.csv")
-            processor.tokenizer = AutoTokenizer.from_pretrained("microsoft/BioGPT")
-            processor.model = AutoModelForCausalLM.from_pretrained("microsoft/BioGPT")
+            processor.load_model_artifacts()
             
             print("Model preloaded successfully!")
             
@@ -300,6 +354,34 @@ def main():
             print(f"Error preloading model: {e}")
             sys.exit(1)
         
+    elif args.mode == 'serve':
+        """Serve mode - keep retrieval and BioGPT loaded and respond to queries"""
+        processor = MedicalRAGProcessor()
+        
+        try:
+            processor.load_model_artifacts()
+            configure_threads(args.threads)
+            
+            print("Model ready")
+            print("Waiting for queries...")
+            sys.stdout.flush()
+            
+        except Exception as e:
+            print(f"Error loading model artifacts: {e}")
+            print("Please run initialization mode first")
+            sys.exit(1)
+        
+        def handle_query(query_data):
+            return processor.process_medical_query(
+                query_data['query'], query_data.get('age'), query_data.get('gender'))
+        
+        if args.socket:
+            # Framed protocol; many clients may connect and pipeline requests
+            serve_socket(handle_query, args.socket, threads=args.threads)
+        else:
+            # Read queries from stdin, answering up to --threads at a time
+            serve_json_lines(handle_query, threads=args.threads)
+        
     elif args.mode == 'query':
         """Process a medical query"""
         if not args.query:
@@ -310,26 +392,16 @@ def main():
         
         # Load existing model artifacts
         try:
-            # Load embedder
-            processor.embedder = SentenceTransformer("data/models/embedder_model/")
-            
-            # Load FAISS index
-            processor.index = faiss.read_index("data/models/faiss_index.bin")
-            
-            # Load processed data
-            processor.df = pd.read_csv("data/models/cleaned_patients.csv")
-            
-            # Load BioGPT
-            processor.tokenizer = AutoTokenizer.from_pretrained("microsoft/BioGPT")
-            processor.model = AutoModelForCausalLM.from_pretrained("microsoft/BioGPT")
+            processor.load_model_artifacts()
             
         except Exception as e:
             print(f"Error loading model artifacts: {e}")
             print("Please run initialization mode first")
             sys.exit(1)
         
-        # Process query
-        result = processor.process_medical_query(args.query, args.age, args.gender)
+        # Process query, as one job of the node-wide CPU budget
+        with default_scheduler().job(configure_threads(1)):
+            result = processor.process_medical_query(args.query, args.age, args.gender)
         
         # Output JSON result
         print(json.dumps(result, indent=2))
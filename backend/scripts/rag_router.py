@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Latency-Budget Router - picks the lightweight or BioGPT RAG path per query
+Sends a query to the full generator only when its predicted latency, given
+the current queue, fits the request's budget
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from lightweight_rag_processor import CASE_COLUMNS as LIGHTWEIGHT_CASE_COLUMNS, LightweightMedicalRAG
+from rag_processor import CASE_COLUMNS as FULL_CASE_COLUMNS, MedicalRAGProcessor
+from cpu_scheduler import default_scheduler
+from serve_utils import (ADMITTED_AT, QUEUE_DEPTH, configure_threads, default_serve_threads,
+                         serve_json_lines, serve_socket)
+
+ROUTE_LIGHTWEIGHT = 'lightweight'
+ROUTE_FULL = 'full'
+# Both engines answer from one case table, so low-memory mode must keep the columns either reads
+SHARED_CASE_COLUMNS = list(dict.fromkeys(LIGHTWEIGHT_CASE_COLUMNS + FULL_CASE_COLUMNS))
+# Remaining budget below which BioGPT is not started
+MIN_GENERATION_MS = 100
+
+
+class LatencyEstimate:
+    """Exponentially weighted moving average of observed latencies (ms)"""
+
+    def __init__(self, alpha: float = 0.2, initial_ms: Optional[float] = None):
+        self.alpha = alpha
+        self.value = initial_ms
+        self._lock = threading.Lock()
+
+    def observe(self, latency_ms: float):
+        with self._lock:
+            if self.value is None:
+                self.value = latency_ms
+            else:
+                self.value = self.alpha * latency_ms + (1 - self.alpha) * self.value
+
+
+class LatencyBudgetRouter:
+    """Routes queries between the template and BioGPT paths under a latency budget.
+
+    The full path is taken when its estimated latency, scaled by the number
+    of full requests already queued ahead, fits what is left of the budget
+    and the server is not past `max_queue_depth`. Anything else is downgraded
+    to the lightweight path. Generation is also capped at the remaining
+    budget, and a request whose budget runs out while waiting for a
+    generation slot gets the template answer instead. Until the first full
+    sample exists, an idle full path is probed so the estimate can be learned.
+    """
+
+    def __init__(self, lightweight: LightweightMedicalRAG, full: Optional[MedicalRAGProcessor],
+                 full_workers: int = 1, default_budget_ms: float = 3000,
+                 max_queue_depth: int = 16, full_estimate_ms: Optional[float] = None):
+        self.lightweight = lightweight
+        self.full = full
+        self.full_workers = max(1, full_workers)
+        self.default_budget_ms = default_budget_ms
+        self.max_queue_depth = max_queue_depth
+        self.estimates = {
+            ROUTE_LIGHTWEIGHT: LatencyEstimate(),
+            ROUTE_FULL: LatencyEstimate(initial_ms=full_estimate_ms)
+        }
+        self._lock = threading.Lock()
+        # At most full_workers generations run at once; the rest queue here
+        self._full_slots = threading.Semaphore(self.full_workers)
+        self.queue_depth = 0
+        self.full_in_flight = 0
+
+    @classmethod
+    def from_artifacts(cls, model_dir: str = "data/models", **kwargs) -> "LatencyBudgetRouter":
+        """Load both engines, sharing one embedder, index and case table"""
+        lightweight = LightweightMedicalRAG()
+        lightweight.load_model_artifacts(model_dir, case_columns=SHARED_CASE_COLUMNS)
+
+        full = None
+        if lightweight.index is not None:
+            full = MedicalRAGProcessor(generation_slots=kwargs.get('full_workers', 1))
+            full.embedder = lightweight.embedder
+            full.index = lightweight.index
+            full.df = lightweight.df
+            # Both engines encode with the same tokenizer, so they share its lock
+            full._encode_lock = lightweight._encode_lock
+            full.load_bio_gpt_model()
+        else:
+            print("Sharded index in use; routing every query to the lightweight path", file=sys.stderr)
+
+        return cls(lightweight, full, **kwargs)
+
+    def predicted_full_ms(self) -> Optional[float]:
+        """Estimated full-path latency for a request arriving now"""
+        estimate = self.estimates[ROUTE_FULL].value
+        if estimate is None:
+            return None
+        # Each full batch of `full_workers` requests ahead adds one service time
+        return estimate * (1 + self.full_in_flight // self.full_workers)
+
+    def choose_route(self, remaining_ms: float, queue_depth: int) -> Tuple[str, str, Optional[float]]:
+        """Return (route, reason, predicted full latency) and reserve a full slot"""
+        with self._lock:
+            predicted = self.predicted_full_ms()
+            if self.full is None:
+                return ROUTE_LIGHTWEIGHT, 'full_unavailable', predicted
+            if queue_depth > self.max_queue_depth:
+                return ROUTE_LIGHTWEIGHT, 'load', predicted
+            if remaining_ms < MIN_GENERATION_MS:
+                return ROUTE_LIGHTWEIGHT, 'deadline', predicted
+            if predicted is None:
+                if self.full_in_flight == 0:
+                    self.full_in_flight += 1
+                    return ROUTE_FULL, 'probe', predicted
+                return ROUTE_LIGHTWEIGHT, 'estimating', predicted
+            if predicted > remaining_ms:
+                return ROUTE_LIGHTWEIGHT, 'deadline', predicted
+            self.full_in_flight += 1
+            return ROUTE_FULL, 'budget', predicted
+
+    def _run_lightweight(self, query: str, age: int, gender: str) -> Dict[str, Any]:
+        service_start = time.monotonic()
+        result = self.lightweight.process_medical_query(query, age, gender)
+        self.estimates[ROUTE_LIGHTWEIGHT].observe((time.monotonic() - service_start) * 1000)
+        return result
+
+    def _run_full(self, query: str, age: int, gender: str,
+                  remaining_ms: Callable[[], float]) -> Optional[Dict[str, Any]]:
+        """BioGPT answer capped at the remaining budget, or None if it ran out waiting for a slot"""
+        with self._full_slots:
+            remaining = remaining_ms()
+            if remaining < MIN_GENERATION_MS:
+                return None
+            service_start = time.monotonic()
+            result = self.full.process_medical_query(query, age, gender, max_time=remaining / 1000)
+            # Service time only; waiting for slots is modelled by predicted_full_ms
+            self.estimates[ROUTE_FULL].observe((time.monotonic() - service_start) * 1000)
+            return result
+
+    def process_medical_query(self, query: str, age: int = None, gender: str = None,
+                              latency_budget_ms: Optional[float] = None, arrival_time: Optional[float] = None,
+                              queue_depth: Optional[int] = None) -> Dict[str, Any]:
+        """Answer a query on the route its budget allows; the route is recorded in the result.
+
+        `arrival_time` (time.monotonic()) and `queue_depth` are taken by the
+        serve loop when it admits the request, so time spent waiting for a
+        worker thread or CPU tokens counts against the budget and the queue.
+        Without them the request is measured from this call.
+        """
+        arrival_time = arrival_time if arrival_time is not None else time.monotonic()
+        budget_ms = float(latency_budget_ms) if latency_budget_ms is not None else self.default_budget_ms
+
+        def remaining_ms() -> float:
+            # Leave a margin of the budget for retrieval and formatting
+            return budget_ms * 0.9 - (time.monotonic() - arrival_time) * 1000
+
+        with self._lock:
+            self.queue_depth += 1
+            if queue_depth is None:
+                queue_depth = self.queue_depth
+        try:
+            route, reason, predicted = self.choose_route(remaining_ms(), queue_depth)
+
+            result = None
+            if route == ROUTE_FULL:
+                try:
+                    result = self._run_full(query, age, gender, remaining_ms)
+                    if result is None:
+                        route, reason = ROUTE_LIGHTWEIGHT, 'deadline'
+                except Exception as e:
+                    print(f"Full RAG path failed, downgrading: {e}", file=sys.stderr)
+                    route, reason = ROUTE_LIGHTWEIGHT, 'full_error'
+                finally:
+                    with self._lock:
+                        self.full_in_flight -= 1
+            if result is None:
+                result = self._run_lightweight(query, age, gender)
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+
+        elapsed_ms = (time.monotonic() - arrival_time) * 1000
+        result['route'] = {
+            'engine': route,
+            'reason': reason,
+            'budget_ms': budget_ms,
+            'predicted_full_ms': predicted,
+            'queue_depth': queue_depth,
+            'elapsed_ms': elapsed_ms,
+            'deadline_met': elapsed_ms <= budget_ms
+        }
+        return result
+
+
+def main():
+    """Main function to handle command line arguments"""
+    parser = argparse.ArgumentParser(description='Latency-budget router for the medical RAG engines')
+    parser.add_argument('--mode', choices=['serve', 'query'], default='serve',
+                        help='Mode: serve (persistent server) or query (process one query)')
+    parser.add_argument('--query', type=str, help='Medical query to process')
+    parser.add_argument('--age', type=int, help='Patient age')
+    parser.add_argument('--gender', type=str, help='Patient gender')
+    parser.add_argument('--latency_budget_ms', type=float, help='Latency budget for --mode query')
+    parser.add_argument('--default_budget_ms', type=float, default=3000,
+                        help='Budget for requests that do not send latency_budget_ms')
+    parser.add_argument('--full_workers', type=int, default=1, help='Concurrent BioGPT generations')
+    parser.add_argument('--max_queue_depth', type=int, default=16,
+                        help='Admitted requests beyond which everything goes to the lightweight path')
+    parser.add_argument('--full_estimate_ms', type=float,
+                        help='Initial BioGPT latency estimate; omit to learn it from probe requests')
+    parser.add_argument('--threads', type=int, default=default_serve_threads(),
+                        help='Concurrent queries in serve mode (default: RAG_SERVE_THREADS or CPU count)')
+    parser.add_argument('--socket', type=str,
+                        help='Serve length-prefixed frames on this Unix socket instead of stdin/stdout')
+
+    args = parser.parse_args()
+
+    try:
+        router = LatencyBudgetRouter.from_artifacts(
+            full_workers=args.full_workers,
+            default_budget_ms=args.default_budget_ms,
+            max_queue_depth=args.max_queue_depth,
+            full_estimate_ms=args.full_estimate_ms
+        )
+    except Exception as e:
+        print(f"Error loading model artifacts: {e}")
+        print("Please run initialization mode first")
+        sys.exit(1)
+
+    if args.mode == 'query':
+        if not args.query:
+            print("Error: Query is required for query mode")
+            sys.exit(1)
+        with default_scheduler().job(configure_threads(1)):
+            result = router.process_medical_query(args.query, args.age, args.gender, args.latency_budget_ms)
+        print(json.dumps(result))
+        return
+
+    configure_threads(args.threads)
+    print("Model ready")
+    print("Waiting for queries...")
+    sys.stdout.flush()
+
+    def handle_query(query_data):
+        return router.process_medical_query(
+            query_data['query'], query_data.get('age'), query_data.get('gender'),
+            query_data.get('latency_budget_ms'), query_data.get(ADMITTED_AT), query_data.get(QUEUE_DEPTH))
+
+    if args.socket:
+        serve_socket(handle_query, args.socket, threads=args.threads)
+    else:
+        serve_json_lines(handle_query, threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Persistent cache of LLM-generated reports
+phi-2 generates with do_sample=False, so a prompt always produces the same
+report. The generated text is keyed by prompt template version, diagnosis and
+modality, and stored in a size-bounded DiskCache shared by every analyzer
+process. The raw text is cached rather than the parsed report, so changes to
+the parser take effect without invalidating the cache.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+from disk_cache import DiskCache
+
+BACKEND_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+REPORT_CACHE_PATH = os.path.join(BACKEND_DIR, 'data', 'cache', 'llm_reports.sqlite')
+DEFAULT_REPORT_CACHE_MB = 64
+
+
+def template_version(*parts: Any) -> str:
+    """Short hash of everything that shapes the generated text (template, model, generation settings)"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class ReportCache:
+    """Generated report text keyed by template version, modality and diagnosis"""
+
+    def __init__(self, cache: DiskCache, version: str):
+        self.cache = cache
+        self.version = version
+
+    def key(self, diagnosis: str, modality: str) -> str:
+        # The diagnosis goes into the prompt verbatim, so it is not normalized here either
+        return f"{self.version}:{modality}:{diagnosis}"
+
+    def get(self, diagnosis: str, modality: str) -> Optional[str]:
+        value = self.cache.get(self.key(diagnosis, modality))
+        return value.decode() if value is not None else None
+
+    def put(self, diagnosis: str, modality: str, text: str):
+        self.cache.put(self.key(diagnosis, modality), text.encode())
+
+    def stats(self) -> Dict[str, Any]:
+        return {'version': self.version, **self.cache.stats()}
+
+
+def open_report_cache(version: str) -> Optional[ReportCache]:
+    """Cache configured by LLM_REPORT_CACHE (path) and LLM_REPORT_CACHE_MB (0 disables)"""
+    max_mb = float(os.environ.get('LLM_REPORT_CACHE_MB', DEFAULT_REPORT_CACHE_MB))
+    if max_mb <= 0:
+        return None
+    path = os.environ.get('LLM_REPORT_CACHE', REPORT_CACHE_PATH)
+    return ReportCache(DiskCache(path, int(max_mb * 1024 * 1024), table="reports"), version)
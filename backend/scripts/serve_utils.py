@@ -0,0 +1,170 @@
+"""
+Shared serve-mode helpers for the RAG processors and image analyzer
+Concurrent JSON-lines and framed Unix-socket request loops, and per-library
+thread configuration. Every request runs as one job of the node-wide CPU
+scheduler (cpu_scheduler.py), so concurrent model processes share the cores.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TextIO
+
+from cpu_scheduler import available_cpus, scheduled, set_library_threads, thread_budget
+
+RESPONSE_END = "RESPONSE_END"
+
+# Fields the serve loops stamp on each request when they admit it
+ADMITTED_AT = '_admitted_at'
+QUEUE_DEPTH = '_queue_depth'
+
+# Threads per request, set by configure_threads
+_job_threads = None
+
+
+def default_serve_threads() -> int:
+    """Worker threads for serve mode: RAG_SERVE_THREADS, else one per available core"""
+    configured = os.environ.get('RAG_SERVE_THREADS')
+    if configured:
+        return max(1, int(configured))
+    return available_cpus()
+
+
+def configure_threads(serve_threads: int) -> int:
+    """Split the CPU thread budget between concurrent requests.
+
+    Each in-flight request gets `budget // serve_threads` intra-op threads in
+    torch, FAISS/OpenMP and MKL, so N overlapping queries keep the cores busy
+    without oversubscribing them. The budget is the node's cgroup quota (see
+    cpu_scheduler.py). Returns the per-request thread count.
+    """
+    global _job_threads
+    per_request = max(1, thread_budget() // max(1, serve_threads))
+    set_library_threads(per_request)
+    _job_threads = per_request
+    return per_request
+
+
+def job_threads() -> int:
+    """Threads each request holds from the CPU scheduler"""
+    return _job_threads or configure_threads(1)
+
+
+class Admissions:
+    """Requests a serve loop has read but not yet answered.
+
+    `admit` stamps the request with its arrival time (time.monotonic()) and
+    the number of requests outstanding including itself, so handlers can see
+    the time spent waiting for a worker thread or CPU-scheduler tokens.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outstanding = 0
+
+    def admit(self, request: Dict[str, Any]):
+        with self._lock:
+            self.outstanding += 1
+            depth = self.outstanding
+        if isinstance(request, dict):
+            request[QUEUE_DEPTH] = depth
+            request[ADMITTED_AT] = time.monotonic()
+
+    def done(self):
+        with self._lock:
+            self.outstanding -= 1
+
+
+def serve_json_lines(handle_query: Callable[[Dict[str, Any]], Dict[str, Any]], threads: int = 1,
+                     stream_in: Optional[TextIO] = None, stream_out: Optional[TextIO] = None,
+                     required_field: Optional[str] = 'query'):
+    """Answer JSON-lines queries from stdin on a pool of worker threads.
+
+    Each input line is one request; each response is written as
+    `json.dumps(result) + RESPONSE_END`. With more than one thread, responses
+    are written in completion order, so clients that pipeline requests should
+    send an `id` field, which is echoed back on the matching response.
+    Requests are stamped with ADMITTED_AT and QUEUE_DEPTH as they are read.
+    """
+    stream_in = stream_in or sys.stdin
+    stream_out = stream_out or sys.stdout
+    handle_query = scheduled(handle_query, job_threads())
+    write_lock = threading.Lock()
+    # Bound the requests read ahead of the workers so stdin applies backpressure
+    in_flight = threading.BoundedSemaphore(threads * 2)
+    admissions = Admissions()
+
+    def respond(payload: Dict[str, Any], request_id: Any = None):
+        if request_id is not None:
+            payload = {**payload, 'id': request_id}
+        with write_lock:
+            stream_out.write(json.dumps(payload) + RESPONSE_END + "\n")
+            stream_out.flush()
+
+    def run(query_data: Dict[str, Any]):
+        request_id = query_data.get('id')
+        try:
+            if required_field and not query_data.get(required_field):
+                respond({"error": f"No {required_field} provided"}, request_id)
+            else:
+                respond(handle_query(query_data), request_id)
+        except Exception as e:
+            respond({"error": str(e)}, request_id)
+        finally:
+            admissions.done()
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="serve-worker") as executor:
+        for line in stream_in:
+            if not line.strip():
+                continue
+            try:
+                query_data = json.loads(line.strip())
+            except json.JSONDecodeError:
+                respond({"error": "Invalid JSON input"})
+                continue
+            if not isinstance(query_data, dict):
+                respond({"error": "Invalid JSON input"})
+                continue
+
+            admissions.admit(query_data)
+            in_flight.acquire()
+            executor.submit(run, query_data)
+
+
+def serve_socket(handle_query: Callable[[Dict[str, Any]], Dict[str, Any]], socket_path: str,
+                 threads: int = 1, required_field: Optional[str] = 'query', payload_field: Optional[str] = None):
+    """Answer framed queries on a Unix socket (see framing.py) until interrupted.
+
+    Requests carry the same fields as the JSON-lines protocol; the response
+    frame's metadata is the result dict. With `payload_field`, a non-empty
+    binary payload is passed to the handler as that field of the request.
+    Requests are stamped with ADMITTED_AT and QUEUE_DEPTH as frames arrive.
+    Logging goes to stderr only.
+    """
+    from framing import serve_unix_socket
+
+    handle_query = scheduled(handle_query, job_threads())
+    admissions = Admissions()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def handle_request(message: Dict[str, Any], payload: bytes) -> Dict[str, Any]:
+        try:
+            if payload_field and payload:
+                message[payload_field] = payload
+            if required_field and not message.get(required_field):
+                return {"error": f"No {required_field} provided"}
+            return handle_query(message)
+        finally:
+            admissions.done()
+
+    try:
+        asyncio.run(serve_unix_socket(handle_request, socket_path, threads, on_admit=admissions.admit))
+    except KeyboardInterrupt:
+        pass
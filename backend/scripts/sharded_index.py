@@ -0,0 +1,359 @@
+"""
+Sharded FAISS retrieval for large case corpora
+Partitions the corpus into size-balanced shards and scatter-gathers queries
+"""
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+import pandas as pd
+
+import low_memory
+
+MANIFEST_NAME = "manifest.json"
+SHARD_INDEX = "faiss_index.bin"
+SHARD_EMBEDDINGS = "embeddings.npy"
+SHARD_CASES = "cases.csv"
+# Case columns the lightweight processor reads from search results (all that low-memory mode loads)
+CASE_COLUMNS = ['Patient id', 'Diagnosis', 'Treatment plan', 'Medications prescribed']
+
+
+def estimate_row_bytes(cases: pd.DataFrame, embedding_dim: int) -> np.ndarray:
+    """Approximate resident bytes per row: text length plus one float32 vector"""
+    text_bytes = cases.fillna('').astype(str).apply(lambda column: column.str.len()).sum(axis=1)
+    return text_bytes.to_numpy(dtype=np.int64) + embedding_dim * 4
+
+
+def plan_shard_bounds(row_bytes: np.ndarray, num_shards: int) -> List[Tuple[int, int]]:
+    """Split rows into contiguous [start, end) ranges of roughly equal bytes"""
+    num_shards = max(1, min(num_shards, len(row_bytes)))
+    cumulative = np.cumsum(row_bytes)
+    targets = cumulative[-1] * np.arange(1, num_shards) / num_shards
+    cuts = np.searchsorted(cumulative, targets, side='right')
+    bounds = [0] + [int(cut) for cut in cuts] + [len(row_bytes)]
+    return [(bounds[i], bounds[i + 1]) for i in range(num_shards) if bounds[i + 1] > bounds[i]]
+
+
+def read_manifest(shard_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(shard_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+class ShardWriter:
+    """Writes shards one at a time, then the manifest describing them"""
+
+    def __init__(self, shard_dir: str, metadata: Dict[str, Any]):
+        self.shard_dir = shard_dir
+        self.metadata = metadata
+        self.shards: List[Dict[str, Any]] = []
+        self.row_offset = 0
+        self._cases: List[pd.DataFrame] = []
+        self._embeddings: List[np.ndarray] = []
+        self._bytes = 0
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def add(self, cases: pd.DataFrame, embeddings: np.ndarray, num_bytes: int):
+        """Buffer rows for the shard currently being written"""
+        self._cases.append(cases)
+        self._embeddings.append(np.asarray(embeddings, dtype=np.float32))
+        self._bytes += int(num_bytes)
+
+    def flush(self):
+        """Write the buffered rows out as the next shard"""
+        if not self._cases:
+            return
+
+        cases = pd.concat(self._cases, ignore_index=True)
+        embeddings = np.ascontiguousarray(np.vstack(self._embeddings))
+
+        name = f"shard_{len(self.shards):03d}"
+        path = os.path.join(self.shard_dir, name)
+        os.makedirs(path, exist_ok=True)
+
+        # Inner product over normalized embeddings, as in the single index
+        index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+        faiss.write_index(index, os.path.join(path, SHARD_INDEX))
+        np.save(os.path.join(path, SHARD_EMBEDDINGS), embeddings)
+        cases.to_csv(os.path.join(path, SHARD_CASES), index=False)
+
+        self.shards.append({
+            'name': name,
+            'rows': len(cases),
+            'bytes': self._bytes,
+            'row_offset': self.row_offset
+        })
+        self.row_offset += len(cases)
+        self._cases, self._embeddings, self._bytes = [], [], 0
+
+    def close(self) -> Dict[str, Any]:
+        """Flush the last shard and write the manifest"""
+        self.flush()
+        manifest = {
+            **self.metadata,
+            'num_shards': len(self.shards),
+            'num_cases': self.row_offset,
+            'shards': self.shards
+        }
+        with open(os.path.join(self.shard_dir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+def build_shards(df: pd.DataFrame, embedder, shard_dir: str, num_shards: int,
+                 text_column: str = "combined_text", batch_size: int = 16) -> Dict[str, Any]:
+    """Partition a corpus into size-balanced shards, embedding one shard at a time"""
+    embedding_dim = embedder.get_sentence_embedding_dimension()
+    row_bytes = estimate_row_bytes(df, embedding_dim)
+    writer = ShardWriter(shard_dir, {'embedding_dim': embedding_dim, 'metric': 'inner_product'})
+
+    for start, end in plan_shard_bounds(row_bytes, num_shards):
+        cases = df.iloc[start:end].reset_index(drop=True)
+        embeddings = embedder.encode(
+            cases[text_column].tolist(),
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        writer.add(cases, embeddings, row_bytes[start:end].sum())
+        writer.flush()
+        print(f"Wrote shard {len(writer.shards) - 1} with {end - start} cases")
+
+    return writer.close()
+
+
+def rebalance_shards(shard_dir: str, num_shards: Optional[int] = None) -> Dict[str, Any]:
+    """Re-cut existing shards into `num_shards` shards of roughly equal size.
+
+    Streams through the old shards in order, so at most one old shard and
+    one new shard are resident. The new layout is written beside the old one
+    and swapped in with renames.
+    """
+    manifest = read_manifest(shard_dir)
+    num_shards = num_shards or manifest['num_shards']
+    embedding_dim = manifest['embedding_dim']
+    total_bytes = sum(shard['bytes'] for shard in manifest['shards'])
+    target_bytes = total_bytes / num_shards
+
+    metadata = {key: value for key, value in manifest.items()
+                if key not in ('num_shards', 'num_cases', 'shards')}
+    new_dir = shard_dir.rstrip(os.sep) + ".rebalance"
+    shutil.rmtree(new_dir, ignore_errors=True)
+    writer = ShardWriter(new_dir, metadata)
+
+    current_shard = 0
+    bytes_before = 0
+    for shard in manifest['shards']:
+        path = os.path.join(shard_dir, shard['name'])
+        cases = pd.read_csv(os.path.join(path, SHARD_CASES))
+        embeddings = np.load(os.path.join(path, SHARD_EMBEDDINGS))
+        row_bytes = estimate_row_bytes(cases, embedding_dim)
+
+        # New shard of each row, from the bytes that precede it in corpus order
+        starts = bytes_before + np.cumsum(row_bytes) - row_bytes
+        assignment = np.minimum((starts // target_bytes).astype(int), num_shards - 1)
+        bytes_before += int(row_bytes.sum())
+
+        for new_shard in np.unique(assignment):
+            if new_shard != current_shard:
+                writer.flush()
+                current_shard = new_shard
+            rows = assignment == new_shard
+            writer.add(cases[rows], embeddings[rows], row_bytes[rows].sum())
+
+    new_manifest = writer.close()
+
+    old_dir = shard_dir.rstrip(os.sep) + ".old"
+    os.rename(shard_dir, old_dir)
+    os.rename(new_dir, shard_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return new_manifest
+
+
+class LocalShard:
+    """One shard's index and case store, loaded on first use"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = None
+        self.cases = None
+
+    def load(self):
+        self.index = low_memory.read_index(os.path.join(self.path, SHARD_INDEX))
+        self.cases = low_memory.read_csv(os.path.join(self.path, SHARD_CASES), CASE_COLUMNS)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        if self.index is None:
+            self.load()
+        scores, ids = self.index.search(query, min(k, self.index.ntotal))
+        return [(float(score), self.cases.iloc[row].to_dict())
+                for score, row in zip(scores[0], ids[0]) if row >= 0]
+
+
+def _shard_worker_main(path: str):
+    """Entry point of a shard worker process: load the shard, answer searches.
+
+    Requests and replies are pickles on stdin/stdout; the parent is the
+    only peer, so nothing untrusted is unpickled. The reply stream gets a
+    private descriptor and fd 1 is pointed at stderr first, so prints from
+    Python or native libraries cannot corrupt it.
+    """
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    shard = LocalShard(path)
+    shard.load()
+    requests = sys.stdin.buffer
+    while True:
+        try:
+            query, k = pickle.load(requests)
+        except EOFError:
+            break
+        try:
+            reply = ('ok', shard.search(query, k))
+        except Exception as e:
+            reply = ('error', str(e))
+        pickle.dump(reply, replies)
+        replies.flush()
+
+
+class ProcessShard:
+    """A shard served by its own local process, started on first use.
+
+    Workers run this module directly rather than through multiprocessing,
+    which would re-import the parent's script (and its model libraries)
+    in every worker.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', self.path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            pickle.dump((query, k), self.process.stdin)
+            self.process.stdin.flush()
+            try:
+                status, payload = pickle.load(self.process.stdout)
+            except EOFError:
+                status, payload = 'error', f"worker exited with code {self.process.wait()}"
+        if status != 'ok':
+            raise RuntimeError(f"Shard {os.path.basename(self.path)} failed: {payload}")
+        return payload
+
+    def close(self):
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.stdin.close()
+                try:
+                    self.process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+            self.process = None
+
+
+class ShardedRetriever:
+    """Fans a query out to every shard and merges their top-k results.
+
+    With `workers='process'` each shard lives in its own local process, so
+    this process never holds more than the embedder. With `workers='thread'`
+    shards load into this process on first use and at most `max_resident`
+    stay loaded, least recently used first out. Every query searches every
+    shard, so `max_resident` must cover them all; a smaller cap would reload
+    shards from disk on each query, and process workers are the way to keep
+    the RAG process small.
+    """
+
+    def __init__(self, shard_dir: str, workers: str = 'process', max_resident: Optional[int] = None):
+        if workers not in ('process', 'thread'):
+            raise ValueError(f"Unknown shard worker type: {workers}")
+
+        self.shard_dir = shard_dir
+        self.manifest = read_manifest(shard_dir)
+        self.workers = workers
+        self.max_resident = max_resident
+        self.paths = [os.path.join(shard_dir, shard['name']) for shard in self.manifest['shards']]
+        if workers == 'thread' and max_resident and max_resident < len(self.paths):
+            raise ValueError(f"max_resident={max_resident} is below the {len(self.paths)} shards every query "
+                             f"searches; raise it or use process shard workers")
+
+        self._process_shards = [ProcessShard(path) for path in self.paths] if workers == 'process' else None
+        self._resident: "OrderedDict[int, LocalShard]" = OrderedDict()
+        # Guards the dict only; each shard loads under its own lock, so shards load in parallel
+        self._resident_lock = threading.Lock()
+        self._load_locks = [threading.Lock() for _ in self.paths]
+        self._pool = ThreadPoolExecutor(max_workers=len(self.paths), thread_name_prefix="shard-search")
+
+    def _local_shard(self, shard_id: int) -> LocalShard:
+        with self._resident_lock:
+            shard = self._resident.get(shard_id)
+            if shard is not None:
+                self._resident.move_to_end(shard_id)
+                return shard
+
+        with self._load_locks[shard_id]:
+            with self._resident_lock:
+                shard = self._resident.get(shard_id)
+            if shard is None:
+                shard = LocalShard(self.paths[shard_id])
+                shard.load()
+            with self._resident_lock:
+                self._resident[shard_id] = shard
+                self._resident.move_to_end(shard_id)
+                while self.max_resident and len(self._resident) > self.max_resident:
+                    self._resident.popitem(last=False)
+            return shard
+
+    def resident_shards(self) -> Dict[int, LocalShard]:
+        """Shards loaded into this process (none with process workers)"""
+        with self._resident_lock:
+            return dict(self._resident)
+
+    def _search_shard(self, shard_id: int, query: np.ndarray, k: int):
+        if self._process_shards is not None:
+            return self._process_shards[shard_id].search(query, k)
+        return self._local_shard(shard_id).search(query, k)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """Return the global top-k (score, case row) pairs, best first"""
+        query = np.ascontiguousarray(query, dtype=np.float32).reshape(1, -1)
+        futures = [self._pool.submit(self._search_shard, shard_id, query, k)
+                   for shard_id in range(len(self.paths))]
+        merged = [hit for future in futures for hit in future.result()]
+        merged.sort(key=lambda hit: hit[0], reverse=True)
+        return merged[:k]
+
+    def close(self):
+        if self._process_shards is not None:
+            for shard in self._process_shards:
+                shard.close()
+        self._pool.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Shard search worker')
+    parser.add_argument('--worker', type=str, required=True, help='Shard directory to serve')
+    _shard_worker_main(parser.parse_args().worker)
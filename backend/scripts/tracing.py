@@ -0,0 +1,143 @@
+"""
+Span tracing and an opt-in torch.profiler hook for the image pipeline
+Tracing is off unless IMAGE_TRACE is set (or configure() is called): `span()`
+and `event()` then cost one global check and return a shared no-op. When on,
+each request is one trace, written as a JSON line to IMAGE_TRACE ('-' for
+stderr), holding its spans (name, start and duration in ms, nesting depth,
+attributes) and events. With a profile directory, each request also runs
+under torch.profiler; spans show up as record_function ranges, and the
+operator-level profile is exported as a Chrome trace.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+_output: Optional[str] = os.environ.get('IMAGE_TRACE') or None
+_profile_dir: Optional[str] = os.environ.get('IMAGE_PROFILE_DIR') or None
+_write_lock = threading.Lock()
+_local = threading.local()
+_NOOP = nullcontext()
+
+
+def configure(output: Optional[str] = None, profile_dir: Optional[str] = None):
+    """Enable tracing to `output` (a JSONL path, or '-' for stderr) and/or profiling into `profile_dir`"""
+    global _output, _profile_dir
+    if output:
+        _output = output
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        _profile_dir = profile_dir
+
+
+def enabled() -> bool:
+    return _output is not None or _profile_dir is not None
+
+
+class Trace:
+    """Spans and events of one request"""
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+        self.depth = 0
+        self.profiler = None
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.start) * 1000, 3)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'trace_id': self.trace_id, 'name': self.name, 'attrs': self.attrs, 'wall_time': time.time(),
+                'total_ms': self.elapsed_ms(), 'spans': sorted(self.spans, key=lambda record: record['start_ms']),
+                'events': self.events}
+
+
+def current() -> Optional[Trace]:
+    return getattr(_local, 'trace', None)
+
+
+def _write(record: Dict[str, Any]):
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        if _output == '-':
+            print(f"[trace] {line}", file=sys.stderr)
+        elif _output:
+            with open(_output, 'a') as f:
+                f.write(line + "\n")
+
+
+@contextmanager
+def _trace(name: str, attrs: Dict[str, Any]):
+    trace = Trace(name, attrs)
+    _local.trace = trace
+    profiler = None
+    if _profile_dir:
+        import torch
+        profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                          record_shapes=True, profile_memory=True)
+        profiler.__enter__()
+        trace.profiler = profiler
+    try:
+        yield trace
+    finally:
+        _local.trace = None
+        if profiler is not None:
+            profiler.__exit__(None, None, None)
+            path = os.path.join(_profile_dir, f"{name}-{trace.trace_id}.json")
+            profiler.export_chrome_trace(path)
+            trace.attrs['profile'] = path
+            print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15), file=sys.stderr)
+        _write(trace.to_dict())
+
+
+def trace(name: str, **attrs):
+    """Root span of one request; a no-op when tracing is off or a trace is already open"""
+    if not enabled() or current() is not None:
+        return _NOOP
+    return _trace(name, attrs)
+
+
+@contextmanager
+def _span(trace: Trace, name: str, attrs: Dict[str, Any]):
+    record = {'name': name, 'start_ms': trace.elapsed_ms(), 'depth': trace.depth, **({'attrs': attrs} if attrs else {})}
+    trace.depth += 1
+    profiled = None
+    if trace.profiler is not None:
+        import torch
+        profiled = torch.profiler.record_function(name)
+        profiled.__enter__()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        if profiled is not None:
+            profiled.__exit__(None, None, None)
+        trace.depth -= 1
+        trace.spans.append(record)
+
+
+def span(name: str, **attrs):
+    """Time a stage of the current trace; yields the span record (or None) for extra attributes"""
+    trace = current() if _output is not None or _profile_dir is not None else None
+    if trace is None:
+        return _NOOP
+    return _span(trace, name, attrs)
+
+
+def event(name: str, **attrs):
+    """Record a point-in-time event (what used to be a DEBUG print) on the current trace"""
+    if _output is None and _profile_dir is None:
+        return
+    trace = current()
+    if trace is not None:
+        trace.events.append({'name': name, 'at_ms': trace.elapsed_ms(), **attrs})
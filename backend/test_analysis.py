@@ -1,7 +1,10 @@
 import os
 import sys
 import json
-from scripts.lightweight_image_analyzer import run_analysis
+
+# The analyzer imports its sibling modules from scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from lightweight_image_analyzer import run_analysis
 
 # Test the analysis with a dummy image path
 # You'll need to replace this with an actual image path
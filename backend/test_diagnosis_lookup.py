@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+from difflib import get_close_matches
+
+import pandas as pd
+import pytest
+
+from diagnosis_lookup import DATA_ROOT, LOOKUP_FILE, SOURCE_FILE, DiagnosisLookup, load_lookup
+from embedding_store import LEGACY_PICKLE, load_diagnosis_matrix
+
+MODALITIES = ['ct', 'mri', 'xray']
+
+
+def dataframe_lookup(diagnosis_name, df):
+    """The DataFrame scan the analyzers ran on every request before the precompiled lookup"""
+    diagnosis_clean = diagnosis_name.lower().replace('_', ' ').replace('-', ' ')
+    exact_match = df[df['diagnosis'].str.lower() == diagnosis_clean]
+    if not exact_match.empty:
+        return exact_match.iloc[0].to_dict()
+    matches = get_close_matches(diagnosis_clean, df['diagnosis'].dropna().str.lower(), n=3, cutoff=0.3)
+    if matches:
+        return df[df['diagnosis'].str.lower() == matches[0]].iloc[0].to_dict()
+    for _, row in df.iterrows():
+        dataset_diagnosis = str(row['diagnosis']).lower()
+        if (diagnosis_clean in dataset_diagnosis or dataset_diagnosis in diagnosis_clean
+                or any(word in dataset_diagnosis for word in diagnosis_clean.split())
+                or any(word in diagnosis_clean for word in dataset_diagnosis.split())):
+            return row.to_dict()
+    return None
+
+
+def same_record(new, old):
+    if new is None or old is None:
+        return new is None and old is None
+    # The cached rows went through JSON, so NaN is None and numbers are plain
+    old = json.loads(pd.Series(old).to_json())
+    return new == old
+
+
+@pytest.mark.parametrize('modality', MODALITIES)
+def test_matches_the_dataframe_lookup(modality):
+    modality_dir = os.path.join(DATA_ROOT, modality)
+    df = pd.read_json(os.path.join(modality_dir, SOURCE_FILE))
+    lookup = DiagnosisLookup.from_dataframe(df)
+    # Every label the analyzer can return, plus a few variants that exercise the fuzzy and partial
+    # paths (only a few: the old fuzzy scan compares against every patient row)
+    labels = [str(label) for label in load_diagnosis_matrix(modality_dir, mmap=False).labels]
+    variants = [label.upper().replace(' ', '_') for label in labels[:5]] + [label[:-2] for label in labels[:5]]
+    queries = labels + variants
+    queries += ['fracture', 'no such finding at all', 'x']
+    for query in queries:
+        assert same_record(lookup.find(query), dataframe_lookup(query, df)), query
+
+
+def test_rebuilds_when_the_source_changes(tmp_path):
+    modality_dir = tmp_path / 'xray'
+    modality_dir.mkdir()
+    rows = [{'diagnosis': 'Fracture', 'treatment': 'cast'}, {'diagnosis': 'fracture', 'treatment': 'other'},
+            {'diagnosis': 'Pneumonia', 'treatment': 'antibiotics'}]
+    (modality_dir / SOURCE_FILE).write_text(json.dumps(rows))
+
+    lookup = load_lookup(str(modality_dir))
+    assert len(lookup) == 2
+    assert lookup.find('FRACTURE')['treatment'] == 'cast'
+    assert (modality_dir / LOOKUP_FILE).exists()
+
+    rows.append({'diagnosis': 'Effusion', 'treatment': 'drain'})
+    (modality_dir / SOURCE_FILE).write_text(json.dumps(rows))
+    assert load_lookup(str(modality_dir)).find('effusion')['treatment'] == 'drain'
+
+
+def test_unreadable_lookup_file_is_rebuilt(tmp_path):
+    modality_dir = tmp_path / 'ct'
+    shutil.copytree(os.path.join(DATA_ROOT, 'ct'), modality_dir,
+                    ignore=shutil.ignore_patterns('diagnosis_*', LEGACY_PICKLE))
+    (modality_dir / LOOKUP_FILE).write_text('{not json')
+    assert len(load_lookup(str(modality_dir))) > 0
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from diagnosis_matrix import DiagnosisMatrix
+
+
+def brute_force_top_k(embeddings, query, k):
+    """Rank by cosine similarity the way the analyzers did before the matrix"""
+    query = query / np.linalg.norm(query)
+    scores = {label: float(np.dot(emb / np.linalg.norm(emb), query)) for label, emb in embeddings.items()}
+    return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+
+@pytest.fixture
+def embeddings():
+    rng = np.random.default_rng(0)
+    return {f"diagnosis {i}": rng.normal(size=32).astype(np.float32) for i in range(50)}
+
+
+def test_top_k_matches_brute_force(embeddings):
+    matrix = DiagnosisMatrix.from_dict(embeddings)
+    query = np.random.default_rng(1).normal(size=32).astype(np.float32)
+    for k in (1, 5, 50):
+        expected = brute_force_top_k(embeddings, query, k)
+        result = matrix.top_k(query, k)
+        assert [label for label, _ in result] == [label for label, _ in expected]
+        assert np.allclose([score for _, score in result], [score for _, score in expected], atol=1e-5)
+
+
+def test_top_k_batch_matches_single_queries(embeddings):
+    matrix = DiagnosisMatrix.from_dict(embeddings)
+    queries = np.random.default_rng(2).normal(size=(8, 32)).astype(np.float32)
+    batch = matrix.top_k_batch(queries, k=3)
+    for query, result in zip(queries, batch):
+        single = matrix.top_k(query, k=3)
+        assert [label for label, _ in result] == [label for label, _ in single]
+        assert np.allclose([s for _, s in result], [s for _, s in single], atol=1e-5)
+
+
+def test_k_larger_than_matrix_returns_every_diagnosis(embeddings):
+    matrix = DiagnosisMatrix.from_dict(embeddings)
+    assert len(matrix.top_k(np.ones(32, dtype=np.float32), k=500)) == len(embeddings)
+
+
+def test_ties_keep_label_order():
+    matrix = DiagnosisMatrix.from_dict({'b': np.array([1.0, 0.0]), 'a': np.array([1.0, 0.0]),
+                                        'c': np.array([0.0, 1.0])})
+    assert [label for label, _ in matrix.top_k(np.array([1.0, 0.0]), k=2)] == ['b', 'a']
+
+
+def test_zero_vectors_are_dropped():
+    matrix = DiagnosisMatrix.from_dict({'zero': np.zeros(4), 'one': np.ones(4)})
+    assert list(matrix.labels) == ['one']
+
+
+def test_empty_matrix():
+    matrix = DiagnosisMatrix.from_dict({})
+    assert matrix.top_k(np.ones(4), k=3) == []
+    assert matrix.top_k_batch(np.ones((2, 4)), k=3) == [[], []]
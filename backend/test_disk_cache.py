@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+from disk_cache import DiskCache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite')
+
+
+def stored_total(path, table='entries'):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+
+
+def test_round_trip_and_counters(cache_path):
+    cache = DiskCache(cache_path, 1024)
+    assert cache.get('a') is None
+    cache.put('a', b'value')
+    assert cache.get('a') == b'value'
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['hits'], stats['misses']) == (1, 5, 1, 1)
+
+
+def test_least_recently_used_entries_are_evicted(cache_path):
+    cache = DiskCache(cache_path, 300)
+    for key in 'abc':
+        cache.put(key, bytes(100))
+    cache.get('a')  # 'b' is now the least recently used
+    cache.put('d', bytes(100))
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acd')
+    assert cache.stats()['evictions'] == 1
+
+
+def test_meta_total_tracks_puts_overwrites_and_evictions(cache_path):
+    cache = DiskCache(cache_path, 1000)
+    for i in range(30):
+        cache.put(f"k{i % 12}", bytes(50 + i * 7))
+        assert cache.stats()['bytes'] == stored_total(cache_path)
+        assert cache.stats()['bytes'] <= 1000
+    cache.clear()
+    assert cache.stats()['bytes'] == 0 == stored_total(cache_path)
+
+
+def test_values_larger_than_the_cache_are_not_stored(cache_path):
+    cache = DiskCache(cache_path, 10)
+    cache.put('big', bytes(11))
+    assert cache.get('big') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_total_is_shared_between_instances(cache_path):
+    first, second = DiskCache(cache_path, 250), DiskCache(cache_path, 250)
+    first.put('a', bytes(100))
+    second.put('b', bytes(100))
+    first.put('c', bytes(100))
+    assert first.stats()['bytes'] == stored_total(cache_path) <= 250
+    assert second.get('a') is None
+
+
+def test_files_without_a_total_are_summed_once(cache_path):
+    with sqlite3.connect(cache_path) as conn:
+        conn.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                     "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        conn.execute("INSERT INTO entries VALUES ('old', ?, 40, 0)", (bytes(40),))
+    cache = DiskCache(cache_path, 1000)
+    assert cache.stats()['bytes'] == 40
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from framing import (HEADER, LENGTH, FrameError, FramedClient, decode_body, encode_frame, read_frame,
+                     serve_unix_socket)
+
+
+def test_encode_decode_round_trip():
+    frame = encode_frame(7, {'text': 'ünïcode', 'n': 3}, b'\x00\x01binary')
+    (body_length,) = LENGTH.unpack_from(frame)
+    assert body_length == len(frame) - LENGTH.size
+    assert decode_body(frame[LENGTH.size:]) == (7, {'text': 'ünïcode', 'n': 3}, b'\x00\x01binary')
+
+
+def test_decode_rejects_truncated_bodies():
+    body = encode_frame(1, {'a': 1})[LENGTH.size:]
+    with pytest.raises(FrameError):
+        decode_body(body[:HEADER.size - 1])
+    with pytest.raises(FrameError):
+        decode_body(body[:HEADER.size + 2])
+
+
+def test_read_frame_reads_consecutive_frames_and_clean_eof():
+    async def read_all():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame(1, {'a': 1}) + encode_frame(2, {'b': 2}, b'xy'))
+        reader.feed_eof()
+        return [await read_frame(reader) for _ in range(3)]
+
+    assert asyncio.run(read_all()) == [(1, {'a': 1}, b''), (2, {'b': 2}, b'xy'), None]
+
+
+def test_read_frame_rejects_a_cut_frame():
+    async def read_cut():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame(1, {'a': 1})[:3])
+        reader.feed_eof()
+        return await read_frame(reader)
+
+    with pytest.raises(FrameError):
+        asyncio.run(read_cut())
+
+
+@pytest.fixture
+def server():
+    """serve_unix_socket running on its own event loop in a thread; yields the socket path"""
+    socket_path = os.path.join(tempfile.mkdtemp(), 'serve.sock')
+
+    def handle(message, payload):
+        if message.get('fail'):
+            raise RuntimeError('boom')
+        time.sleep(message.get('sleep', 0))
+        return {'echo': message['n'], 'payload_bytes': len(payload)}
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(serve_unix_socket(handle, socket_path, threads=4))
+    thread = threading.Thread(target=loop.run_until_complete, args=(task,), daemon=True)
+    thread.start()
+    deadline = time.time() + 5
+    while not os.path.exists(socket_path) and time.time() < deadline:
+        time.sleep(0.01)
+    yield socket_path
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(5)
+    loop.close()
+
+
+def test_pipelined_requests_are_answered_by_id(server):
+    async def run():
+        client = FramedClient(server)
+        await client.connect()
+        try:
+            # The slow first request must not hold up the ones pipelined behind it
+            slow = asyncio.ensure_future(client.request({'n': 0, 'sleep': 0.5}))
+            start = time.perf_counter()
+            fast = await asyncio.gather(*(client.request({'n': n}, b'x' * n) for n in range(1, 6)))
+            fast_seconds = time.perf_counter() - start
+            return await slow, fast, fast_seconds
+        finally:
+            await client.close()
+
+    slow, fast, fast_seconds = asyncio.run(run())
+    assert slow == {'echo': 0, 'payload_bytes': 0}
+    assert fast == [{'echo': n, 'payload_bytes': n} for n in range(1, 6)]
+    assert fast_seconds < 0.4
+
+
+def test_handler_errors_become_error_responses(server):
+    async def run():
+        client = FramedClient(server)
+        await client.connect()
+        try:
+            return await client.request({'n': 1, 'fail': True}), await client.request({'n': 2})
+        finally:
+            await client.close()
+
+    failed, ok = asyncio.run(run())
+    assert failed == {'error': 'boom'}
+    assert ok == {'echo': 2, 'payload_bytes': 0}
@@ -0,0 +1,107 @@
+import test from 'node:test';
+import assert from 'node:assert/strict';
+import ImageJobQueue, { QueueFullError } from './utils/imageJobQueue.js';
+
+// A task that finishes when the test says so (at once if that was before it started),
+// or rejects when its signal aborts
+const deferredTask = () => {
+  let resolveTask = null;
+  let finished = false;
+  let result;
+  let aborted = false;
+  const task = (signal) => new Promise((resolve, reject) => {
+    if (finished) return resolve(result);
+    resolveTask = resolve;
+    signal.addEventListener('abort', () => {
+      aborted = true;
+      reject(new Error('aborted'));
+    });
+  });
+  const finish = (value) => {
+    finished = true;
+    result = value;
+    if (resolveTask) resolveTask(value);
+  };
+  return { task, finish, wasAborted: () => aborted };
+};
+
+test('rejects submissions beyond the queue bound', async () => {
+  const queue = new ImageJobQueue({ workers: 1, maxQueue: 2 });
+  const tasks = [deferredTask(), deferredTask(), deferredTask()];
+  const ids = tasks.map(({ task }) => queue.submit(task));
+  assert.throws(() => queue.submit(deferredTask().task), QueueFullError);
+  assert.deepEqual(
+    { running: queue.stats().running, waiting: queue.stats().waiting, rejected: queue.stats().rejected },
+    { running: 1, waiting: 2, rejected: 1 }
+  );
+
+  // Each task starts only after the one before it settles, so finish them in order
+  for (const [index, id] of ids.entries()) {
+    tasks[index].finish();
+    await queue.wait(id);
+  }
+});
+
+test('frees a worker slot only when its task settles', async () => {
+  const queue = new ImageJobQueue({ workers: 1, maxQueue: 4 });
+  const first = deferredTask();
+  const firstId = queue.submit(first.task);
+  const secondId = queue.submit(async () => 'second');
+  assert.equal(queue.get(secondId).status, 'queued');
+  assert.equal(queue.get(secondId).position, 1);
+
+  first.finish('first');
+  assert.equal((await queue.wait(firstId)).result, 'first');
+  assert.equal((await queue.wait(secondId)).result, 'second');
+  // The slot is released just after the finished job is reported
+  await new Promise(setImmediate);
+  assert.equal(queue.stats().running, 0);
+});
+
+test('runs higher priority jobs first, FIFO within a priority', async () => {
+  const queue = new ImageJobQueue({ workers: 1, maxQueue: 8 });
+  const order = [];
+  const blocker = deferredTask();
+  queue.submit(blocker.task);
+  const ids = [['low', 0], ['high', 1], ['low2', 0], ['high2', 1]].map(([name, priority]) =>
+    queue.submit(async () => order.push(name), { priority }));
+
+  blocker.finish();
+  await Promise.all(ids.map((id) => queue.wait(id)));
+  assert.deepEqual(order, ['high', 'high2', 'low', 'low2']);
+});
+
+test('aborts a job that runs past its timeout', async () => {
+  const queue = new ImageJobQueue({ workers: 1, maxQueue: 2, timeoutMs: 20 });
+  const slow = deferredTask();
+  const id = queue.submit(slow.task);
+  const view = await queue.wait(id);
+  assert.equal(view.status, 'timed_out');
+  assert.equal(view.statusCode, 504);
+  assert.ok(slow.wasAborted());
+  assert.equal(queue.stats().timedOut, 1);
+});
+
+test('reports failures with their status code', async () => {
+  const queue = new ImageJobQueue({ workers: 1, maxQueue: 2 });
+  const id = queue.submit(async () => {
+    const error = new Error('bad image');
+    error.statusCode = 400;
+    throw error;
+  });
+  const view = await queue.wait(id);
+  assert.deepEqual([view.status, view.error, view.statusCode], ['failed', 'bad image', 400]);
+});
+
+test('subscribers see every state change until the job finishes', async () => {
+  const queue = new ImageJobQueue({ workers: 1, maxQueue: 2 });
+  const blocker = deferredTask();
+  queue.submit(blocker.task);
+  const id = queue.submit(async () => 'done');
+  const statuses = [];
+  queue.subscribe(id, (view) => statuses.push(view.status));
+
+  blocker.finish();
+  await queue.wait(id);
+  assert.deepEqual(statuses, ['running', 'succeeded']);
+});
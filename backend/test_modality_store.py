@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from modality_store import ModalityStore
+
+
+class Sized(list):
+    nbytes = 0
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    (tmp_path / 'xray').mkdir()
+    (tmp_path / 'xray' / 'patient_data.json').write_text('["v1"]')
+    return tmp_path
+
+
+def touch(path, text):
+    path.write_text(text)
+    # Make the change visible even on filesystems with coarse timestamps
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def reading_loader(data_root):
+    def load(modality):
+        text = (data_root / modality / 'patient_data.json').read_text()
+        if 'broken' in text:
+            raise ValueError('unreadable data')
+        return Sized([text]), Sized([text])
+    return load
+
+
+def test_changed_files_swap_in_a_new_snapshot(data_root):
+    store = ModalityStore(str(data_root), reading_loader(data_root))
+    first = store.get('xray')
+    assert first.version == 1 and first.matrix == ['["v1"]']
+
+    store.check()
+    assert store.get('xray') is first
+
+    touch(data_root / 'xray' / 'patient_data.json', '["v2"]')
+    store.check()
+    second = store.get('xray')
+    assert second.version == 2 and second.matrix == ['["v2"]']
+    # A request that took the old snapshot keeps seeing the old data
+    assert first.matrix == ['["v1"]']
+
+
+def test_failed_reload_keeps_serving_the_old_snapshot(data_root):
+    calls = []
+    loader = reading_loader(data_root)
+    store = ModalityStore(str(data_root), lambda modality: calls.append(modality) or loader(modality))
+    first = store.get('xray')
+
+    touch(data_root / 'xray' / 'patient_data.json', 'broken')
+    store.check()
+    assert store.get('xray') is first
+    assert store.stats()['xray']['last_error'] == 'unreadable data'
+
+    # The same broken files are not retried on every poll
+    store.check()
+    assert len(calls) == 2
+
+    touch(data_root / 'xray' / 'patient_data.json', '["v3"]')
+    store.check()
+    assert store.get('xray').version == 2
+    assert 'last_error' not in store.stats()['xray']
+
+
+def test_preload_reports_failures(data_root):
+    store = ModalityStore(str(data_root), reading_loader(data_root))
+    failures = store.preload(['xray', 'ct'])
+    assert list(failures) == ['ct']
+    assert list(store.loaded()) == ['xray']
+    assert 'last_error' in store.stats()['ct']
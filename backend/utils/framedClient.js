@@ -0,0 +1,136 @@
+// Framed Unix-socket client for the Python serve modes
+// Wire format is documented in scripts/framing.py
+
+import net from 'net';
+
+const MAX_FRAME_BYTES = 64 * 1024 * 1024;
+
+// Everything of a frame before its payload: body length, request id, metadata length, JSON metadata
+export const encodeFrameHead = (requestId, message, payloadLength = 0) => {
+  const metadata = Buffer.from(JSON.stringify(message), 'utf8');
+  const header = Buffer.alloc(16);
+  header.writeUInt32BE(12 + metadata.length + payloadLength, 0);
+  header.writeBigUInt64BE(BigInt(requestId), 4);
+  header.writeUInt32BE(metadata.length, 12);
+  return Buffer.concat([header, metadata]);
+};
+
+// Encode one frame: body length, request id, metadata length, JSON metadata, payload
+export const encodeFrame = (requestId, message, payload = Buffer.alloc(0)) =>
+  Buffer.concat([encodeFrameHead(requestId, message, payload.length), payload]);
+
+class FramedClient {
+  constructor(socketPath, { timeout = 40000 } = {}) {
+    this.socketPath = socketPath;
+    this.timeout = timeout;
+    this.socket = null;
+    this.connecting = null;
+    this.buffer = Buffer.alloc(0);
+    this.pending = new Map();
+    this.nextId = 1;
+  }
+
+  // Connect once and reuse the connection for every request
+  connect() {
+    if (this.socket) return Promise.resolve(this.socket);
+    if (this.connecting) return this.connecting;
+
+    this.connecting = new Promise((resolve, reject) => {
+      const socket = net.createConnection(this.socketPath);
+
+      socket.once('connect', () => {
+        this.socket = socket;
+        this.connecting = null;
+        resolve(socket);
+      });
+
+      socket.on('data', (chunk) => this.onData(chunk));
+
+      socket.on('error', (err) => {
+        if (this.connecting) {
+          this.connecting = null;
+          reject(err);
+        }
+        this.failPending(err);
+      });
+
+      socket.on('close', () => {
+        this.socket = null;
+        this.buffer = Buffer.alloc(0);
+        this.failPending(new Error('Model socket closed'));
+      });
+    });
+
+    return this.connecting;
+  }
+
+  onData(chunk) {
+    this.buffer = Buffer.concat([this.buffer, chunk]);
+
+    while (this.buffer.length >= 4) {
+      const bodyLength = this.buffer.readUInt32BE(0);
+      if (bodyLength > MAX_FRAME_BYTES) {
+        this.socket.destroy(new Error(`Frame of ${bodyLength} bytes exceeds limit`));
+        return;
+      }
+      if (this.buffer.length < 4 + bodyLength) return;
+
+      const requestId = Number(this.buffer.readBigUInt64BE(4));
+      const metadataLength = this.buffer.readUInt32BE(12);
+      const metadata = this.buffer.subarray(16, 16 + metadataLength).toString('utf8');
+      this.buffer = this.buffer.subarray(4 + bodyLength);
+
+      const entry = this.pending.get(requestId);
+      if (!entry) continue;
+      this.pending.delete(requestId);
+      clearTimeout(entry.timer);
+
+      try {
+        entry.resolve(JSON.parse(metadata));
+      } catch (parseError) {
+        entry.reject(new Error(`Failed to parse model response: ${parseError.message}`));
+      }
+    }
+  }
+
+  failPending(err) {
+    for (const entry of this.pending.values()) {
+      clearTimeout(entry.timer);
+      entry.reject(err);
+    }
+    this.pending.clear();
+  }
+
+  // Send a request; resolves with the response metadata object. Aborting
+  // `signal` rejects at once and ignores the response if it arrives later.
+  async request(message, payload, { signal } = {}) {
+    signal?.throwIfAborted();
+    const socket = await this.connect();
+    signal?.throwIfAborted();
+    const requestId = this.nextId++;
+
+    return new Promise((resolve, reject) => {
+      const settle = (callback) => (value) => {
+        clearTimeout(timer);
+        signal?.removeEventListener('abort', onAbort);
+        callback(value);
+      };
+      const onAbort = () => {
+        this.pending.delete(requestId);
+        settle(reject)(signal.reason ?? new Error('Model socket request aborted'));
+      };
+      const timer = setTimeout(() => {
+        this.pending.delete(requestId);
+        settle(reject)(new Error('Model socket request timeout'));
+      }, this.timeout);
+
+      this.pending.set(requestId, { resolve: settle(resolve), reject: settle(reject), timer });
+      signal?.addEventListener('abort', onAbort, { once: true });
+      // The payload (an uploaded image) is written as-is rather than copied into the frame
+      socket.write(encodeFrameHead(requestId, message, payload ? payload.length : 0));
+      if (payload && payload.length) socket.write(payload);
+    });
+  }
+}
+
+export default FramedClient;
@@ -0,0 +1,176 @@
+// Bounded in-process job queue for image analysis
+// A fixed number of workers pull jobs from a priority queue (higher priority
+// first, FIFO within a priority). Submitting to a full queue throws
+// QueueFullError instead of letting uploads pile up. Each job has a timeout,
+// enforced through an AbortSignal passed to the task; finished jobs are kept
+// for `retainMs` so clients can poll or subscribe for the result.
+
+import { EventEmitter } from 'events';
+import crypto from 'crypto';
+
+export class QueueFullError extends Error {
+  constructor(message) {
+    super(message);
+    this.name = 'QueueFullError';
+  }
+}
+
+class ImageJobQueue extends EventEmitter {
+  constructor({ workers = 2, maxQueue = 16, timeoutMs = 120000, retainMs = 10 * 60 * 1000 } = {}) {
+    super();
+    // One event per job id; several clients may subscribe to the same job
+    this.setMaxListeners(0);
+    this.workers = workers;
+    this.maxQueue = maxQueue;
+    this.timeoutMs = timeoutMs;
+    this.retainMs = retainMs;
+    this.waiting = [];
+    this.jobs = new Map();
+    this.running = 0;
+    this.counts = { submitted: 0, rejected: 0, succeeded: 0, failed: 0, timedOut: 0 };
+  }
+
+  // Queue `task(signal)`; returns the job id or throws QueueFullError
+  submit(task, { priority = 0, timeoutMs = this.timeoutMs, meta = {} } = {}) {
+    if (this.waiting.length >= this.maxQueue) {
+      this.counts.rejected += 1;
+      throw new QueueFullError(`Image analysis queue is full (${this.maxQueue} waiting)`);
+    }
+
+    const job = {
+      id: crypto.randomUUID(),
+      status: 'queued',
+      priority,
+      timeoutMs,
+      meta,
+      task,
+      submittedAt: Date.now(),
+      startedAt: null,
+      finishedAt: null,
+      result: null,
+      error: null,
+      statusCode: null
+    };
+    this.jobs.set(job.id, job);
+    this.counts.submitted += 1;
+
+    // Insert after every job of equal or higher priority
+    let index = this.waiting.findIndex((queued) => queued.priority < priority);
+    if (index === -1) index = this.waiting.length;
+    this.waiting.splice(index, 0, job);
+
+    this.emit(job.id, this.view(job));
+    this.drain();
+    return job.id;
+  }
+
+  drain() {
+    while (this.running < this.workers && this.waiting.length > 0) {
+      this.run(this.waiting.shift());
+    }
+  }
+
+  async run(job) {
+    this.running += 1;
+    job.status = 'running';
+    job.startedAt = Date.now();
+    this.emit(job.id, this.view(job));
+
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), job.timeoutMs);
+    const settled = Promise.resolve().then(() => job.task(controller.signal));
+    const timedOut = new Promise((_, reject) => {
+      controller.signal.addEventListener('abort', () => reject(new Error('timeout')), { once: true });
+    });
+
+    try {
+      // Report a timeout as soon as it happens, even if the task is slow to stop
+      job.result = await Promise.race([settled, timedOut]);
+      job.status = 'succeeded';
+      this.counts.succeeded += 1;
+    } catch (error) {
+      if (controller.signal.aborted) {
+        job.status = 'timed_out';
+        job.error = `Image analysis timed out after ${job.timeoutMs}ms`;
+        job.statusCode = 504;
+        this.counts.timedOut += 1;
+      } else {
+        job.status = 'failed';
+        job.error = error.message;
+        job.statusCode = error.statusCode || 500;
+        this.counts.failed += 1;
+      }
+    } finally {
+      clearTimeout(timer);
+      job.finishedAt = Date.now();
+      job.task = null;
+      this.emit(job.id, this.view(job));
+      setTimeout(() => this.jobs.delete(job.id), this.retainMs).unref();
+    }
+
+    // The worker slot is freed only once the task has settled, so memory stays bounded
+    await settled.catch(() => {});
+    this.running -= 1;
+    this.drain();
+  }
+
+  get(id) {
+    const job = this.jobs.get(id);
+    return job ? this.view(job) : null;
+  }
+
+  // Resolves with the finished job's view
+  wait(id) {
+    return new Promise((resolve, reject) => {
+      const job = this.jobs.get(id);
+      if (!job) return reject(new Error(`Unknown job ${id}`));
+      if (job.finishedAt) return resolve(this.view(job));
+      const onUpdate = (view) => {
+        if (view.finishedAt) {
+          this.off(id, onUpdate);
+          resolve(view);
+        }
+      };
+      this.on(id, onUpdate);
+    });
+  }
+
+  // Calls `listener(view)` on every state change until the job finishes; returns an unsubscribe function
+  subscribe(id, listener) {
+    const onUpdate = (view) => {
+      listener(view);
+      if (view.finishedAt) this.off(id, onUpdate);
+    };
+    this.on(id, onUpdate);
+    return () => this.off(id, onUpdate);
+  }
+
+  view(job) {
+    const position = job.status === 'queued' ? this.waiting.indexOf(job) + 1 : null;
+    return {
+      id: job.id,
+      status: job.status,
+      priority: job.priority,
+      position,
+      submittedAt: job.submittedAt,
+      startedAt: job.startedAt,
+      finishedAt: job.finishedAt,
+      result: job.result,
+      error: job.error,
+      statusCode: job.statusCode,
+      meta: job.meta
+    };
+  }
+
+  stats() {
+    return {
+      workers: this.workers,
+      maxQueue: this.maxQueue,
+      running: this.running,
+      waiting: this.waiting.length,
+      ...this.counts
+    };
+  }
+}
+
+export default ImageJobQueue;
@@ -4,6 +4,8 @@
 import { spawn } from 'child_process';
 import path from 'path';
 import fs from 'fs';
+import axios from 'axios';
+import FramedClient from './framedClient.js';
 
 class RAGMedicalAssistant {
   constructor() {
@@ -14,6 +16,22 @@ class RAGMedicalAssistant {
     this.modelLoaded = false;
   }
 
+  // Warm Python inference service (scripts/inference_service.py), if deployed.
+  // Read lazily because this singleton is built before dotenv runs.
+  get serviceUrl() {
+    return process.env.INFERENCE_SERVICE_URL || null;
+  }
+
+  // Persistent serve-mode process listening on a Unix socket, if configured
+  get socketClient() {
+    const socketPath = process.env.RAG_SOCKET_PATH;
+    if (!socketPath) return null;
+    if (!this._socketClient || this._socketClient.socketPath !== socketPath) {
+      this._socketClient = new FramedClient(socketPath, { timeout: 40000 });
+    }
+    return this._socketClient;
+  }
+
   // Initialize the RAG model
   async initialize() {
     try {
@@ -36,13 +54,25 @@ class RAGMedicalAssistant {
     }
   }
 
-  // Check if model artifacts exist
+  // Check if model artifacts exist for the layout model_config.json records
+  // (num_shards is set when the last initialization built shards)
   async checkModelExists() {
-    const requiredFiles = [
+    const configPath = path.join(this.modelPath, 'model_config.json');
+    if (!fs.existsSync(configPath)) {
+      return false;
+    }
+    let sharded;
+    try {
+      sharded = Boolean(JSON.parse(fs.readFileSync(configPath, 'utf8')).num_shards);
+    } catch (error) {
+      return false;
+    }
+    const requiredFiles = sharded ? [
+      path.join('shards', 'manifest.json')
+    ] : [
       'faiss_index.bin',
       'corpus_embeddings.npy',
-      'cleaned_patients.csv',
-      'model_config.json'
+      'cleaned_patients.csv'
     ];
 
     for (const file of requiredFiles) {
@@ -67,7 +97,14 @@ class RAGMedicalAssistant {
     }
 
     try {
-      const response = await this.callPythonRAG(userQuery, context);
+      let response;
+      if (this.socketClient) {
+        response = await this.callSocketRAG(userQuery, context);
+      } else if (this.serviceUrl) {
+        response = await this.callInferenceService(userQuery, context);
+      } else {
+        response = await this.callPythonRAG(userQuery, context);
+      }
       
       const responseTime = Date.now() - startTime;
       console.log(`[RAG] Query processed in ${responseTime}ms`);
@@ -80,6 +117,39 @@ class RAGMedicalAssistant {
     }
   }
 
+  // Call a warm serve-mode process over its framed Unix socket
+  async callSocketRAG(query, context) {
+    const message = {
+      query,
+      age: context.age ?? null,
+      gender: context.gender ?? null
+    };
+    // Only the latency-budget router (scripts/rag_router.py) reads this field
+    if (process.env.RAG_LATENCY_BUDGET_MS) {
+      message.latency_budget_ms = Number(process.env.RAG_LATENCY_BUDGET_MS);
+    }
+    const response = await this.socketClient.request(message);
+    if (response.error) {
+      throw new Error(`[RAG] Model error: ${response.error}`);
+    }
+    return response;
+  }
+
+  // Call the warm inference service instead of spawning a process
+  async callInferenceService(query, context) {
+    try {
+      const { data } = await axios.post(`${this.serviceUrl}/rag/query`, {
+        query,
+        age: context.age ?? null,
+        gender: context.gender ?? null
+      }, { timeout: 40000 });
+      return data;
+    } catch (error) {
+      const detail = error.response?.data?.detail || error.message;
+      throw new Error(`[RAG] Inference service error: ${detail}`);
+    }
+  }
+
   // Call Python RAG processor with optimization
   async callPythonRAG(query, context) {
     return new Promise((resolve, reject) => {